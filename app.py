@@ -1,15 +1,55 @@
+# first, so the startup report's import phase times loading everything else
+from startup import startup_report, ready
 import os
-from flask import Flask, request, abort, jsonify
+from flask import (
+    Flask, request, abort, jsonify, stream_with_context, _request_ctx_stack)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_db, db_drop_and_create_all, Movie, Actor
+from models import (
+    setup_db, db_drop_and_create_all, db, Movie, Actor, Job, clean_datetime)
 from auth import AuthError, requires_auth
+from metrics import init_metrics
+from compression import compressor
+from rate_limit import rate_limiter, load_shedder
+from slow_queries import slow_query_log
+from permissions import permission_registry
+from idempotency import idempotent
+from single_flight import single_flight
+from routing import client_key, read_only
+from http_cache import conditional, cached_json
+from cache import resource_key
+from serializers import json_response
+from pagination import (
+    parse_fields, parse_page_args, parse_sort, keyset_page, sort_order)
+from filters import parse_filters
+from relations import parse_include, embed_related, in_cast_of, in_films_of
+from changes import (
+    CHANGES_MAX_PAGE_SIZE, init_change_log, last_seq, parse_changes_args,
+    purged_seq, read_changes, readable_tables, wait_for_changes)
+from events import event_stream_response, init_events, subscribe
+from jobs import enqueue, job_runner, result_chunks
+from export import stream_export
+from bulk import (
+    BULK_CHUNK_SIZE, BULK_MAX_ITEMS, run_bulk,
+    prepare_create, prepare_update, prepare_delete,
+    write_create, write_update, write_delete)
 
 
 def create_app(test_config=None):
 
+    started = startup_report.clock()
+    startup_report.imported()
     app = Flask(__name__)
+    if test_config:
+        app.config.from_mapping(test_config)
+    init_metrics(app)
+    compressor.init_app(app)
     setup_db(app)
+    load_shedder.init_app(app, db)
+    rate_limiter.init_app(app)
+    init_change_log(app)
+    init_events(app)
+    job_runner.init_app(app)
     CORS(app)
     #db_drop_and_create_all()
 
@@ -21,7 +61,7 @@ def create_app(test_config=None):
             'Content-Type,Authorization,true')
         response.headers.add(
             'Access-Control-Allow-Methods',
-            'GET,PATCH,POST,DELETE,OPTIONS')
+            'GET,PUT,PATCH,POST,DELETE,OPTIONS')
         return response
 
 
@@ -35,33 +75,195 @@ def create_app(test_config=None):
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
+    @read_only
+    @single_flight
+    @conditional(Actor)
     def get_actors(jwt):
 
-        actors = Actor.query.all()
-        formatted_actors = [actor.format() for actor in actors]
+        criteria = parse_filters(request.args, Actor)
 
-        if len(actors) == 0:
+        if 'export' in request.args:
+            return stream_export(
+                Actor, 'actors', parse_fields(request.args, Actor),
+                request.args['export'], criteria,
+                sort_order(Actor, parse_sort(request.args, Actor)))
+
+        include = parse_include(
+            request.args, Actor, _request_ctx_stack.top.granted_permissions)
+        limit, after, fields, sort = parse_page_args(request.args, Actor)
+        if include and 'id' not in fields:
+            fields = ['id'] + fields
+        formatted_actors, next_cursor = keyset_page(
+            Actor, limit, after, fields, criteria, sort)
+        embed_related(Actor, formatted_actors, include)
+
+        if len(formatted_actors) == 0:
             abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'actors': formatted_actors
-        }), 200
+            'actors': formatted_actors,
+            'next_cursor': next_cursor
+        }, 200)
 
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
+    @read_only
+    @single_flight
+    @conditional(Movie)
     def get_movies(jwt):
 
-        movies = Movie.query.all()
-        formatted_movies = [movie.format() for movie in movies]
+        criteria = parse_filters(request.args, Movie)
 
-        if len(movies) == 0:
+        if 'export' in request.args:
+            return stream_export(
+                Movie, 'movies', parse_fields(request.args, Movie),
+                request.args['export'], criteria,
+                sort_order(Movie, parse_sort(request.args, Movie)))
+
+        include = parse_include(
+            request.args, Movie, _request_ctx_stack.top.granted_permissions)
+        limit, after, fields, sort = parse_page_args(request.args, Movie)
+        if include and 'id' not in fields:
+            fields = ['id'] + fields
+        formatted_movies, next_cursor = keyset_page(
+            Movie, limit, after, fields, criteria, sort)
+        embed_related(Movie, formatted_movies, include)
+
+        if len(formatted_movies) == 0:
             abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'movies': formatted_movies
-        }), 200
+            'movies': formatted_movies,
+            'next_cursor': next_cursor
+        }, 200)
+
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    @read_only
+    @single_flight
+    def get_actor(jwt, actor_id):
+
+        def lookup():
+            formatted_actor = Actor.lookup(actor_id)
+
+            if formatted_actor is None:
+                abort(404)
+
+            return json_response({
+                'success': True,
+                'actor': formatted_actor
+            }, 200)
+
+        return cached_json(
+            resource_key(Actor.__tablename__, actor_id), lookup,
+            shared_only=True)
+
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    @read_only
+    @single_flight
+    def get_movie(jwt, movie_id):
+
+        def lookup():
+            formatted_movie = Movie.lookup(movie_id)
+
+            if formatted_movie is None:
+                abort(404)
+
+            return json_response({
+                'success': True,
+                'movie': formatted_movie
+            }, 200)
+
+        return cached_json(
+            resource_key(Movie.__tablename__, movie_id), lookup,
+            shared_only=True)
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    @read_only
+    @single_flight
+    @conditional(Actor, extra_tables=(Movie.__tablename__,), includes=False)
+    def get_movie_actors(jwt, movie_id):
+
+        if Movie.lookup(movie_id) is None:
+            abort(404)
+
+        criteria = parse_filters(request.args, Actor) + [in_cast_of(movie_id)]
+        limit, after, fields, sort = parse_page_args(request.args, Actor)
+        formatted_actors, next_cursor = keyset_page(
+            Actor, limit, after, fields, criteria, sort)
+
+        return json_response({
+            'success': True,
+            'actors': formatted_actors,
+            'next_cursor': next_cursor
+        }, 200)
+
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:movies')
+    @read_only
+    @single_flight
+    @conditional(Movie, extra_tables=(Actor.__tablename__,), includes=False)
+    def get_actor_movies(jwt, actor_id):
+
+        if Actor.lookup(actor_id) is None:
+            abort(404)
+
+        criteria = parse_filters(request.args, Movie) + [in_films_of(actor_id)]
+        limit, after, fields, sort = parse_page_args(request.args, Movie)
+        formatted_movies, next_cursor = keyset_page(
+            Movie, limit, after, fields, criteria, sort)
+
+        return json_response({
+            'success': True,
+            'movies': formatted_movies,
+            'next_cursor': next_cursor
+        }, 200)
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['PUT'])
+    @requires_auth('patch:movies')
+    def cast_actor(jwt, movie_id, actor_id):
+
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+
+        if movie is None or actor is None:
+            abort(404)
+        try:
+            movie.cast(actor)
+
+            return jsonify({
+                'success': True,
+                'movie_id': movie_id,
+                'actor_id': actor_id
+            }), 200
+
+        except BaseException:
+            abort(422)
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def uncast_actor(jwt, movie_id, actor_id):
+
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+
+        if movie is None or actor is None or actor not in movie.actors:
+            abort(404)
+        try:
+            movie.uncast(actor)
+
+            return jsonify({
+                'success': True,
+                'movie_id': movie_id,
+                'actor_id': actor_id
+            }), 200
+
+        except BaseException:
+            abort(422)
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
@@ -103,6 +305,7 @@ def create_app(test_config=None):
 
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def add_new_actor(jwt):
 
         try:
@@ -125,12 +328,13 @@ def create_app(test_config=None):
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def add_new_movie(jwt):
 
         try:
             body = request.get_json()
             movie_title = body['title']
-            movie_release_date = body['release_date']
+            movie_release_date = clean_datetime(body, 'release_date')
 
             new_movie = Movie(title=movie_title, release_date=movie_release_date)
 
@@ -146,6 +350,7 @@ def create_app(test_config=None):
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
+    @idempotent
     def update_actor(jwt, actor_id):
 
         actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
@@ -177,6 +382,7 @@ def create_app(test_config=None):
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
+    @idempotent
     def update_movie(jwt, movie_id):
 
         movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
@@ -191,7 +397,7 @@ def create_app(test_config=None):
                 movie.title = body['title']
 
             if 'release_date' in body:
-                movie.release_date = body['release_date']
+                movie.release_date = clean_datetime(body, 'release_date')
 
             movie.update()
 
@@ -203,6 +409,184 @@ def create_app(test_config=None):
         except BaseException:
             abort(422)
 
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('get:changes')
+    @read_only
+    def get_changes(jwt):
+
+        since, limit, wait = parse_changes_args(request.args)
+        if since is None:
+            # where to start following the log after a full pull
+            return jsonify({
+                'success': True,
+                'changes': [],
+                'next_since': last_seq(),
+                'more': False
+            }), 200
+        if since < purged_seq():
+            abort(410)
+
+        tables = readable_tables(_request_ctx_stack.top.granted_permissions)
+        if wait:
+            wait_for_changes(since, tables, wait)
+        changes = read_changes(since, limit, tables)
+
+        return json_response({
+            'success': True,
+            'changes': changes,
+            'next_since': changes[-1]['seq'] if changes else since,
+            'more': len(changes) == limit
+        })
+
+    @app.route('/events', methods=['GET'])
+    @requires_auth()
+    def get_events(jwt):
+
+        # events are filtered by the caller's get:actors / get:movies
+        granted = _request_ctx_stack.top.granted_permissions
+        if not readable_tables(granted):
+            abort(401)
+        since = request.headers.get(
+            'Last-Event-ID', request.args.get('since'))
+        try:
+            since = int(since) if since is not None else None
+        except ValueError:
+            abort(400)
+
+        subscription = subscribe(granted, db.engine)
+        # changes missed while disconnected come from the change log; a
+        # client too far behind is told to reload instead
+        backlog, resync = [], False
+        if since is not None:
+            changes = read_changes(
+                since, CHANGES_MAX_PAGE_SIZE + 1, readable_tables(granted))
+            if since < purged_seq() or len(changes) > CHANGES_MAX_PAGE_SIZE:
+                resync = True
+            else:
+                backlog = [
+                    {key: change[key] for key in ('seq', 'table', 'id', 'op')}
+                    for change in changes]
+
+        return event_stream_response(subscription, backlog, resync)
+
+    @app.route('/admin/slow-queries', methods=['GET'])
+    @requires_auth('get:diagnostics')
+    def get_slow_queries(jwt):
+
+        return jsonify({
+            'success': True,
+            'worker': os.getpid(),
+            'threshold_ms': slow_query_log.threshold_ms,
+            'slow_queries': slow_query_log.top()
+        }), 200
+
+    @app.route('/admin/permissions', methods=['GET'])
+    @requires_auth('get:diagnostics')
+    def get_permissions(jwt):
+
+        granted = _request_ctx_stack.top.granted_permissions
+
+        return jsonify(dict(
+            permission_registry.describe(),
+            success=True,
+            granted={
+                'permissions': permission_registry.names(granted),
+                'roles': permission_registry.role_names(granted)
+            })), 200
+
+    def bulk_response(prepare, write):
+        items = request.get_json(silent=True)
+        if not isinstance(items, list) or len(items) > BULK_MAX_ITEMS:
+            abort(422)
+        try:
+            chunk_size = int(request.args.get('chunk_size', BULK_CHUNK_SIZE))
+        except ValueError:
+            abort(400)
+        if chunk_size < 1:
+            abort(400)
+        atomic = request.args.get('atomic', '').lower() in ('1', 'true')
+
+        results, rejected = run_bulk(
+            items, prepare, write, chunk_size, atomic)
+
+        return jsonify({
+            'success': not rejected,
+            'results': results
+        }), 422 if atomic and rejected else 200
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    @idempotent
+    def bulk_add_actors(jwt):
+        return bulk_response(prepare_create(Actor), write_create(Actor))
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    @idempotent
+    def bulk_add_movies(jwt):
+        return bulk_response(prepare_create(Movie), write_create(Movie))
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    @idempotent
+    def bulk_update_actors(jwt):
+        return bulk_response(prepare_update(Actor), write_update(Actor))
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    @idempotent
+    def bulk_update_movies(jwt):
+        return bulk_response(prepare_update(Movie), write_update(Movie))
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def bulk_delete_actors(jwt):
+        return bulk_response(prepare_delete(Actor), write_delete(Actor))
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def bulk_delete_movies(jwt):
+        return bulk_response(prepare_delete(Movie), write_delete(Movie))
+
+    @app.route('/jobs', methods=['POST'])
+    @requires_auth()
+    @idempotent
+    def create_job(jwt):
+
+        # the job's own permission, e.g. post:actors, is checked by enqueue
+        job = enqueue(
+            request.get_json(silent=True), client_key(),
+            _request_ctx_stack.top.granted_permissions)
+        job_runner.start(app)
+
+        response = jsonify({'success': True, 'job': job.format()})
+        response.headers['Location'] = f'/jobs/{job.id}'
+        return response, 202
+
+    def owned_job(job_id):
+        job = Job.query.get(job_id)
+        if job is None or job.owner != client_key():
+            abort(404)
+        return job
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    @requires_auth()
+    def get_job(jwt, job_id):
+        return jsonify({'success': True, 'job': owned_job(job_id).format()})
+
+    @app.route('/jobs/<job_id>/result', methods=['GET'])
+    @requires_auth()
+    def get_job_result(jwt, job_id):
+
+        job = owned_job(job_id)
+        if job.status == 'failed':
+            abort(422)
+        if job.status != 'succeeded':
+            abort(409)
+        return app.response_class(
+            stream_with_context(result_chunks(job.id)),
+            mimetype=job.result_mimetype)
+
 
     @app.errorhandler(422)
     def unprocessable(error):
@@ -228,6 +612,46 @@ def create_app(test_config=None):
             'message': 'method not allowed'
         }), 401
 
+    @app.errorhandler(409)
+    def conflict(error):
+        response = jsonify({
+            'success': False,
+            'error': 409,
+            'message': 'request in progress'
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 409
+
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+            'success': False,
+            'error': 410,
+            'message': 'changes no longer available, resync'
+        }), 410
+
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'too many requests'
+        })
+        if error.retry_after:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            'success': False,
+            'error': 503,
+            'message': 'service unavailable'
+        })
+        if error.retry_after:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 503
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({
@@ -241,9 +665,23 @@ def create_app(test_config=None):
         response = jsonify(error.error)
         response.status_code = error.status_code
         return response
+
+    permission_registry.compile(app)
+
+    startup_report.record('create_app', startup_report.clock() - started)
     return app
 
-app = create_app()
+
+def __getattr__(name):
+    # the module's app is built on first use (gunicorn app:app, flask run),
+    # so importing create_app does not build one
+    if name == 'app':
+        globals()['app'] = create_app()
+        return globals()['app']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 if __name__ == '__main__':
+    app = create_app()
+    app.logger.info('App %s', ready(app))
     app.run()
\ No newline at end of file
@@ -0,0 +1,14 @@
+# Cooperative entry point: run with
+#
+#   gunicorn -k gevent --worker-connections 100 async_app:app
+#
+# gevent switches to another request whenever one waits on the network, so
+# a worker keeps many requests in flight while they wait on Postgres or the
+# JWKS endpoint. psycopg2 is a C extension and needs psycogreen to yield.
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+from app import app
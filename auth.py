@@ -1,13 +1,31 @@
+import hashlib
 import json
-from flask import _request_ctx_stack
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
+from prometheus_client import Counter
 from urllib.request import urlopen
+from metrics import timed
+from permissions import permission_registry
+from rate_limit import rate_limiter
 
 
-AUTH_DOMAIN = 'majeed.us.auth0.com'
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'majeed.us.auth0.com')
 ALGORITHMS = ['RS256']
-API_AUDIENCE = 'capstone'
+API_AUDIENCE = os.environ.get('API_AUDIENCE', 'capstone')
+
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = float(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -44,44 +62,248 @@ def get_token_auth_header():
     token = parts[1]
     return token
 
-def check_permissions(permission, payload):
-    if permissions not in payload:
+# JWKS Cache
+
+def jwks_from_url(url=JWKS_URL, timeout=JWKS_FETCH_TIMEOUT):
+    def provider():
+        with urlopen(url, timeout=timeout) as jsonurl:
+            return json.loads(jsonurl.read())
+    return provider
+
+def jwks_from_file(path):
+    def provider():
+        with open(path) as jwks_file:
+            return json.load(jwks_file)
+    return provider
+
+
+class JWKSCache:
+    '''
+    Parsed signing keys indexed by kid, shared by every request in the worker.
+
+    Keys are refetched once the TTL has passed, or when a token names a kid
+    we have not seen; the latter is throttled by min_refresh_interval so a
+    stream of forged kids cannot turn into a stream of fetches. If a refetch
+    fails the previous keys stay in service.
+
+    With background_refresh, an expired key set keeps being served while a
+    background thread fetches the new one, so only the very first request
+    (or an unknown kid) ever waits on the IdP.
+    '''
+
+    def __init__(self, provider, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 clock=time.monotonic, background_refresh=True):
+        self.provider = provider
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self.background_refresh = background_refresh
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refresh_thread = None
+        self._lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+
+    def get_key(self, kid):
+        if self._is_stale():
+            if self._keys and self.background_refresh:
+                self.refresh_in_background()
+            else:
+                self.refresh()
+        key = self._keys.get(kid)
+        if key is None and self._may_refresh():
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = self.clock()
+            # another thread may have refreshed while we waited on the lock,
+            # or the IdP failed us a moment ago; keep serving what we have
+            if not force and self._keys and not self._may_refresh(now):
+                return
+            self._last_attempt = now
+            try:
+                jwks = self.provider()
+                self.fetch_count += 1
+                keys = {}
+                for key in jwks['keys']:
+                    if key.get('kty') != 'RSA' or 'kid' not in key:
+                        continue
+                    keys[key['kid']] = jwk.construct({
+                        'kty': key['kty'],
+                        'kid': key['kid'],
+                        'use': key.get('use', 'sig'),
+                        'n': key['n'],
+                        'e': key['e']
+                    }, ALGORITHMS[0])
+            except Exception:
+                if not self._keys:
+                    raise
+                return
+            self._keys = keys
+            self._fetched_at = now
+
+    def warm_up(self):
+        # fetches the keys ahead of the first request, unless fresh ones
+        # are already held (inherited from a preloading master)
+        if self._is_stale():
+            self.refresh(force=True)
+
+    def refresh_in_background(self):
+        # not self._lock, which refresh() holds for the whole fetch
+        with self._thread_lock:
+            if self._refresh_thread is not None and \
+                    self._refresh_thread.is_alive():
+                return self._refresh_thread
+            self._refresh_thread = threading.Thread(
+                target=self.refresh, name='jwks-refresh', daemon=True)
+            self._refresh_thread.start()
+            return self._refresh_thread
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def _is_stale(self, now=None):
+        if self._fetched_at is None:
+            return True
+        if now is None:
+            now = self.clock()
+        return now - self._fetched_at >= self.ttl
+
+    def _may_refresh(self, now=None):
+        if self._last_attempt is None:
+            return True
+        if now is None:
+            now = self.clock()
+        return now - self._last_attempt >= self.min_refresh_interval
+
+
+jwks_cache = JWKSCache(
+    jwks_from_file(JWKS_FILE) if JWKS_FILE else jwks_from_url())
+
+def set_jwks_provider(provider):
+    jwks_cache.provider = provider
+    jwks_cache.clear()
+
+# Verified Token Cache
+
+TOKEN_CACHE_LOOKUPS = Counter(
+    'capstone_token_cache_lookups_total',
+    'Verified token cache lookups by result',
+    ['result'])
+
+class TokenCache:
+    '''
+    LRU of payloads whose signature has already been verified, keyed by a
+    SHA-256 digest of the raw token so tokens are never held in memory.
+    Entries are only served until the token's own exp.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def lookup(self, token):
+        '''
+        (payload, granted permission mask) of a cached token, or None.
+        '''
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                TOKEN_CACHE_LOOKUPS.labels('hit').inc()
+                return entry[0], entry[2]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            TOKEN_CACHE_LOOKUPS.labels('miss').inc()
+            return None
+
+    def get(self, token):
+        entry = self.lookup(token)
+        return entry[0] if entry is not None else None
+
+    def put(self, token, payload, granted=0):
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (payload, exp, granted)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+
+token_cache = TokenCache()
+
+def granted_permissions(payload):
+    if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_calaims',
             'description': 'permissions not included in JWT'
         }, 400)
-    elif permission not in permissions:
+    return permission_registry.mask(payload['permissions'])
+
+def check_granted(granted, required):
+    if granted & required != required:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'permission not encluded'
         }, 401)
     return True
 
+def check_permissions(permission, payload):
+    return check_granted(
+        granted_permissions(payload), permission_registry.bit(permission))
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH_DOMAIN}/.wll-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
-            'code': 'Authorization malformed'
+            'description': 'Authorization malformed'
             }, 401)
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
+                audience=API_AUDIENCE,
                 issuer='https://'+ AUTH0_DOMAIN + '/'
             )
             return payload
@@ -106,19 +328,35 @@ def verify_decode_jwt(token):
         }, 400)
         
 def requires_auth(permission=''):
+    # the permission's bit is fixed when the route is defined, and a
+    # token's permissions are compiled to a mask once and cached with it.
+    # Without a permission any valid token is accepted.
+    required = permission_registry.bit(permission) if permission else 0
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except BaseException:
-                raise AuthError({
-                    'code': 'Invalid Token',
-                    'description': 'Token is invalid'
-                },401)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                token = get_token_auth_header()
+                entry = token_cache.lookup(token)
+                if entry is None:
+                    try:
+                        payload = verify_decode_jwt(token)
+                    except BaseException:
+                        raise AuthError({
+                            'code': 'Invalid Token',
+                            'description': 'Token is invalid'
+                        },401)
+                    granted = granted_permissions(payload)
+                    token_cache.put(token, payload, granted)
+                else:
+                    payload, granted = entry
+                check_granted(granted, required)
+            _request_ctx_stack.top.current_user = payload
+            _request_ctx_stack.top.granted_permissions = granted
+            rate_limiter.limit(permission)
             return f(payload, *args, **kwargs)
+        wrapper.required_permission = permission
         return wrapper
     return requires_auth_decorator
     
@@ -0,0 +1,610 @@
+'''
+Load and micro-benchmarks for the API.
+
+Boots create_app() against a freshly seeded database, signs tokens with a
+locally generated RSA key served as the JWKS, and measures every route
+under concurrency, plus verify_decode_jwt, format() and serialization on
+their own. Results are written as JSON and can be compared against a
+stored baseline:
+
+    python benchmark.py --rows 10000 --output results.json
+    python benchmark.py --rows 10000 --baseline results.json
+
+The exit status is 1 when a route answers with an error status or a
+comparison finds a regression.
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+BENCHMARK_KID = 'benchmark-key'
+BENCHMARK_PERMISSIONS = [
+    'get:actors', 'get:movies', 'post:actors', 'post:movies',
+    'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies',
+    'get:changes', 'get:diagnostics'
+]
+SEED_CHUNK_SIZE = 10000
+CAST_PER_MOVIE = 3
+# endless streams: only the first chunk is read before hanging up
+STREAMING_SCENARIOS = {'events'}
+
+
+# Statistics
+
+def percentile(sorted_values, fraction):
+    '''
+    Nearest-rank percentile of an already sorted list.
+    '''
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, statuses, elapsed):
+    latencies = sorted(latencies)
+    # every scenario expects a 2xx; anything else times an error path
+    errors = sum(count for status, count in statuses.items()
+                 if not 200 <= int(status) < 300)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': statuses,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, .50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, .95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, .99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3)
+    }
+
+
+# Comparison: for each metric, which direction is worse
+
+ROUTE_METRICS = {'p50_ms': 1, 'p95_ms': 1, 'p99_ms': 1, 'throughput_rps': -1}
+MICRO_METRICS = {'mean_us': 1}
+
+
+def compare_metric(current, baseline, worse_direction, tolerance):
+    if current is None or not baseline:
+        return None
+    change = (current - baseline) / baseline
+    return {
+        'baseline': baseline,
+        'current': current,
+        'change': round(change, 4),
+        'regression': change * worse_direction > tolerance
+    }
+
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    Relative change of every metric present in both runs. A metric that is
+    worse by more than tolerance (0.1 is 10%) counts as a regression.
+    '''
+    comparison = {}
+    for section, metrics in (('routes', ROUTE_METRICS),
+                             ('micro', MICRO_METRICS)):
+        for name, current in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if previous is None:
+                continue
+            for metric, direction in metrics.items():
+                change = compare_metric(
+                    current.get(metric), previous.get(metric),
+                    direction, tolerance)
+                if change is not None:
+                    comparison[f'{section}.{name}.{metric}'] = change
+    return comparison
+
+
+# Local signing key, served in place of the Auth0 JWKS
+
+def make_signing_key(bits=2048):
+    import rsa
+    from jose import jwk
+    public_key, private_key = rsa.newkeys(bits)
+    public_jwk = jwk.construct(
+        public_key.save_pkcs1().decode(), 'RS256').to_dict()
+    public_jwk.update({'kid': BENCHMARK_KID, 'use': 'sig'})
+    return private_key.save_pkcs1().decode(), public_jwk
+
+
+def load_signing_key(path=None):
+    if path and os.path.exists(path):
+        with open(path) as key_file:
+            stored = json.load(key_file)
+        return stored['private_key'], stored['jwk']
+    private_key, public_jwk = make_signing_key()
+    if path:
+        with open(path, 'w') as key_file:
+            json.dump({'private_key': private_key, 'jwk': public_jwk}, key_file)
+    return private_key, public_jwk
+
+
+def sign_token(private_key, permissions=BENCHMARK_PERMISSIONS,
+               sub='benchmark|user'):
+    import auth
+    from jose import jwt
+    return jwt.encode({
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+        'aud': auth.API_AUDIENCE,
+        'sub': sub,
+        'exp': int(time.time()) + 24 * 3600,
+        'permissions': permissions
+    }, private_key, algorithm='RS256', headers={'kid': BENCHMARK_KID})
+
+
+# Seed data
+
+def seed(app, rows, rng):
+    '''
+    Recreates the tables with rows actors and rows movies, each movie cast
+    with CAST_PER_MOVIE actors, inserted in chunks of SEED_CHUNK_SIZE.
+    '''
+    from models import db, casting, Actor, Movie, TableVersion
+
+    genders = ['Female', 'Male']
+    first_release = datetime(1970, 1, 1)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for start in range(1, rows + 1, SEED_CHUNK_SIZE):
+            ids = range(start, min(start + SEED_CHUNK_SIZE, rows + 1))
+            db.session.execute(Actor.__table__.insert(), [{
+                'id': row_id,
+                'name': f'Actor {rng.randrange(rows * 10):07d}',
+                'age': rng.randint(18, 90),
+                'gender': rng.choice(genders)
+            } for row_id in ids])
+            db.session.execute(Movie.__table__.insert(), [{
+                'id': row_id,
+                'title': f'Movie {rng.randrange(rows * 10):07d}',
+                'release_date': first_release + timedelta(
+                    days=rng.randrange(20000))
+            } for row_id in ids])
+            db.session.execute(casting.insert(), [{
+                'movie_id': row_id,
+                'actor_id': actor_id
+            } for row_id in ids
+              for actor_id in rng.sample(range(1, rows + 1),
+                                         min(CAST_PER_MOVIE, rows))])
+            db.session.commit()
+        for model in (Actor, Movie):
+            TableVersion.bump(model.__tablename__)
+            if db.engine.dialect.name == 'postgresql':
+                # explicit ids leave the serial sequences behind
+                db.session.execute(
+                    f"SELECT setval(pg_get_serial_sequence("
+                    f"'{model.__tablename__}', 'id'), {rows})")
+        db.session.commit()
+        db.engine.dispose()
+
+
+# Routes. Each scenario builds its request from a random generator; ids
+# for destructive scenarios come from a shared counter so no id is
+# deleted twice.
+
+class IdCounter:
+    def __init__(self, start):
+        self.next_id = start
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            self.next_id -= 1
+            return self.next_id + 1
+
+
+class CastPairs:
+    '''
+    Movie and actor pairs cast by cast_actor, handed back one at a time
+    to uncast_actor, which runs after it. None once all are taken.
+    '''
+
+    def __init__(self):
+        self.pairs = {}
+        self._lock = threading.Lock()
+
+    def cast(self, movie_id, actor_id):
+        with self._lock:
+            self.pairs[(movie_id, actor_id)] = True
+        return movie_id, actor_id
+
+    def take(self):
+        with self._lock:
+            pair = next(iter(self.pairs), None)
+            self.pairs.pop(pair, None)
+            return pair
+
+
+def scenarios(rows):
+    from pagination import encode_cursor
+
+    def any_id(rng):
+        return rng.randint(1, rows)
+
+    def any_cursor(rng):
+        # an empty page is a 404, so never start after the last row
+        return encode_cursor(rng.randint(0, rows - 1))
+
+    def uncached_page(collection):
+        return lambda rng: \
+            f'/{collection}?limit=100&after={any_cursor(rng)}'
+
+    new_actor = lambda rng: {
+        'name': f'Bench {rng.random()}', 'age': 30, 'gender': 'Female'}
+    new_movie = lambda rng: {
+        'title': f'Bench {rng.random()}',
+        'release_date': '2024-01-01T00:00:00'}
+    export_job = lambda rng: {
+        'kind': 'export', 'resource': 'actors', 'format': 'ndjson',
+        'query': {'age_min': str(rng.randint(18, 90)), 'age_max': '90'}}
+
+    # deletes count down from the top of the id range
+    deleted_actors = IdCounter(rows)
+    deleted_movies = IdCounter(rows)
+    bulk_deleted = IdCounter(rows // 2)
+    cast_pairs = CastPairs()
+
+    return [
+        ('greeting', 'GET', lambda rng: '/', None),
+        ('actors_page', 'GET', lambda rng: '/actors?limit=100', None),
+        ('movies_page', 'GET', lambda rng: '/movies?limit=100', None),
+        ('actors_page_uncached', 'GET', uncached_page('actors'), None),
+        ('movies_page_uncached', 'GET', uncached_page('movies'), None),
+        # seeded names are 'Actor' and seven digits below rows * 10; a
+        # four digit prefix matches about a hundred of them
+        ('actors_filtered', 'GET', lambda rng:
+            f'/actors?name_prefix=actor%20'
+            f'{rng.randrange(rows * 10) // 1000:04d}'
+            f'&sort=name&limit=50', None),
+        ('movies_filtered', 'GET', lambda rng:
+            f'/movies?release_date_from={1970 + rng.randrange(50)}-01-01'
+            f'&sort=release_date&limit=50', None),
+        ('movies_include_actors', 'GET', lambda rng:
+            f'/movies?include=actors&limit=50'
+            f'&after={any_cursor(rng)}', None),
+        ('actors_export', 'GET', lambda rng:
+            f'/actors?export=ndjson&age_min={rng.randint(18, 90)}'
+            f'&age_max=90', None),
+        ('actor', 'GET', lambda rng: f'/actors/{any_id(rng)}', None),
+        ('movie', 'GET', lambda rng: f'/movies/{any_id(rng)}', None),
+        ('movie_actors', 'GET', lambda rng:
+            f'/movies/{any_id(rng)}/actors', None),
+        ('actor_movies', 'GET', lambda rng:
+            f'/actors/{any_id(rng)}/movies', None),
+        ('create_actor', 'POST', lambda rng: '/actors', new_actor),
+        ('create_movie', 'POST', lambda rng: '/movies', new_movie),
+        ('update_actor', 'PATCH', lambda rng: f'/actors/{any_id(rng)}',
+            lambda rng: {'age': rng.randint(18, 90)}),
+        ('update_movie', 'PATCH', lambda rng: f'/movies/{any_id(rng)}',
+            lambda rng: {'title': f'Movie {rng.random()}'}),
+        ('cast_actor', 'PUT', lambda rng:
+            '/movies/{}/actors/{}'.format(
+                *cast_pairs.cast(any_id(rng), any_id(rng))), None),
+        ('uncast_actor', 'DELETE', lambda rng:
+            '/movies/{}/actors/{}'.format(
+                *(cast_pairs.take() or (any_id(rng), any_id(rng)))), None),
+        ('bulk_create_actors', 'POST', lambda rng: '/actors/bulk',
+            lambda rng: [new_actor(rng) for _ in range(100)]),
+        ('bulk_update_movies', 'PATCH', lambda rng: '/movies/bulk',
+            lambda rng: [{'id': any_id(rng), 'title': f'Movie {rng.random()}'}
+                         for _ in range(100)]),
+        ('bulk_delete_actors', 'DELETE', lambda rng: '/actors/bulk',
+            lambda rng: [bulk_deleted.take() for _ in range(10)]),
+        ('delete_actor', 'DELETE', lambda rng:
+            f'/actors/{deleted_actors.take()}', None),
+        ('delete_movie', 'DELETE', lambda rng:
+            f'/movies/{deleted_movies.take()}', None),
+        ('changes', 'GET', lambda rng: '/changes?since=0&limit=100', None),
+        ('changes_head', 'GET', lambda rng: '/changes', None),
+        # time to the first chunk of the stream, then the client leaves
+        ('events', 'GET', lambda rng: '/events?since=0', None),
+        ('queue_export_job', 'POST', lambda rng: '/jobs', export_job),
+        ('slow_queries', 'GET', lambda rng: '/admin/slow-queries', None),
+        ('permissions', 'GET', lambda rng: '/admin/permissions', None),
+        ('metrics', 'GET', lambda rng: '/metrics', None)
+    ]
+
+
+# Clients: the app in process through the test client, or a running
+# server over HTTP
+
+class InProcessClient:
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, headers, body, stream=False):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, headers=headers, json=body,
+                               buffered=not stream)
+        if stream:
+            next(response.iter_encoded(), None)
+            response.close()
+        else:
+            # read streamed bodies through, so exports are timed in full
+            response.get_data()
+        return response.status_code
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, path, headers, body, stream=False):
+        data = None
+        headers = dict(headers)
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = Request(
+            self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with urlopen(request) as response:
+                if stream:
+                    response.readline()
+                else:
+                    response.read()
+                return response.status
+        except HTTPError as error:
+            error.read()
+            return error.code
+
+
+def run_scenario(client, headers, scenario, requests, concurrency, warmup,
+                 seed_value):
+    name, method, path, body = scenario
+    stream = name in STREAMING_SCENARIOS
+    rng = random.Random(f'{seed_value}-{name}')
+    rng_lock = threading.Lock()
+
+    def build():
+        with rng_lock:
+            return path(rng), body(rng) if body else None
+
+    for _ in range(warmup):
+        request_path, request_body = build()
+        client.request(method, request_path, headers, request_body, stream)
+
+    latencies = []
+    statuses = {}
+    results_lock = threading.Lock()
+
+    def worker(count):
+        for _ in range(count):
+            request_path, request_body = build()
+            start = time.perf_counter()
+            status = client.request(
+                method, request_path, headers, request_body, stream)
+            elapsed = time.perf_counter() - start
+            with results_lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    shares = [requests // concurrency + (index < requests % concurrency)
+              for index in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, [share for share in shares if share]))
+    return summarize(latencies, statuses, time.perf_counter() - start)
+
+
+# Micro-benchmarks
+
+def time_call(function, number):
+    '''
+    Best of three timings of number calls, as mean microseconds per call
+    and calls per second.
+    '''
+    best = min(timeit.Timer(function).repeat(repeat=3, number=number))
+    return {
+        'iterations': number,
+        'mean_us': round(best / number * 1e6, 3),
+        'ops_per_sec': round(number / best, 1)
+    }
+
+
+def micro_benchmarks(app, token, number):
+    import auth
+    import serializers
+    from models import db, Actor, Movie
+    from pagination import keyset_page
+
+    results = {}
+    auth.token_cache.clear()
+    auth.verify_decode_jwt(token)
+    results['verify_decode_jwt'] = time_call(
+        lambda: auth.verify_decode_jwt(token), number)
+    auth.token_cache.put(token, auth.verify_decode_jwt(token))
+    results['token_cache_hit'] = time_call(
+        lambda: auth.token_cache.get(token), number * 10)
+
+    with app.app_context():
+        actors = Actor.query.order_by(Actor.id).limit(100).all()
+        movies = Movie.query.order_by(Movie.id).limit(100).all()
+        results['actor_format_x100'] = time_call(
+            lambda: [actor.format() for actor in actors], number)
+        results['movie_format_x100'] = time_call(
+            lambda: [movie.format() for movie in movies], number)
+        actor_page, _ = keyset_page(Actor, 100)
+        movie_page, _ = keyset_page(Movie, 100)
+        db.session.remove()
+
+    payloads = {
+        'actors': {'success': True, 'actors': actor_page, 'next_cursor': None},
+        'movies': {'success': True, 'movies': movie_page, 'next_cursor': None}
+    }
+    encoders = {'stdlib': serializers.StdlibSerializer()}
+    if serializers.orjson is not None:
+        encoders['orjson'] = serializers.OrjsonSerializer()
+    with app.app_context():
+        for collection, payload in payloads.items():
+            for encoder_name, encoder in encoders.items():
+                results[f'serialize_{collection}_x100_{encoder_name}'] = \
+                    time_call(lambda: encoder.dumps(payload), number)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every route and the hot helpers.')
+    parser.add_argument('--database-url', help=(
+        'database to seed and serve; defaults to a SQLite file in a '
+        'temporary directory. The tables are dropped and recreated'))
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='actors and movies to seed, each (default 1000)')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the data of a previous run')
+    parser.add_argument('--url', help=(
+        'benchmark a running server instead of the app in process. It '
+        'must serve the same database with JWKS_FILE set to --jwks-file'))
+    parser.add_argument('--key-file', help=(
+        'signing key to reuse across runs, created on first use'))
+    parser.add_argument('--jwks-file', help=(
+        'where to write the public JWKS for a server started with --url'))
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route (default 200)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='concurrent clients (default 8)')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='unmeasured requests per route (default 5)')
+    parser.add_argument('--routes', help=(
+        'comma separated scenario names to run (default all)'))
+    parser.add_argument('--micro-iterations', type=int, default=2000,
+                        help='calls per micro-benchmark (default 2000)')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the results here as JSON')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help=(
+        'relative change counted as a regression (default 0.1)'))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(prefix='capstone-benchmark-'), 'benchmark.db'))
+    # slow-query logging would dominate the timings it measures
+    os.environ.setdefault('SLOW_QUERY_MS', '0')
+    # every benchmark request comes from one client
+    os.environ.setdefault('RATE_LIMIT', 'false')
+    os.environ.setdefault('JOB_MAX_QUEUED_PER_CLIENT', '1000000')
+
+    # the settings above are module constants, read when the app's
+    # modules are first imported, so the app is imported only now
+    import auth
+    from app import create_app
+
+    private_key, public_jwk = load_signing_key(args.key_file)
+    jwks = {'keys': [public_jwk]}
+    auth.set_jwks_provider(lambda: jwks)
+    if args.jwks_file:
+        with open(args.jwks_file, 'w') as jwks_file:
+            json.dump(jwks, jwks_file)
+    token = sign_token(private_key)
+    headers = {'Authorization': 'Bearer ' + token}
+
+    app = create_app()
+    if not args.no_seed:
+        started = time.perf_counter()
+        seed(app, args.rows, random.Random(args.seed))
+        print(f'seeded {args.rows} actors and movies in '
+              f'{time.perf_counter() - started:.1f}s', file=sys.stderr)
+
+    client = HTTPClient(args.url) if args.url else InProcessClient(app)
+    selected = set(args.routes.split(',')) if args.routes else None
+
+    results = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': os.environ['DATABASE_URL'].split(':', 1)[0],
+            'target': args.url or 'in-process',
+            'rows': args.rows,
+            'requests': args.requests,
+            'concurrency': args.concurrency
+        },
+        'routes': {},
+        'micro': {}
+    }
+
+    for scenario in scenarios(args.rows):
+        if selected is not None and scenario[0] not in selected:
+            continue
+        results['routes'][scenario[0]] = route = run_scenario(
+            client, headers, scenario, args.requests, args.concurrency,
+            args.warmup, args.seed)
+        print(f'{scenario[0]:<24} {route["throughput_rps"]:>9} req/s  '
+              f'p50 {route["p50_ms"]:>8} ms  p95 {route["p95_ms"]:>8} ms  '
+              f'p99 {route["p99_ms"]:>8} ms  errors {route["errors"]}',
+              file=sys.stderr)
+
+    if not args.skip_micro:
+        results['micro'] = micro_benchmarks(app, token, args.micro_iterations)
+        for name, micro in results['micro'].items():
+            print(f'{name:<32} {micro["mean_us"]:>10} us/call',
+                  file=sys.stderr)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            results['comparison'] = compare(
+                results, json.load(baseline_file), args.tolerance)
+        regressions = [name for name, change in results['comparison'].items()
+                       if change['regression']]
+        for name in regressions:
+            change = results['comparison'][name]
+            print(f'regression: {name} {change["baseline"]} -> '
+                  f'{change["current"]} ({change["change"]:+.1%})',
+                  file=sys.stderr)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    failed = [name for name, route in results['routes'].items()
+              if route['errors']]
+    for name in failed:
+        print(f'errors: {name} {results["routes"][name]["statuses"]}',
+              file=sys.stderr)
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
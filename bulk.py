@@ -0,0 +1,165 @@
+import os
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, delete_castings, record_change
+
+
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 500))
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def failure(error):
+    return {'success': False, 'error': error}
+
+
+def existing_ids(model, ids):
+    return {
+        row[0] for row in
+        db.session.query(model.id).filter(model.id.in_(ids))
+    }
+
+
+# Item preparation, raising ValueError for items that cannot be written
+
+def clean_id(item):
+    item_id = item.get('id') if isinstance(item, dict) else item
+    if isinstance(item_id, bool) or not isinstance(item_id, int):
+        raise ValueError('id must be an integer')
+    return item_id
+
+
+def prepare_create(model):
+    def prepare(item):
+        if not isinstance(item, dict):
+            raise ValueError('item must be an object')
+        return model.validate(item)
+    return prepare
+
+
+def prepare_update(model):
+    def prepare(item):
+        if not isinstance(item, dict):
+            raise ValueError('item must be an object')
+        values = model.validate(item, partial=True)
+        values['id'] = clean_id(item)
+        return values
+    return prepare
+
+
+def prepare_delete(model):
+    return clean_id
+
+
+# Chunk writers, returning one result per item in the chunk
+
+def inserted_ids(model, mappings):
+    '''
+    Inserts the rows in one statement and returns their new ids, in order.
+    bulk_insert_mappings with return_defaults=True would issue one INSERT
+    per row to learn the keys.
+    '''
+    table = model.__table__
+    if db.engine.dialect.name == 'postgresql':
+        # a multi-row VALUES draws its ids from the sequence row by row
+        rows = db.session.execute(
+            insert(table).values(mappings).returning(table.c.id))
+        return sorted(row[0] for row in rows)
+    # elsewhere executemany, then the newest ids: the insert holds the
+    # database's write lock until commit, so they are all ours
+    db.session.execute(insert(table), mappings)
+    rows = db.session.query(model.id) \
+        .order_by(model.id.desc()).limit(len(mappings))
+    return sorted(row[0] for row in rows)
+
+
+def write_create(model):
+    def write(mappings):
+        ids = inserted_ids(model, mappings)
+        record_change(model, ids, 'create')
+        return [{'success': True, 'id': row_id} for row_id in ids]
+    return write
+
+
+def write_update(model):
+    def write(mappings):
+        found = existing_ids(model, [values['id'] for values in mappings])
+        db.session.bulk_update_mappings(
+            model, [values for values in mappings if values['id'] in found])
+        if found:
+            record_change(model, sorted(found))
+        return [
+            {'success': True, 'id': values['id']}
+            if values['id'] in found else failure('resource not found')
+            for values in mappings
+        ]
+    return write
+
+
+def write_delete(model):
+    def write(ids):
+        found = existing_ids(model, ids)
+        if found:
+            delete_castings(model, found)
+        db.session.query(model).filter(model.id.in_(found)) \
+            .delete(synchronize_session=False)
+        if found:
+            record_change(model, sorted(found), 'delete')
+        return [
+            {'success': True, 'id': item_id}
+            if item_id in found else failure('resource not found')
+            for item_id in ids
+        ]
+    return write
+
+
+def run_bulk(items, prepare, write, chunk_size=BULK_CHUNK_SIZE, atomic=False):
+    '''
+    Validates every item, then writes the valid ones chunk_size at a time,
+    one transaction per chunk. A chunk that fails in the database is rolled
+    back and reported item by item; the other chunks still commit. With
+    atomic=True any failure rejects the whole batch and nothing is written.
+
+    Returns a result per item, in request order, and whether anything was
+    rejected.
+    '''
+    results = [None] * len(items)
+    pending = []
+    for index, item in enumerate(items):
+        try:
+            pending.append((index, prepare(item)))
+        except ValueError as error:
+            results[index] = failure(str(error))
+
+    if atomic:
+        chunk_size = len(pending)
+        if len(pending) < len(items):
+            pending = []
+
+    for chunk in chunked(pending, max(chunk_size, 1)):
+        try:
+            outcomes = write([values for _, values in chunk])
+            if atomic and not all(outcome['success'] for outcome in outcomes):
+                db.session.rollback()
+                for (index, _), outcome in zip(chunk, outcomes):
+                    if not outcome['success']:
+                        results[index] = outcome
+                break
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            outcomes = [failure('unprocessable')] * len(chunk)
+        for (index, _), outcome in zip(chunk, outcomes):
+            results[index] = outcome
+
+    rejected = False
+    for index, result in enumerate(results):
+        if result is None:
+            result = failure('not applied, batch rejected')
+        results[index] = dict(result, index=index)
+        rejected = rejected or not result['success']
+    return results, rejected
@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_URL = os.environ.get('CACHE_URL', 'redis://localhost:6379/0')
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 32 * 1024 * 1024))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX', 'capstone:')
+
+
+# Backends store bytes under string keys. They must never raise on the
+# request path: an unreachable cache behaves like an empty one.
+
+class NullBackend:
+    shared = False
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete_many(self, keys):
+        pass
+
+
+class MemoryBackend:
+    '''
+    Per-worker LRU bounded by the total size of the stored values.
+    '''
+
+    shared = False
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (self.clock() + ttl, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class RedisBackend:
+    '''
+    Shared cache on any client speaking the redis-py API, so every worker
+    and dyno sees the same entries (fakeredis works as a local stand-in).
+    '''
+
+    shared = True
+
+    def __init__(self, client, prefix=CACHE_KEY_PREFIX):
+        self.client = client
+        self.prefix = prefix
+        self.errors = 0
+
+    def get(self, key):
+        try:
+            return self.client.get(self.prefix + key)
+        except Exception:
+            self.errors += 1
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            self.client.set(self.prefix + key, value, ex=ttl)
+        except Exception:
+            self.errors += 1
+
+    def delete_many(self, keys):
+        if not keys:
+            return
+        try:
+            self.client.delete(*[self.prefix + key for key in keys])
+        except Exception:
+            self.errors += 1
+
+
+def create_backend(name=CACHE_BACKEND, url=CACHE_URL):
+    if name == 'redis':
+        # optional dependency, only needed when the shared cache is used
+        import redis
+        return RedisBackend(redis.Redis.from_url(url))
+    if name == 'none':
+        return NullBackend()
+    return MemoryBackend()
+
+
+class ResourceCache:
+    def __init__(self, backend, ttl=CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, self.ttl if ttl is None else ttl)
+
+    def delete_many(self, keys):
+        self.backend.delete_many(list(keys))
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+resource_cache = ResourceCache(create_backend())
+
+def set_cache_backend(backend):
+    resource_cache.backend = backend
+
+
+def resource_key(table_name, row_id):
+    return f'{table_name}:{row_id}'
+
+
+def list_key(table_name, etag):
+    return f'{table_name}:list:{etag}'
@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+from flask import abort
+from sqlalchemy import event, func
+from sqlalchemy.orm import aliased
+from models import db, Actor, Change, Movie, TableVersion
+from permissions import permission_registry
+from routing import RoutingSession
+
+
+CHANGES_PAGE_SIZE = int(os.environ.get('CHANGES_PAGE_SIZE', 100))
+CHANGES_MAX_PAGE_SIZE = int(os.environ.get('CHANGES_MAX_PAGE_SIZE', 1000))
+# longest ?wait= a client may ask for, in seconds
+CHANGES_MAX_WAIT = float(os.environ.get('CHANGES_MAX_WAIT', 30))
+# how often a waiting request looks for changes committed by other workers
+CHANGES_POLL_SECONDS = float(os.environ.get('CHANGES_POLL_SECONDS', 1))
+CHANGE_LOG_RETENTION_DAYS = float(
+    os.environ.get('CHANGE_LOG_RETENTION_DAYS', 7))
+
+# the models a change feed reader may see, with the permission to read them
+FEED_MODELS = {
+    Actor.__tablename__: (Actor, 'get:actors'),
+    Movie.__tablename__: (Movie, 'get:movies')
+}
+
+
+class ChangeNotifier:
+    '''
+    Wakes requests long-polling /changes when this worker commits a change.
+    Changes committed by other workers are found by polling.
+    '''
+
+    def __init__(self):
+        self.last_seq = 0
+        self._condition = threading.Condition()
+
+    def notify(self, seq):
+        with self._condition:
+            self.last_seq = max(self.last_seq, seq)
+            self._condition.notify_all()
+
+    def wait(self, since, timeout):
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.last_seq > since, timeout)
+
+
+notifier = ChangeNotifier()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def notify_change_readers(session):
+    seq = session.info.pop('change_log_seq', None)
+    if seq is not None:
+        notifier.notify(seq)
+
+
+def parse_changes_args(args):
+    '''
+    (since, limit, wait) from the query string, aborting with 400 on
+    values that are not numbers or out of range. since is None when the
+    client asks where the log ends.
+    '''
+    try:
+        since = int(args['since']) if 'since' in args else None
+        limit = int(args.get('limit', CHANGES_PAGE_SIZE))
+        wait = float(args.get('wait', 0))
+    except ValueError:
+        abort(400)
+    if (since is not None and since < 0) or limit < 1 or wait < 0:
+        abort(400)
+    return since, min(limit, CHANGES_MAX_PAGE_SIZE), min(wait, CHANGES_MAX_WAIT)
+
+
+def readable_tables(granted):
+    return [
+        table_name for table_name, (_, permission) in FEED_MODELS.items()
+        if granted & permission_registry.bit(permission)
+    ]
+
+
+def last_seq():
+    return TableVersion.current(Change.SEQUENCE)[0]
+
+
+def purged_seq():
+    return TableVersion.current(Change.PURGED)[0]
+
+
+def read_changes(since, limit, table_names):
+    '''
+    Up to limit changes after since, oldest first, each with the row as
+    it is now. Deleted rows, and rows deleted since the change, have no
+    data. Rows are loaded with one query per table.
+    '''
+    entries = db.session.query(
+        Change.seq, Change.table_name, Change.row_id, Change.op,
+        Change.changed_at) \
+        .filter(Change.seq > since, Change.table_name.in_(table_names)) \
+        .order_by(Change.seq).limit(limit).all()
+
+    ids = {}
+    for entry in entries:
+        if entry.op != 'delete':
+            ids.setdefault(entry.table_name, set()).add(entry.row_id)
+    rows = {}
+    for table_name, row_ids in ids.items():
+        model = FEED_MODELS[table_name][0]
+        columns = [getattr(model, name) for name in model.response_keys]
+        keys = list(model.response_keys.values())
+        for row in db.session.query(*columns).filter(model.id.in_(row_ids)):
+            rows[table_name, row[0]] = dict(zip(keys, row))
+
+    return [{
+        'seq': entry.seq,
+        'table': entry.table_name,
+        'id': entry.row_id,
+        'op': entry.op,
+        'changed_at': entry.changed_at,
+        'data': rows.get((entry.table_name, entry.row_id))
+    } for entry in entries]
+
+
+def wait_for_changes(since, table_names, wait, clock=time.monotonic):
+    '''
+    Whether there are changes after since, waiting up to wait seconds for
+    one to be committed. The session is closed while waiting, so a long
+    poll does not hold a pooled connection.
+    '''
+    deadline = clock() + wait
+    while True:
+        # read before the query, so a commit made while it runs still
+        # wakes us, while seqs already seen (in tables the reader cannot
+        # see, or not yet on the replica) do not wake us again
+        seen = max(since, notifier.last_seq)
+        found = db.session.query(Change.seq) \
+            .filter(Change.seq > since, Change.table_name.in_(table_names)) \
+            .first() is not None
+        remaining = deadline - clock()
+        if found or remaining <= 0:
+            return found
+        db.session.close()
+        notifier.wait(seen, min(remaining, CHANGES_POLL_SECONDS))
+
+
+# Retention job, run by `flask compact-changes`
+
+def compact_change_log():
+    '''
+    Deletes every entry superseded by a later entry for the same row.
+    A reader at any position still ends with each row's latest change, so
+    compaction is invisible to clients.
+    '''
+    later = aliased(Change)
+    superseded = db.session.query(later.seq).filter(
+        later.table_name == Change.table_name,
+        later.row_id == Change.row_id,
+        later.seq > Change.seq).exists()
+    deleted = db.session.query(Change).filter(superseded) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def purge_change_log(retention_days=CHANGE_LOG_RETENTION_DAYS, now=None):
+    '''
+    Deletes entries older than retention_days and remembers the highest
+    seq removed: readers behind it have missed changes and get 410.
+    '''
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    highest = db.session.query(func.max(Change.seq)) \
+        .filter(Change.changed_at < cutoff).scalar()
+    if highest is None:
+        return 0
+    deleted = db.session.query(Change).filter(Change.seq <= highest) \
+        .delete(synchronize_session=False)
+    TableVersion.bump(Change.PURGED, highest - purged_seq())
+    db.session.commit()
+    return deleted
+
+
+def init_change_log(app):
+    @app.cli.command('compact-changes')
+    @click.option('--retention-days', type=float,
+                  default=CHANGE_LOG_RETENTION_DAYS, show_default=True,
+                  help='Delete entries older than this.')
+    def compact_changes_command(retention_days):
+        '''Compact the change log and apply its retention.'''
+        compacted = compact_change_log()
+        purged = purge_change_log(retention_days)
+        click.echo(f'compacted {compacted} entries, purged {purged}')
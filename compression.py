@@ -0,0 +1,186 @@
+import hashlib
+import os
+import zlib
+from flask import request
+from cache import resource_cache
+from dbpool import env_flag
+
+# optional encoders, offered to clients only when installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION = env_flag('COMPRESSION', True)
+# bodies smaller than this go out as they are
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+COMPRESS_ZSTD_LEVEL = int(os.environ.get('COMPRESS_ZSTD_LEVEL', 3))
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/x-ndjson',
+    'text/plain',
+    'text/html'
+}
+
+
+# Encoders: compress(body) for whole bodies, stream(chunks) for streamed
+# responses, which are compressed as they are produced
+
+class Gzip:
+    name = 'gzip'
+
+    def __init__(self, level=COMPRESS_GZIP_LEVEL):
+        self.level = level
+
+    def compressor(self):
+        # wbits 31 writes the gzip header and trailer
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def compress(self, body):
+        compressor = self.compressor()
+        return compressor.compress(body) + compressor.flush()
+
+    def stream(self, chunks):
+        compressor = self.compressor()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class Brotli:
+    name = 'br'
+
+    def __init__(self, quality=COMPRESS_BROTLI_QUALITY):
+        self.quality = quality
+
+    def compress(self, body):
+        return brotli.compress(body, quality=self.quality)
+
+    def stream(self, chunks):
+        compressor = brotli.Compressor(quality=self.quality)
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+
+
+class Zstd:
+    name = 'zstd'
+
+    def __init__(self, level=COMPRESS_ZSTD_LEVEL):
+        self.level = level
+
+    def compress(self, body):
+        return zstandard.ZstdCompressor(level=self.level).compress(body)
+
+    def stream(self, chunks):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+def available_encoders():
+    # in order of preference when a client accepts several equally
+    encoders = []
+    if brotli is not None:
+        encoders.append(Brotli())
+    if zstandard is not None:
+        encoders.append(Zstd())
+    encoders.append(Gzip())
+    return encoders
+
+
+class Compressor:
+    '''
+    Compresses responses with the best encoding the client accepts. Bodies
+    of GET responses are looked up in resource_cache by encoding and
+    content digest first, so a cached list or lookup is compressed once
+    per encoding, not on every hit, and a variant can never outlive the
+    body it was made from.
+    '''
+
+    def __init__(self, encoders=None, min_bytes=COMPRESS_MIN_BYTES,
+                 cache=resource_cache):
+        self.encoders = available_encoders() if encoders is None else encoders
+        self.min_bytes = min_bytes
+        self.cache = cache
+
+    def init_app(self, app):
+        self.min_bytes = int(
+            app.config.get('COMPRESS_MIN_BYTES', COMPRESS_MIN_BYTES))
+        if not app.config.get('COMPRESSION', COMPRESSION):
+            return
+
+        @app.after_request
+        def compress_response(response):
+            return self.compress_response(response)
+
+    def negotiate(self, accept_encodings):
+        '''
+        The encoder with the highest quality in Accept-Encoding, ours
+        deciding ties, or None for identity.
+        '''
+        best, best_quality = None, 0
+        for encoder in self.encoders:
+            quality = accept_encodings[encoder.name]
+            if quality > best_quality:
+                best, best_quality = encoder, quality
+        return best
+
+    def compress_response(self, response):
+        if response.status_code == 304:
+            response.vary.add('Accept-Encoding')
+            return response
+        if response.status_code != 200 or response.direct_passthrough or \
+                'Content-Encoding' in response.headers or \
+                response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoder = self.negotiate(request.accept_encodings)
+        if encoder is None:
+            return response
+
+        if response.is_streamed:
+            response.response = encoder.stream(response.response)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_bytes:
+                return response
+            response.set_data(self.compressed(encoder, body))
+
+        response.headers['Content-Encoding'] = encoder.name
+        # the encoded bytes differ, the representation does not
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def compressed(self, encoder, body):
+        if request.method != 'GET':
+            return encoder.compress(body)
+        digest = hashlib.sha1(body).hexdigest()
+        key = f'compressed:{encoder.name}:{digest}'
+        data = self.cache.get(key)
+        if data is None:
+            data = encoder.compress(body)
+            self.cache.set(key, data)
+        return data
+
+
+compressor = Compressor()
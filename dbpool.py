@@ -0,0 +1,214 @@
+import os
+import threading
+import time
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, Pool, QueuePool
+
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', True)
+DB_POOL_USE_LIFO = env_flag('DB_POOL_USE_LIFO', True)
+# milliseconds, 0 leaves the server default in place
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+# set when connecting through PgBouncer (transaction mode) or a similar
+# pooler, which then owns pooling and session settings
+DB_EXTERNAL_POOLER = env_flag('DB_EXTERNAL_POOLER')
+
+
+# weight of each checkout in the recent wait average, and the seconds
+# after which the average has halved when no checkout happens
+RECENT_WAIT_WEIGHT = 0.2
+RECENT_WAIT_HALF_LIFE = 2.0
+
+WAIT_BUCKETS = (
+    .0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+# per worker: liveall keeps a series per pid and drops it when the worker
+# exits
+POOL_CHECKED_OUT = Gauge(
+    'capstone_db_pool_checked_out',
+    'Connections checked out of this worker\'s pool',
+    ['database'], multiprocess_mode='liveall')
+POOL_OVERFLOW = Gauge(
+    'capstone_db_pool_overflow',
+    'Connections open beyond DB_POOL_SIZE in this worker\'s pool',
+    ['database'], multiprocess_mode='liveall')
+POOL_WAIT_SECONDS = Histogram(
+    'capstone_db_pool_wait_seconds',
+    'Time a checkout waited for a pooled connection',
+    ['database'], buckets=WAIT_BUCKETS)
+POOL_TIMEOUTS = Counter(
+    'capstone_db_pool_timeouts_total',
+    'Checkouts that gave up after DB_POOL_TIMEOUT',
+    ['database'])
+
+
+class PoolStats:
+    def __init__(self, clock=time.monotonic):
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.clock = clock
+        self._recent_wait = 0.0
+        self._recent_at = clock()
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, timed_out=False):
+        with self._lock:
+            self.waits += 1
+            self.wait_time += elapsed
+            self.max_wait = max(self.max_wait, elapsed)
+            if timed_out:
+                self.timeouts += 1
+            recent = self._decayed(self.clock())
+            self._recent_wait = recent + (elapsed - recent) * RECENT_WAIT_WEIGHT
+            self._recent_at = self.clock()
+
+    def recent_wait(self):
+        '''
+        Moving average of checkout waits that decays to 0 while nothing is
+        checked out, so it reflects the pool now rather than at the last
+        checkout.
+        '''
+        with self._lock:
+            return self._decayed(self.clock())
+
+    def _decayed(self, now):
+        age = now - self._recent_at
+        return self._recent_wait * 0.5 ** (age / RECENT_WAIT_HALF_LIFE)
+
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool that records how long each checkout waited for a connection,
+    and exports that and its occupancy on /metrics labelled with name.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+        self.name = 'default'
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            elapsed = time.perf_counter() - start
+            self.stats.record(elapsed, timed_out=True)
+            POOL_WAIT_SECONDS.labels(self.name).observe(elapsed)
+            POOL_TIMEOUTS.labels(self.name).inc()
+            raise
+        elapsed = time.perf_counter() - start
+        self.stats.record(elapsed)
+        POOL_WAIT_SECONDS.labels(self.name).observe(elapsed)
+        self.export_occupancy()
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self.export_occupancy()
+
+    def export_occupancy(self):
+        POOL_CHECKED_OUT.labels(self.name).set(self.checkedout())
+        POOL_OVERFLOW.labels(self.name).set(max(self.overflow(), 0))
+
+
+def name_pool(engine):
+    '''
+    Labels the engine's pool metrics with its host and database, which
+    tells the primary and the replicas apart.
+    '''
+    if isinstance(engine.pool, TimedQueuePool):
+        url = engine.url
+        engine.pool.name = f'{url.host}/{url.database}' if url.host \
+            else url.database or 'memory'
+    return engine
+
+
+# A connection opened before gunicorn forked (with --preload, or by a
+# warm-up in the master) must not be shared with the workers: its socket
+# would be used by several processes at once. Pooled connections remember
+# the process that opened them, and any other process replaces them.
+
+@event.listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        # dropped without closing, the socket still belongs to the parent
+        connection_record.connection = None
+        connection_proxy.connection = None
+        raise DisconnectionError(
+            'connection opened in process %s, checked out in %s' %
+            (connection_record.info['pid'], pid))
+
+
+def engine_options(database_path):
+    '''
+    SQLALCHEMY_ENGINE_OPTIONS for the given database, driven by the DB_*
+    environment variables. SQLite keeps Flask-SQLAlchemy's own defaults.
+    '''
+    if database_path.startswith('sqlite'):
+        return {}
+    if DB_EXTERNAL_POOLER:
+        # the external pooler multiplexes server connections, so holding
+        # client-side connections open only pins them for nothing
+        return {'poolclass': NullPool}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_use_lifo': DB_POOL_USE_LIFO
+    }
+    if DB_STATEMENT_TIMEOUT and database_path.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+        }
+    return options
+
+
+def pool_metrics(engine):
+    '''
+    Point-in-time pool state for this worker's engine.
+    '''
+    pool = engine.pool
+    metrics = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+        })
+    stats = getattr(pool, 'stats', None)
+    if stats is not None:
+        metrics.update({
+            'waits': stats.waits,
+            'wait_seconds_total': stats.wait_time,
+            'wait_seconds_max': stats.max_wait,
+            'wait_seconds_recent': stats.recent_wait(),
+            'timeouts': stats.timeouts
+        })
+    return metrics
@@ -0,0 +1,342 @@
+import json
+import logging
+import os
+import select
+import threading
+import time
+from collections import deque
+from flask import Response, abort
+from prometheus_client import Counter, Gauge
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import NullPool
+from dbpool import DB_EXTERNAL_POOLER
+from permissions import permission_registry
+from routing import RoutingSession, normalize_database_url
+from serializers import dumps
+
+
+# local delivers events to this worker's clients only; postgres sends them
+# through LISTEN/NOTIFY so clients on every worker and dyno get them; auto
+# picks postgres when the app's database is Postgres and can LISTEN
+EVENTS_BRIDGE = os.environ.get('EVENTS_BRIDGE', 'auto')
+EVENTS_CHANNEL = os.environ.get('EVENTS_CHANNEL', 'capstone_events')
+# direct connection for LISTEN: a pooler in transaction mode hands each
+# transaction to any server connection, so LISTEN through it hears nothing
+EVENTS_LISTEN_URL = os.environ.get('EVENTS_LISTEN_URL')
+# events queued per client; a client that falls this far behind is
+# disconnected and catches up from the change log when it reconnects
+EVENTS_BUFFER_SIZE = int(os.environ.get('EVENTS_BUFFER_SIZE', 256))
+EVENTS_MAX_CLIENTS = int(os.environ.get('EVENTS_MAX_CLIENTS', 1000))
+EVENTS_HEARTBEAT_SECONDS = float(
+    os.environ.get('EVENTS_HEARTBEAT_SECONDS', 15))
+# how long browsers wait before reconnecting, in milliseconds
+EVENTS_RETRY_MS = 2000
+# NOTIFY payloads must stay under 8000 bytes
+NOTIFY_MAX_BYTES = 7000
+
+# the permissions needed to see events of each table
+EVENT_PERMISSIONS = {
+    'actor': ('get:actors',),
+    'movie': ('get:movies',),
+    'casting': ('get:actors', 'get:movies')
+}
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBERS = Gauge(
+    'capstone_event_subscribers',
+    'Clients connected to /events',
+    multiprocess_mode='livesum')
+DISCONNECTS = Counter(
+    'capstone_event_disconnects_total',
+    'Event stream clients disconnected by the server, by reason',
+    ['reason'])
+
+
+class Subscription:
+    '''
+    One client's queue of events. Publishing never blocks: when the queue
+    is full the subscription is closed instead, so a slow client cannot
+    hold up the others or grow the worker's memory.
+    '''
+
+    def __init__(self, mask, size=EVENTS_BUFFER_SIZE):
+        self.mask = mask
+        self.size = size
+        self.overflowed = False
+        self._events = deque()
+        self._condition = threading.Condition()
+
+    def visible(self, event):
+        required = EVENT_PERMISSIONS.get(event['table'])
+        return required is not None and \
+            all(self.mask & permission_registry.bit(p) for p in required)
+
+    def put(self, events):
+        with self._condition:
+            if self.overflowed:
+                return
+            for event in events:
+                if not self.visible(event):
+                    continue
+                if len(self._events) >= self.size:
+                    self.overflowed = True
+                    self._events.clear()
+                    break
+                self._events.append(event)
+            self._condition.notify()
+
+    def get(self, timeout):
+        '''
+        Every queued event, waiting up to timeout for one. An empty list
+        means the wait timed out or the subscription overflowed.
+        '''
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._events or self.overflowed, timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+
+class Broadcaster:
+    '''
+    Fans events out to this worker's subscriptions.
+    '''
+
+    def __init__(self, max_clients=EVENTS_MAX_CLIENTS):
+        self.max_clients = max_clients
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, mask, size=EVENTS_BUFFER_SIZE):
+        subscription = Subscription(mask, size)
+        with self._lock:
+            if len(self._subscriptions) >= self.max_clients:
+                return None
+            self._subscriptions.add(subscription)
+        SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription not in self._subscriptions:
+                return
+            self._subscriptions.discard(subscription)
+        SUBSCRIBERS.dec()
+
+    def publish(self, events):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(events)
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+
+broadcaster = Broadcaster()
+
+
+# Bridges carry the events of a commit to the broadcasters. send() is called
+# before the commit, deliver_local() after it.
+
+class LocalBridge:
+    def send(self, session, events):
+        pass
+
+    def deliver_local(self, events):
+        broadcaster.publish(events)
+
+    def start(self, engine):
+        pass
+
+
+class PostgresBridge:
+    '''
+    NOTIFYs the events inside the writing transaction, so Postgres delivers
+    them only if it commits, and LISTENs on a dedicated connection per
+    worker, started with the first subscriber, to pass everyone's events to
+    the local broadcaster.
+    '''
+
+    def __init__(self, channel=EVENTS_CHANNEL, listen_url=None):
+        self.channel = channel
+        self.listen_url = listen_url
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def send(self, session, events):
+        for payload in notify_payloads(events):
+            session.execute(
+                text('SELECT pg_notify(:channel, :payload)'),
+                {'channel': self.channel, 'payload': payload})
+
+    def deliver_local(self, events):
+        # this worker receives its own NOTIFYs like everyone else's
+        pass
+
+    def start(self, engine):
+        with self._lock:
+            if self._thread is None:
+                if self.listen_url:
+                    engine = create_engine(
+                        normalize_database_url(self.listen_url),
+                        poolclass=NullPool)
+                self._thread = threading.Thread(
+                    target=self.listen, args=(engine,),
+                    name='events-listener', daemon=True)
+                self._thread.start()
+
+    def listen(self, engine):
+        delay = 1
+        while True:
+            try:
+                self.listen_once(engine)
+                delay = 1
+            except Exception:
+                logger.exception(
+                    'event listener lost its connection, retrying in %ss',
+                    delay)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def listen_once(self, engine):
+        # detached from the pool, so it never counts against pool_size
+        connection = engine.raw_connection()
+        connection.detach()
+        raw = connection.connection
+        try:
+            raw.autocommit = True
+            with raw.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self.channel}"')
+            while True:
+                if select.select([raw], [], [], 30) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    notify = raw.notifies.pop(0)
+                    broadcaster.publish(json.loads(notify.payload))
+        finally:
+            connection.close()
+
+
+def notify_payloads(events):
+    '''
+    The events as JSON arrays, each small enough for one NOTIFY.
+    '''
+    batch, size = [], 2
+    for event in events:
+        encoded = dumps(event).decode()
+        if batch and size + len(encoded) + 1 > NOTIFY_MAX_BYTES:
+            yield '[' + ','.join(batch) + ']'
+            batch, size = [], 2
+        batch.append(encoded)
+        size += len(encoded) + 1
+    if batch:
+        yield '[' + ','.join(batch) + ']'
+
+
+def create_bridge(name=EVENTS_BRIDGE, listen_url=EVENTS_LISTEN_URL):
+    if name == 'postgres':
+        return PostgresBridge(listen_url=listen_url)
+    return LocalBridge()
+
+
+bridge = create_bridge()
+
+def set_bridge(new_bridge):
+    global bridge
+    bridge = new_bridge
+
+
+def init_events(app):
+    name = app.config.get('EVENTS_BRIDGE', EVENTS_BRIDGE)
+    listen_url = app.config.get('EVENTS_LISTEN_URL', EVENTS_LISTEN_URL)
+    pooled = app.config.get('DB_EXTERNAL_POOLER', DB_EXTERNAL_POOLER)
+    if name == 'auto':
+        uri = app.config['SQLALCHEMY_DATABASE_URI']
+        name = 'postgres' if uri.startswith('postgres') and \
+            (listen_url or not pooled) else 'local'
+    elif name == 'postgres' and pooled and not listen_url:
+        logger.warning(
+            'EVENTS_BRIDGE=postgres behind DB_EXTERNAL_POOLER needs '
+            'EVENTS_LISTEN_URL, or other workers\' events are not received')
+    set_bridge(create_bridge(name, listen_url))
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def send_pending_events(session):
+    events = session.info.get('pending_events')
+    if events:
+        bridge.send(session, events)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def deliver_pending_events(session):
+    events = session.info.pop('pending_events', None)
+    if events:
+        bridge.deliver_local(events)
+
+
+# The stream
+
+def format_event(event):
+    lines = ['event: change']
+    if event.get('seq') is not None:
+        lines.append(f'id: {event["seq"]}')
+    lines.append('data: ' + dumps(event).decode())
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def stream_events(subscription, backlog=(), resync=False,
+                  heartbeat=EVENTS_HEARTBEAT_SECONDS):
+    '''
+    The text/event-stream body: the backlog missed since Last-Event-ID,
+    then live events as they are published. Comments go out every
+    heartbeat seconds, so proxies keep the connection open and a closed
+    one is noticed. Ends when the client falls behind.
+    '''
+    try:
+        yield f'retry: {EVENTS_RETRY_MS}\n\n'.encode()
+        if resync:
+            yield b'event: resync\ndata: {}\n\n'
+        last_seq = 0
+        for event in backlog:
+            last_seq = event['seq']
+            yield format_event(event)
+        while True:
+            events = subscription.get(heartbeat)
+            if subscription.overflowed:
+                DISCONNECTS.labels('overflow').inc()
+                return
+            if not events:
+                yield b': heartbeat\n\n'
+                continue
+            # live events already sent from the backlog are skipped
+            yield b''.join(
+                format_event(event) for event in events
+                if event.get('seq') is None or event['seq'] > last_seq)
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+def event_stream_response(subscription, backlog=(), resync=False):
+    response = Response(
+        stream_events(subscription, backlog, resync),
+        mimetype='text/event-stream')
+    # also when the client leaves before the stream has started
+    response.call_on_close(lambda: broadcaster.unsubscribe(subscription))
+    response.headers['Cache-Control'] = 'no-cache'
+    # tells nginx and the Heroku router not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def subscribe(mask, engine):
+    bridge.start(engine)
+    subscription = broadcaster.subscribe(mask)
+    if subscription is None:
+        DISCONNECTS.labels('max_clients').inc()
+        abort(503, retry_after=EVENTS_RETRY_MS // 1000)
+    return subscription
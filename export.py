@@ -0,0 +1,59 @@
+import os
+from flask import Response, abort, stream_with_context
+from models import db
+from serializers import dumps
+
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+EXPORT_MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def iter_rows(model, fields, criteria=(), order=None,
+              batch_size=EXPORT_BATCH_SIZE):
+    '''
+    Every matching row as a formatted dict, read through a server-side
+    cursor in batches so only batch_size rows are held at a time.
+    '''
+    keys = [model.response_keys[name] for name in fields]
+    query = db.session.query(*[getattr(model, name) for name in fields]) \
+        .filter(*criteria) \
+        .order_by(*(order or [model.id])) \
+        .execution_options(stream_results=True) \
+        .yield_per(batch_size)
+    for row in query:
+        yield dict(zip(keys, row))
+
+
+def generate_json(collection, rows):
+    # same bytes as jsonify({'success': True, collection: [...]})
+    yield b'{"%s":[' % collection.encode()
+    for index, row in enumerate(rows):
+        yield (b',' if index else b'') + dumps(row)
+    yield b'],"success":true}\n'
+
+
+def generate_ndjson(rows):
+    for row in rows:
+        yield dumps(row) + b'\n'
+
+
+def stream_export(model, collection, fields, export_format,
+                  criteria=(), order=None):
+    '''
+    Streams every matching row as one JSON document shaped like the paged
+    response, or as one JSON object per line for export=ndjson.
+    '''
+    if export_format not in EXPORT_MIMETYPES:
+        abort(400)
+    rows = iter_rows(model, fields, criteria, order)
+    if export_format == 'ndjson':
+        body = generate_ndjson(rows)
+    else:
+        body = generate_json(collection, rows)
+    return Response(
+        stream_with_context(body),
+        mimetype=EXPORT_MIMETYPES[export_format])
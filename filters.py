@@ -0,0 +1,50 @@
+from flask import abort
+from sqlalchemy import DateTime, Integer, func
+from models import clean_datetime
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def parse_value(column, raw):
+    if isinstance(column.type, Integer):
+        return int(raw)
+    if isinstance(column.type, DateTime):
+        return clean_datetime({'value': raw}, 'value')
+    return raw
+
+
+def criterion(column, operator, value):
+    # prefix and contains match case-insensitively on lower(column), which
+    # is what the expression and trigram indexes are built on
+    if operator == 'prefix':
+        return func.lower(column).like(
+            escape_like(value.lower()) + '%', escape='\\')
+    if operator == 'contains':
+        return func.lower(column).like(
+            '%' + escape_like(value.lower()) + '%', escape='\\')
+    if operator == 'min':
+        return column >= value
+    if operator == 'max':
+        return column <= value
+    return column == value
+
+
+def parse_filters(args, model):
+    '''
+    SQL criteria for the query arguments listed in model.filter_params,
+    which maps each argument to a column and a comparison.
+    '''
+    criteria = []
+    for param, (name, operator) in model.filter_params.items():
+        raw = args.get(param)
+        if raw is None or raw == '':
+            continue
+        column = getattr(model, name)
+        try:
+            value = parse_value(column, raw)
+        except ValueError:
+            abort(400)
+        criteria.append(criterion(column, operator, value))
+    return criteria
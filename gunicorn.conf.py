@@ -0,0 +1,40 @@
+# Read by gunicorn from the working directory, for app:app and async_app:app
+import os
+
+
+def env_flag(name, default=False):
+    # dbpool.env_flag, without importing the app into the config
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# The master imports and builds the app once and workers fork from it,
+# sharing its memory, so a new worker starts serving almost at once. Nothing
+# connects to the database before the fork.
+preload_app = env_flag('PRELOAD_APP', True)
+
+
+def when_ready(server):
+    if server.cfg.worker_class_str == 'sync':
+        server.log.warning(
+            'Sync workers: each /events stream and long poll holds a whole '
+            'worker until the timeout. Serve async_app:app with -k gevent.')
+    # server.app.callable is the app only when it was preloaded
+    app = server.app.callable
+    if app is not None:
+        from startup import preloaded
+        preloaded(app)
+
+
+def post_worker_init(worker):
+    from startup import ready
+    worker.log.info('Worker %s %s', worker.pid, ready(worker.wsgi))
+
+
+def child_exit(server, worker):
+    # drops the live gauges of a dead or recycled worker from /metrics
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,100 @@
+import hashlib
+from datetime import timezone
+from functools import wraps
+from flask import Response, make_response, request, _request_ctx_stack
+from cache import resource_cache, list_key
+from models import TableVersion
+from relations import included_tables
+
+
+def list_etag(table_name, version, url):
+    digest = hashlib.sha1(url).hexdigest()[:16]
+    return f'{table_name}-{version}-{digest}'
+
+
+def list_version(table_names):
+    '''
+    The combined version and latest modification time of the tables a list
+    response is built from.
+    '''
+    versions, modified = [], []
+    for table_name in table_names:
+        version, modified_at = TableVersion.current(table_name)
+        versions.append(str(version))
+        if modified_at is not None:
+            modified.append(modified_at)
+    return '.'.join(versions), max(modified, default=None)
+
+
+def is_not_modified(etag, modified_at):
+    # weak comparison, so the ETag of a compressed response matches too
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and modified_at is not None:
+        return modified_at.replace(microsecond=0, tzinfo=timezone.utc) <= \
+            request.if_modified_since
+    return False
+
+
+def set_validators(response, etag, modified_at):
+    response.set_etag(etag)
+    if modified_at is not None:
+        response.last_modified = modified_at.replace(tzinfo=timezone.utc)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def cached_json(key, build, shared_only=False):
+    '''
+    The JSON body stored under key in resource_cache, or the response of
+    build(), whose body is stored when it is a 200. Entries that are only
+    removed by the worker making the write are cached with shared_only,
+    which skips the cache unless every worker shares the backend.
+    '''
+    if shared_only and not resource_cache.backend.shared:
+        return build()
+    body = resource_cache.get(key)
+    if body is not None:
+        return Response(body, mimetype='application/json')
+    response = make_response(build())
+    if response.status_code == 200 and not response.is_streamed:
+        resource_cache.set(key, response.get_data())
+    return response
+
+
+def conditional(model, extra_tables=(), includes=True):
+    '''
+    ETag / Last-Modified handling for a list view of model. A matching
+    If-None-Match or If-Modified-Since is answered with 304 after reading
+    only the table versions; otherwise the body comes from resource_cache.
+    The versions of the model's table, of extra_tables and of any
+    ?include= relations (when the view embeds them) are part of the ETag
+    and so of the cache key, so a write from any worker moves readers on
+    to a new entry. Nested lists name their parent's table in
+    extra_tables: casting changes move both tables' versions.
+    '''
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            table_name = model.__tablename__
+            table_names = [table_name] + list(extra_tables)
+            if includes:
+                table_names += included_tables(
+                    model, request.args,
+                    _request_ctx_stack.top.granted_permissions)
+            version, modified_at = list_version(table_names)
+            etag = list_etag(
+                table_name, version,
+                request.path.encode() + b'?' + request.query_string)
+
+            if is_not_modified(etag, modified_at):
+                return set_validators(
+                    Response(status=304), etag, modified_at)
+
+            response = cached_json(
+                list_key(table_name, etag), lambda: f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            return set_validators(response, etag, modified_at)
+        return wrapper
+    return conditional_decorator
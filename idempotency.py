@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import Response, abort, make_response, request
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import is_hop_by_hop_header
+from models import db, IdempotencyRecord
+from routing import client_key
+
+
+# seconds a stored response is replayed for
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))
+# seconds a claim stays with a request that has not completed yet, after
+# which a retry runs again; keep it above the slowest idempotent request
+IDEMPOTENCY_LEASE_SECONDS = int(
+    os.environ.get('IDEMPOTENCY_LEASE_SECONDS', 120))
+# completed responses kept per worker in front of the table, 0 disables
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 1024))
+# how long a duplicate waits for the first request in the same worker
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 30))
+IDEMPOTENCY_PURGE_SECONDS = int(os.environ.get('IDEMPOTENCY_PURGE_SECONDS', 300))
+MAX_KEY_LENGTH = 255
+# rebuilt from the body and mimetype on replay
+UNSTORED_HEADERS = {'content-type', 'content-length'}
+
+
+def stored_headers(response):
+    return [
+        [name, value] for name, value in response.headers.items()
+        if name.lower() not in UNSTORED_HEADERS and
+        not is_hop_by_hop_header(name)
+    ]
+
+
+class StoredResponse:
+    def __init__(self, request_hash, status, body, mimetype, headers,
+                 expires_at):
+        self.request_hash = request_hash
+        self.status = status
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(
+            record.request_hash, record.status, record.body,
+            record.mimetype, json.loads(record.headers or '[]'),
+            record.expires_at)
+
+    def replay(self):
+        response = Response(self.body, self.status, mimetype=self.mimetype)
+        for name, value in self.headers:
+            response.headers.add(name, value)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+
+class IdempotencyStore:
+    '''
+    Responses by idempotency key. The idempotency_record table is shared
+    by every worker: a key is claimed by inserting its row, which only one
+    request can do, and completed by storing the response in it. Completed
+    responses are also kept in a per-worker LRU, and duplicates arriving
+    at the same worker while the first request runs wait for it instead
+    of going to the table.
+    '''
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, cache_size=IDEMPOTENCY_CACHE_SIZE,
+                 wait_seconds=IDEMPOTENCY_WAIT_SECONDS,
+                 purge_seconds=IDEMPOTENCY_PURGE_SECONDS,
+                 lease=IDEMPOTENCY_LEASE_SECONDS):
+        self.ttl = ttl
+        self.lease = lease
+        self.cache_size = cache_size
+        self.wait_seconds = wait_seconds
+        self.purge_seconds = purge_seconds
+        self.replays = 0
+        self._completed = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._next_purge = 0
+
+    # Per-worker fast path
+
+    def cached(self, key):
+        with self._lock:
+            stored = self._completed.get(key)
+            if stored is None:
+                return None
+            if stored.expires_at <= datetime.utcnow():
+                del self._completed[key]
+                return None
+            self._completed.move_to_end(key)
+            return stored
+
+    def remember(self, key, stored):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._completed[key] = stored
+            self._completed.move_to_end(key)
+            while len(self._completed) > self.cache_size:
+                self._completed.popitem(last=False)
+
+    def lead_or_wait(self, key):
+        '''
+        True when this request is the first in the worker to run key;
+        otherwise waits until the one running it finishes.
+        '''
+        with self._lock:
+            event = self._in_flight.get(key)
+            if event is None:
+                self._in_flight[key] = threading.Event()
+                return True
+        event.wait(self.wait_seconds)
+        return False
+
+    def finish(self, key):
+        with self._lock:
+            event = self._in_flight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._completed.clear()
+
+    # Table
+
+    def claim(self, key, request_hash):
+        '''
+        Inserts the in-progress row for key. Returns None when this request
+        now owns the key, or the existing row when another request does.
+        The row expires after the lease until complete() stores the
+        response, so a request that died holding it does not block retries
+        for the whole ttl.
+        '''
+        self.purge_expired()
+        now = datetime.utcnow()
+        db.session.add(IdempotencyRecord(
+            key=key, request_hash=request_hash,
+            expires_at=now + timedelta(seconds=self.lease)))
+        try:
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+        record = IdempotencyRecord.query.get(key)
+        if record is not None and record.expires_at <= now:
+            db.session.delete(record)
+            db.session.commit()
+            return self.claim(key, request_hash)
+        return record
+
+    def complete(self, key, request_hash, response):
+        db.session.rollback()
+        record = IdempotencyRecord.query.get(key)
+        if record is None:
+            # the lease ran out and the claim was purged meanwhile
+            record = IdempotencyRecord(key=key, request_hash=request_hash)
+            db.session.add(record)
+        record.status = response.status_code
+        record.body = response.get_data()
+        record.mimetype = response.mimetype
+        record.headers = json.dumps(stored_headers(response))
+        record.expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        db.session.commit()
+        return StoredResponse.from_record(record)
+
+    def release(self, key):
+        db.session.rollback()
+        IdempotencyRecord.query.filter(IdempotencyRecord.key == key) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    def purge_expired(self):
+        if time.monotonic() < self._next_purge:
+            return
+        self._next_purge = time.monotonic() + self.purge_seconds
+        IdempotencyRecord.query \
+            .filter(IdempotencyRecord.expires_at <= datetime.utcnow()) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+
+idempotency_store = IdempotencyStore()
+
+
+def idempotency_key():
+    header = request.headers.get('Idempotency-Key')
+    if header is None:
+        return None
+    if not header or len(header) > MAX_KEY_LENGTH:
+        abort(400)
+    # keys are per client and per endpoint, so clients cannot collide
+    scope = f'{client_key()}\n{request.method}\n{request.path}\n{header}'
+    return hashlib.sha256(scope.encode()).hexdigest()
+
+
+def request_fingerprint():
+    digest = hashlib.sha256(request.query_string)
+    digest.update(b'\n')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def replay(stored, request_hash):
+    # the same key with a different request is a client bug
+    if stored.request_hash != request_hash:
+        abort(422)
+    idempotency_store.replays += 1
+    return stored.replay()
+
+
+def idempotent(f):
+    '''
+    Honours an Idempotency-Key header: the first request with a key runs,
+    and its response is stored and replayed for every retry with the same
+    key and body until the key expires. A retry arriving while the first
+    request is still running in another worker gets 409 with Retry-After,
+    and a request reusing the key with a different body gets 422.
+    Requests that abort or fail with a 5xx are not stored, so they can be
+    retried.
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = idempotency_key()
+        if key is None:
+            return f(*args, **kwargs)
+        request_hash = request_fingerprint()
+
+        stored = idempotency_store.cached(key)
+        if stored is not None:
+            return replay(stored, request_hash)
+        leader = idempotency_store.lead_or_wait(key)
+        if not leader:
+            stored = idempotency_store.cached(key)
+            if stored is not None:
+                return replay(stored, request_hash)
+
+        try:
+            record = idempotency_store.claim(key, request_hash)
+            if record is not None:
+                # a reused key is a client bug even before the first
+                # request has finished, so it is not worth retrying
+                if record.request_hash != request_hash:
+                    abort(422)
+                if record.status is None:
+                    abort(409)
+                stored = StoredResponse.from_record(record)
+                idempotency_store.remember(key, stored)
+                return replay(stored, request_hash)
+
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                idempotency_store.release(key)
+                raise
+            if response.status_code >= 500:
+                idempotency_store.release(key)
+                return response
+            idempotency_store.remember(
+                key, idempotency_store.complete(key, request_hash, response))
+            return response
+        finally:
+            if leader:
+                idempotency_store.finish(key)
+
+    return wrapper
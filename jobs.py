@@ -0,0 +1,465 @@
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+import click
+from flask import abort
+from prometheus_client import Counter
+from sqlalchemy import and_, func, insert, or_
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from auth import check_granted
+from bulk import (
+    BULK_CHUNK_SIZE, BULK_MAX_ITEMS, run_bulk,
+    prepare_create, prepare_update, prepare_delete,
+    write_create, write_update, write_delete)
+from export import EXPORT_MIMETYPES, generate_json, generate_ndjson, iter_rows
+from filters import parse_filters
+from models import db, Actor, Job, JobResultChunk, Movie
+from pagination import parse_fields, parse_sort, sort_order
+from permissions import permission_registry
+from serializers import dumps
+
+
+# worker threads started in each web process; by default jobs are left to
+# the `flask run-jobs` worker
+JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', 0))
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 1))
+# seconds a claimed job stays with its worker without a heartbeat
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+# first retry delay in seconds, doubled per attempt up to JOB_BACKOFF_MAX
+JOB_BACKOFF_SECONDS = float(os.environ.get('JOB_BACKOFF_SECONDS', 5))
+JOB_BACKOFF_MAX = float(os.environ.get('JOB_BACKOFF_MAX', 600))
+# jobs of a kind running at once across every worker, e.g. "export=2,bulk=4"
+JOB_CONCURRENCY = os.environ.get('JOB_CONCURRENCY', 'export=2,bulk=2')
+JOB_MAX_QUEUED_PER_CLIENT = int(os.environ.get('JOB_MAX_QUEUED_PER_CLIENT', 20))
+# seconds finished jobs and their results are kept
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 24 * 3600))
+# bytes of a job's result stored per job_result_chunk row
+JOB_RESULT_CHUNK_BYTES = int(
+    os.environ.get('JOB_RESULT_CHUNK_BYTES', 1024 * 1024))
+
+RESOURCES = {'actors': Actor, 'movies': Movie}
+
+logger = logging.getLogger(__name__)
+
+JOBS = Counter(
+    'capstone_jobs_total',
+    'Background job attempts by kind and outcome',
+    ['kind', 'outcome'])
+
+
+def parse_concurrency(value):
+    limits = {}
+    for entry in value.split(','):
+        if entry.strip():
+            kind, limit = entry.split('=', 1)
+            limits[kind.strip()] = int(limit)
+    return limits
+
+
+def resource_model(spec):
+    model = RESOURCES.get(spec.get('resource'))
+    if model is None:
+        abort(400)
+    return model
+
+
+# Job kinds. validate() turns the request body into the stored params,
+# aborting on bad input; run() does the work in a worker and returns the
+# result body, an iterable of bytes, and its mimetype.
+
+class BulkJob:
+    '''
+    POST, PATCH or DELETE of many actors or movies, as the /bulk endpoints.
+    '''
+
+    verbs = {'POST': 'post', 'PATCH': 'patch', 'DELETE': 'delete'}
+    steps = {
+        'POST': (prepare_create, write_create),
+        'PATCH': (prepare_update, write_update),
+        'DELETE': (prepare_delete, write_delete)
+    }
+
+    def validate(self, spec):
+        resource_model(spec)
+        if spec.get('method') not in self.steps:
+            abort(400)
+        items = spec.get('items')
+        if not isinstance(items, list) or len(items) > BULK_MAX_ITEMS:
+            abort(422)
+        chunk_size = spec.get('chunk_size', BULK_CHUNK_SIZE)
+        if isinstance(chunk_size, bool) or not isinstance(chunk_size, int) \
+                or chunk_size < 1:
+            abort(400)
+        return {
+            'resource': spec['resource'],
+            'method': spec['method'],
+            'items': items,
+            'chunk_size': chunk_size,
+            'atomic': spec.get('atomic') is True
+        }
+
+    def permission(self, params):
+        return f'{self.verbs[params["method"]]}:{params["resource"]}'
+
+    def max_attempts(self, params):
+        # only an atomic batch is all or nothing, and so safe to run again
+        return JOB_MAX_ATTEMPTS if params['atomic'] else 1
+
+    def run(self, params):
+        model = RESOURCES[params['resource']]
+        prepare, write = self.steps[params['method']]
+        results, rejected = run_bulk(
+            params['items'], prepare(model), write(model),
+            params['chunk_size'], params['atomic'])
+        body = dumps({'success': not rejected, 'results': results})
+        return [body], 'application/json'
+
+
+class ExportJob:
+    '''
+    Every matching actor or movie, as ?export= on the list endpoints.
+    query holds the list query arguments: filters, fields and sort.
+    '''
+
+    def validate(self, spec):
+        model = resource_model(spec)
+        export_format = spec.get('format', 'json')
+        query = spec.get('query', {})
+        if export_format not in EXPORT_MIMETYPES or \
+                not isinstance(query, dict) or \
+                not all(isinstance(value, str) for value in query.values()):
+            abort(400)
+        args = MultiDict(query)
+        parse_fields(args, model)
+        parse_filters(args, model)
+        parse_sort(args, model)
+        return {
+            'resource': spec['resource'],
+            'format': export_format,
+            'query': query
+        }
+
+    def permission(self, params):
+        return f'get:{params["resource"]}'
+
+    def max_attempts(self, params):
+        return JOB_MAX_ATTEMPTS
+
+    def run(self, params):
+        model = RESOURCES[params['resource']]
+        args = MultiDict(params['query'])
+        rows = iter_rows(
+            model, parse_fields(args, model), parse_filters(args, model),
+            sort_order(model, parse_sort(args, model)))
+        if params['format'] == 'ndjson':
+            body = generate_ndjson(rows)
+        else:
+            body = generate_json(params['resource'], rows)
+        return body, EXPORT_MIMETYPES[params['format']]
+
+
+JOB_KINDS = {
+    'bulk': BulkJob(),
+    'export': ExportJob()
+}
+
+
+# The queue is the job table: no broker, and every worker of every dyno
+# sees the same jobs
+
+def enqueue(spec, owner, granted, now=None):
+    '''
+    Validates a job request, checks the caller holds the permission the
+    job needs and queues it. Aborts with 429 when the caller already has
+    JOB_MAX_QUEUED_PER_CLIENT jobs waiting or running.
+    '''
+    if not isinstance(spec, dict) or spec.get('kind') not in JOB_KINDS:
+        abort(400)
+    kind = JOB_KINDS[spec['kind']]
+    params = kind.validate(spec)
+    check_granted(granted, permission_registry.bit(kind.permission(params)))
+
+    pending = Job.query.filter(
+        Job.owner == owner, Job.status.in_(('queued', 'running'))).count()
+    if pending >= JOB_MAX_QUEUED_PER_CLIENT:
+        abort(429, retry_after=int(JOB_POLL_SECONDS * 10))
+
+    now = now or datetime.utcnow()
+    job = Job(
+        id=uuid.uuid4().hex, kind=spec['kind'], owner=owner,
+        status='queued', params=json.dumps(params), attempts=0,
+        max_attempts=kind.max_attempts(params), run_after=now,
+        created_at=now)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def claimable(now):
+    return or_(
+        and_(Job.status == 'queued', Job.run_after <= now),
+        # running elsewhere, but its worker stopped renewing the lease
+        and_(Job.status == 'running', Job.locked_until < now,
+             Job.attempts < Job.max_attempts))
+
+
+def claim(worker, limits, lease=JOB_LEASE_SECONDS, now=None):
+    '''
+    The next due job, now running under worker's lease, or None. Kinds at
+    their concurrency limit are skipped. The conditional UPDATE decides
+    races between workers; on Postgres SKIP LOCKED keeps them from
+    queueing on the same row.
+    '''
+    now = now or datetime.utcnow()
+    running = dict(
+        db.session.query(Job.kind, func.count(Job.id))
+        .filter(Job.status == 'running', Job.locked_until >= now)
+        .group_by(Job.kind))
+    kinds = [kind for kind in JOB_KINDS
+             if running.get(kind, 0) < limits.get(kind, 1)]
+    if not kinds:
+        return None
+
+    candidate = db.session.query(Job.id) \
+        .filter(Job.kind.in_(kinds), claimable(now)) \
+        .order_by(Job.run_after) \
+        .with_for_update(skip_locked=True).first()
+    if candidate is None:
+        db.session.rollback()
+        return None
+    claimed = db.session.query(Job) \
+        .filter(Job.id == candidate.id, claimable(now)) \
+        .update({
+            Job.status: 'running',
+            Job.attempts: Job.attempts + 1,
+            Job.locked_by: worker,
+            Job.locked_until: now + timedelta(seconds=lease)
+        }, synchronize_session=False)
+    db.session.commit()
+    return Job.query.get(candidate.id) if claimed else None
+
+
+def store_result(job_id, body, chunk_bytes=JOB_RESULT_CHUNK_BYTES):
+    '''
+    Writes body to job_result_chunk as it is generated, holding no more
+    than chunk_bytes of it at a time. The chunks commit with the job's
+    status, so a failed attempt leaves none behind.
+    '''
+    table = JobResultChunk.__table__
+    buffer = bytearray()
+    seq = 0
+    for piece in body:
+        buffer += piece
+        if len(buffer) < chunk_bytes:
+            continue
+        db.session.execute(
+            insert(table).values(job_id=job_id, seq=seq, data=bytes(buffer)))
+        buffer.clear()
+        seq += 1
+    if buffer:
+        db.session.execute(
+            insert(table).values(job_id=job_id, seq=seq, data=bytes(buffer)))
+
+
+def result_chunks(job_id):
+    '''
+    The stored result of a job, a chunk at a time.
+    '''
+    seqs = [seq for seq, in db.session.query(JobResultChunk.seq)
+            .filter(JobResultChunk.job_id == job_id)
+            .order_by(JobResultChunk.seq)]
+    for seq in seqs:
+        data = db.session.query(JobResultChunk.data) \
+            .filter(JobResultChunk.job_id == job_id,
+                    JobResultChunk.seq == seq).scalar()
+        if data is None:
+            # expired while it was being read
+            return
+        yield data
+
+
+def backoff(attempts):
+    delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    # jitter, so jobs failing together do not retry together
+    return delay * random.uniform(0.5, 1)
+
+
+def execute(job):
+    '''
+    Runs a claimed job and records its result, or its error. A failed job
+    is queued again after a backoff until it has used max_attempts;
+    invalid parameters fail it at once.
+    '''
+    kind = JOB_KINDS[job.kind]
+    job_id, attempts = job.id, job.attempts
+    try:
+        body, mimetype = kind.run(json.loads(job.params))
+        store_result(job_id, body)
+    except Exception as error:
+        db.session.rollback()
+        job = Job.query.get(job_id)
+        job.error = str(error) or type(error).__name__
+        if not isinstance(error, HTTPException) and \
+                attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_after = datetime.utcnow() + timedelta(
+                seconds=backoff(attempts))
+            outcome = 'retried'
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+            outcome = 'failed'
+        job.locked_by = job.locked_until = None
+        db.session.commit()
+        JOBS.labels(job.kind, outcome).inc()
+        logger.warning('job %s (%s) attempt %s failed: %s',
+                       job_id, job.kind, attempts, job.error)
+        return
+
+    job = Job.query.get(job_id)
+    job.status = 'succeeded'
+    job.result_mimetype = mimetype
+    job.error = None
+    job.finished_at = datetime.utcnow()
+    job.locked_by = job.locked_until = None
+    db.session.commit()
+    JOBS.labels(job.kind, 'succeeded').inc()
+
+
+def renew_leases(worker, lease=JOB_LEASE_SECONDS, now=None):
+    now = now or datetime.utcnow()
+    db.session.query(Job) \
+        .filter(Job.status == 'running', Job.locked_by == worker) \
+        .update({Job.locked_until: now + timedelta(seconds=lease)},
+                synchronize_session=False)
+    db.session.commit()
+
+
+def expire_jobs(ttl=JOB_RESULT_TTL, now=None):
+    '''
+    Fails jobs lost with their worker that may not run again, and deletes
+    finished jobs older than ttl.
+    '''
+    now = now or datetime.utcnow()
+    db.session.query(Job).filter(
+        Job.status == 'running', Job.locked_until < now,
+        Job.attempts >= Job.max_attempts) \
+        .update({
+            Job.status: 'failed',
+            Job.error: 'worker lost',
+            Job.finished_at: now
+        }, synchronize_session=False)
+    finished = (
+        Job.status.in_(('succeeded', 'failed')),
+        Job.finished_at < now - timedelta(seconds=ttl))
+    db.session.query(JobResultChunk).filter(JobResultChunk.job_id.in_(
+        db.session.query(Job.id).filter(*finished).scalar_subquery())) \
+        .delete(synchronize_session=False)
+    db.session.query(Job).filter(*finished) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+class JobRunner:
+    '''
+    A pool of worker threads taking jobs from the table, plus one that
+    renews the leases of the jobs they run and expires old ones. Started
+    lazily by the first enqueue in an app process, or in the foreground by
+    `flask run-jobs`.
+    '''
+
+    def __init__(self, threads=JOB_WORKER_THREADS):
+        self.threads = threads
+        self.limits = parse_concurrency(JOB_CONCURRENCY)
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.threads = int(
+            app.config.get('JOB_WORKER_THREADS', JOB_WORKER_THREADS))
+        self.limits = parse_concurrency(
+            app.config.get('JOB_CONCURRENCY', JOB_CONCURRENCY))
+
+        @app.cli.command('run-jobs')
+        @click.option('--threads', type=int, default=self.threads or 1,
+                      show_default=True, help='Jobs run at once.')
+        def run_jobs_command(threads):
+            '''Run background jobs until interrupted.'''
+            self.threads = threads
+            self.start(app)
+            try:
+                self._stop.wait()
+            except KeyboardInterrupt:
+                self.stop()
+
+    def start(self, app):
+        with self._lock:
+            if self._threads or self.threads < 1:
+                self._wake.set()
+                return
+            # the pid changes when gunicorn forks, so leases stay per process
+            self.worker = f'{socket.gethostname()}:{os.getpid()}'
+            self._stop.clear()
+            targets = [self.work] * self.threads + [self.keep]
+            for index, target in enumerate(targets):
+                thread = threading.Thread(
+                    target=target, args=(app,), daemon=True,
+                    name=f'jobs-{index}')
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def run_pending(self, app):
+        '''
+        Runs due jobs in the calling thread until none is left.
+        '''
+        ran = 0
+        while self.run_one(app):
+            ran += 1
+        return ran
+
+    def run_one(self, app):
+        with app.app_context():
+            job = claim(self.worker, self.limits)
+            if job is None:
+                return False
+            execute(job)
+            return True
+
+    def work(self, app):
+        while not self._stop.is_set():
+            try:
+                if self.run_one(app):
+                    continue
+            except Exception:
+                logger.exception('job worker failed')
+            self._wake.wait(JOB_POLL_SECONDS)
+            self._wake.clear()
+
+    def keep(self, app):
+        while not self._stop.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                with app.app_context():
+                    renew_leases(self.worker)
+                    expire_jobs()
+            except Exception:
+                logger.exception('job lease renewal failed')
+
+
+job_runner = JobRunner()
@@ -0,0 +1,151 @@
+import os
+import time
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+    generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from dbpool import env_flag
+
+
+METRICS_ENABLED = env_flag('METRICS_ENABLED', True)
+SERVER_TIMING = env_flag('SERVER_TIMING', True)
+# set for gunicorn, so /metrics sums the samples of every worker
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+PHASES = ('auth', 'db', 'serialize')
+
+LATENCY_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+REQUEST_SECONDS = Histogram(
+    'capstone_request_duration_seconds',
+    'Time from the start of a request to its response',
+    ['route', 'method'], buckets=LATENCY_BUCKETS)
+PHASE_SECONDS = Histogram(
+    'capstone_request_phase_seconds',
+    'Time spent per request in auth, SQL and JSON encoding',
+    ['route', 'phase'], buckets=LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram(
+    'capstone_request_db_queries',
+    'SQL statements run per request',
+    ['route'], buckets=QUERY_BUCKETS)
+RESPONSES = Counter(
+    'capstone_responses_total',
+    'Responses by route and status code',
+    ['route', 'method', 'status'])
+
+
+# Request timings live on g, so anything outside a request (migrations,
+# background refreshes) is not counted
+
+def add_time(phase, elapsed):
+    if has_request_context() and 'phase_seconds' in g:
+        g.phase_seconds[phase] += elapsed
+
+
+@contextmanager
+def timed(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start)
+
+
+# Called with (conn, statement, parameters, executemany, elapsed) after
+# every statement, inside or outside a request
+query_listeners = []
+
+def add_query_listener(listener):
+    query_listeners.append(listener)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'phase_seconds' in g:
+        g.phase_seconds['db'] += elapsed
+        g.db_queries += 1
+    for listener in query_listeners:
+        listener(conn, statement, parameters, executemany, elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def drop_query_timer(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
+
+
+def route_label():
+    # the URL rule rather than the path keeps label cardinality bounded
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def server_timing(phase_seconds, queries, total):
+    entries = []
+    for phase in PHASES:
+        entry = f'{phase};dur={phase_seconds[phase] * 1000:.2f}'
+        if phase == 'db':
+            entry += f';desc="queries={queries}"'
+        entries.append(entry)
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+def metrics_response():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app, enabled=METRICS_ENABLED):
+    '''
+    Times every request of app and its auth, SQL and serialization phases
+    into Prometheus histograms, adds a Server-Timing header and serves
+    the histograms on /metrics. Register before the other after_request
+    hooks: Flask runs them in reverse, so the total covers theirs too.
+    '''
+    if not enabled:
+        return
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        g.db_queries = 0
+
+    @app.after_request
+    def record_request_time(response):
+        if 'request_start' not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        route = route_label()
+        REQUEST_SECONDS.labels(route, request.method).observe(total)
+        for phase in PHASES:
+            PHASE_SECONDS.labels(route, phase).observe(g.phase_seconds[phase])
+        REQUEST_QUERIES.labels(route).observe(g.db_queries)
+        RESPONSES.labels(
+            route, request.method, response.status_code).inc()
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = server_timing(
+                g.phase_seconds, g.db_queries, total)
+        return response
+
+    app.add_url_rule(
+        '/metrics', 'metrics', metrics_response, methods=['GET'])
@@ -0,0 +1,32 @@
+"""add casting
+
+Revision ID: 5e7a0c3d9b21
+Revises: 8d2b6f4c1a93
+Create Date: 2026-10-18 13:40:06.112874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7a0c3d9b21'
+down_revision = '8d2b6f4c1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('casting',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actor.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index('ix_casting_actor_id', 'casting', ['actor_id'])
+
+
+def downgrade():
+    op.drop_index('ix_casting_actor_id', table_name='casting')
+    op.drop_table('casting')
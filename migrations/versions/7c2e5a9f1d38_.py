@@ -0,0 +1,34 @@
+"""store job results in chunks
+
+Revision ID: 7c2e5a9f1d38
+Revises: 3b8f0d6c1e47
+Create Date: 2026-10-18 21:12:48.530716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2e5a9f1d38'
+down_revision = '3b8f0d6c1e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job_result_chunk',
+    sa.Column('job_id', sa.String(length=32), nullable=False),
+    sa.Column('seq', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['job_id'], ['job.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('job_id', 'seq')
+    )
+    with op.batch_alter_table('job') as batch_op:
+        batch_op.drop_column('result')
+
+
+def downgrade():
+    with op.batch_alter_table('job') as batch_op:
+        batch_op.add_column(sa.Column('result', sa.LargeBinary(), nullable=True))
+    op.drop_table('job_result_chunk')
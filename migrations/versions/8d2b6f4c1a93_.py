@@ -0,0 +1,53 @@
+"""add search and sort indexes
+
+Revision ID: 8d2b6f4c1a93
+Revises: c3f1e2a9d4b7
+Create Date: 2026-10-18 11:02:17.540913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2b6f4c1a93'
+down_revision = 'c3f1e2a9d4b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_movie_title_id', 'movie', ['title', 'id'])
+    op.create_index('ix_movie_release_date_id', 'movie', ['release_date', 'id'])
+    op.create_index('ix_actor_name_id', 'actor', ['name', 'id'])
+    op.create_index('ix_actor_gender_id', 'actor', ['gender', 'id'])
+    op.create_index('ix_actor_age', 'actor', ['age'])
+
+    if op.get_bind().dialect.name == 'postgresql':
+        # text_pattern_ops serves prefix LIKE under any collation, the
+        # trigram indexes serve the contains filters
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.execute('CREATE INDEX ix_movie_title_lower ON movie '
+                   '(lower(title) text_pattern_ops)')
+        op.execute('CREATE INDEX ix_actor_name_lower ON actor '
+                   '(lower(name) text_pattern_ops)')
+        op.execute('CREATE INDEX ix_movie_title_trgm ON movie '
+                   'USING gin (lower(title) gin_trgm_ops)')
+        op.execute('CREATE INDEX ix_actor_name_trgm ON actor '
+                   'USING gin (lower(name) gin_trgm_ops)')
+    else:
+        op.create_index('ix_movie_title_lower', 'movie', [sa.text('lower(title)')])
+        op.create_index('ix_actor_name_lower', 'actor', [sa.text('lower(name)')])
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_actor_name_trgm', table_name='actor')
+        op.drop_index('ix_movie_title_trgm', table_name='movie')
+    op.drop_index('ix_actor_name_lower', table_name='actor')
+    op.drop_index('ix_movie_title_lower', table_name='movie')
+    op.drop_index('ix_actor_age', table_name='actor')
+    op.drop_index('ix_actor_gender_id', table_name='actor')
+    op.drop_index('ix_actor_name_id', table_name='actor')
+    op.drop_index('ix_movie_release_date_id', table_name='movie')
+    op.drop_index('ix_movie_title_id', table_name='movie')
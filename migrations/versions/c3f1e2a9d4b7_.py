@@ -0,0 +1,35 @@
+"""add table_version
+
+Revision ID: c3f1e2a9d4b7
+Revises: 415760b41c4a
+Create Date: 2026-10-18 09:12:44.318205
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1e2a9d4b7'
+down_revision = '415760b41c4a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table('table_version',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('modified_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_version, [
+        {'table_name': 'actor', 'version': 1, 'modified_at': now},
+        {'table_name': 'movie', 'version': 1, 'modified_at': now}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
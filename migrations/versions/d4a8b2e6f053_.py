@@ -0,0 +1,25 @@
+"""store idempotent response headers
+
+Revision ID: d4a8b2e6f053
+Revises: 7c2e5a9f1d38
+Create Date: 2026-10-18 21:46:03.118529
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8b2e6f053'
+down_revision = '7c2e5a9f1d38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('idempotency_record', sa.Column('headers', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('idempotency_record') as batch_op:
+        batch_op.drop_column('headers')
@@ -0,0 +1,49 @@
+"""add change_log
+
+Revision ID: e61b7d5a2c08
+Revises: a4c9e81f2d60
+Create Date: 2026-10-18 17:40:12.518304
+
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e61b7d5a2c08'
+down_revision = 'a4c9e81f2d60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('seq', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=6), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq')
+    )
+    op.create_index('ix_change_log_table_name_row_id', 'change_log', ['table_name', 'row_id'], unique=False)
+    # Change.log takes its seq under the lock of an existing row; seeding
+    # it means the first writers never race to insert it
+    table_version = sa.table('table_version',
+    sa.column('table_name', sa.String()),
+    sa.column('version', sa.Integer()),
+    sa.column('modified_at', sa.DateTime())
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_version, [
+        {'table_name': 'change_log', 'version': 0, 'modified_at': now},
+        {'table_name': 'change_log_purged', 'version': 0, 'modified_at': now}
+    ])
+
+
+def downgrade():
+    op.execute(
+        "DELETE FROM table_version "
+        "WHERE table_name IN ('change_log', 'change_log_purged')")
+    op.drop_index('ix_change_log_table_name_row_id', table_name='change_log')
+    op.drop_table('change_log')
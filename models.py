@@ -1,26 +1,57 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from datetime import datetime
+from dateutil import parser as date_parser
+from sqlalchemy import (
+    Column, ForeignKey, String, Integer, Index, Table, create_engine, event,
+    func)
+import click
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from dbpool import engine_options
+from routing import (
+    REPLICA_URLS, RoutingSQLAlchemy, RoutingSession, normalize_database_url,
+    router)
+from cache import resource_cache, resource_key
+from slow_queries import slow_query_log
 import json
 
 
 #database_name = "capstoneproject"
 #database_path = "postgresql://{}@{}/{}".format('root:Pp251100', 'localhost:5432', database_name)
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
+def database_url():
+    # read when an app is set up, not on import
+    return normalize_database_url(os.environ['DATABASE_URL'])
 
-def setup_db(app, database_path=database_path):
+
+def setup_db(app, database_path=None):
+    '''
+    Configures the app's database. Nothing connects here: the engine and
+    its pool are created by the first query.
+    '''
+    if database_path is None:
+        database_path = app.config.get('SQLALCHEMY_DATABASE_URI') or \
+            database_url()
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    router.init_app(
+        app, db, app.config.get('DATABASE_REPLICA_URLS', REPLICA_URLS))
+    slow_query_log.init_app(app)
     db.app = app
     db.init_app(app)
-    migrate = Migrate(app, db)
+    setup_migrations(app)
+
+
+def setup_migrations(app):
+    # only `flask db` needs Flask-Migrate, and importing it loads all of
+    # Alembic, so apps created outside the flask command skip it
+    if click.get_current_context(silent=True) is None:
+        return
+    from flask_migrate import Migrate
+    Migrate(app, db)
 
 
 def db_drop_and_create_all():
@@ -41,28 +72,315 @@ def db_drop_and_create_all():
     movie.create()
 
 
+# Validation helpers for request bodies that skip the single-row endpoints,
+# where the database itself rejects bad values
+
+def clean_string(data, key):
+    value = data.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f'{key} must be a non-empty string')
+    return value
+
+
+def clean_integer(data, key):
+    value = data.get(key)
+    if value is None:
+        return None
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f'{key} must be an integer')
+    return value
+
+
+def clean_datetime(data, key):
+    value = data.get(key)
+    if isinstance(value, datetime):
+        return value
+    try:
+        return date_parser.parse(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f'{key} must be a date')
+
+
+class TableVersion(db.Model):
+    '''
+    Change counter per table, bumped in the same transaction as every write
+    to that table. Drives the ETag and Last-Modified of the list endpoints.
+    '''
+    __tablename__ = 'table_version'
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    modified_at = Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def current(cls, table_name):
+        row = db.session.query(cls.version, cls.modified_at) \
+            .filter(cls.table_name == table_name).one_or_none()
+        return row if row is not None else (0, None)
+
+    @classmethod
+    def bump(cls, table_name, count=1):
+        now = datetime.utcnow()
+        updated = db.session.query(cls) \
+            .filter(cls.table_name == table_name) \
+            .update({cls.version: cls.version + count, cls.modified_at: now},
+                    synchronize_session=False)
+        if not updated:
+            db.session.add(
+                cls(table_name=table_name, version=count, modified_at=now))
+
+
+class IdempotencyRecord(db.Model):
+    '''
+    The stored response of a POST or PATCH sent with an Idempotency-Key.
+    status is NULL while the first request is still running, and the claim
+    expires after a short lease in case that request never completes.
+    '''
+    __tablename__ = 'idempotency_record'
+
+    key = Column(String(64), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status = Column(Integer)
+    body = Column(db.LargeBinary)
+    mimetype = Column(String)
+    # JSON list of [name, value] pairs
+    headers = Column(db.Text)
+    expires_at = Column(db.DateTime, nullable=False, index=True)
+
+
+class Job(db.Model):
+    '''
+    A queued background job. Workers claim a job by moving it to running
+    with a lease; a job whose lease runs out (its worker died) can be
+    claimed again.
+    '''
+    __tablename__ = 'job'
+
+    id = Column(String(32), primary_key=True)
+    kind = Column(String(32), nullable=False)
+    owner = Column(String, nullable=False, index=True)
+    status = Column(String(10), nullable=False)
+    params = Column(db.Text, nullable=False)
+    result_mimetype = Column(String)
+    error = Column(db.Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    run_after = Column(db.DateTime, nullable=False)
+    locked_by = Column(String)
+    locked_until = Column(db.DateTime)
+    created_at = Column(db.DateTime, nullable=False)
+    finished_at = Column(db.DateTime)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+
+Index('ix_job_status_run_after', Job.status, Job.run_after)
+
+
+class JobResultChunk(db.Model):
+    '''
+    One piece of a finished job's result. A result is written and read a
+    chunk at a time, so a large export never sits in memory whole.
+    '''
+    __tablename__ = 'job_result_chunk'
+
+    job_id = Column(
+        String(32), ForeignKey('job.id', ondelete='CASCADE'),
+        primary_key=True)
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    data = Column(db.LargeBinary, nullable=False)
+
+
+def queue_event(event):
+    '''
+    Queues an event for the push channel. Events go out when the current
+    transaction commits and are dropped if it rolls back.
+    '''
+    db.session.info.setdefault('pending_events', []).append(event)
+
+
+class Change(db.Model):
+    '''
+    Append-only log of the rows created, updated and deleted in Movie and
+    Actor, read by GET /changes. seq comes from the change_log row of
+    table_version, so sequence numbers are handed out in commit order and
+    a reader never passes a change that commits later with a lower seq.
+    '''
+    __tablename__ = 'change_log'
+
+    # table_version rows holding the last seq handed out and the last seq
+    # removed by retention
+    SEQUENCE = 'change_log'
+    PURGED = 'change_log_purged'
+
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    op = Column(String(6), nullable=False)
+    changed_at = Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def log(cls, table_name, ids, op):
+        '''
+        Appends one entry per id. The table_version update holds a row
+        lock until commit, which is what keeps seq in commit order.
+        '''
+        TableVersion.bump(cls.SEQUENCE, len(ids))
+        last = TableVersion.current(cls.SEQUENCE)[0]
+        now = datetime.utcnow()
+        db.session.bulk_insert_mappings(cls, [
+            {'seq': seq, 'table_name': table_name, 'row_id': row_id,
+             'op': op, 'changed_at': now}
+            for seq, row_id in enumerate(ids, last - len(ids) + 1)
+        ])
+        db.session.info['change_log_seq'] = last
+        for seq, row_id in enumerate(ids, last - len(ids) + 1):
+            queue_event({
+                'seq': seq, 'table': table_name, 'id': row_id, 'op': op})
+
+
+Index('ix_change_log_table_name_row_id', Change.table_name, Change.row_id)
+
+
+# Every write to Movie or Actor goes through record_change, inside the
+# transaction making it. op is 'create', 'update' or 'delete'; writes
+# without ids (casting) only move the table version.
+
+def record_change(model, ids=(), op='update'):
+    TableVersion.bump(model.__tablename__)
+    ids = list(ids)
+    if ids:
+        Change.log(model.__tablename__, ids, op)
+    stale = db.session.info.setdefault('stale_cache_keys', set())
+    stale.update(resource_key(model.__tablename__, row_id) for row_id in ids)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def drop_stale_cache_entries(session):
+    stale = session.info.pop('stale_cache_keys', None)
+    if stale:
+        resource_cache.delete_many(stale)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def drop_pending_notifications(session):
+    session.info.pop('stale_cache_keys', None)
+    session.info.pop('change_log_seq', None)
+    session.info.pop('pending_events', None)
+
+
+# Who is cast in what. Rows go with either side when it is deleted.
+
+casting = Table(
+    'casting', db.Model.metadata,
+    Column('movie_id', Integer,
+           ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actor.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_casting_actor_id', 'actor_id')
+)
+
+
 class Movie(db.Model):
     __tablename__ = 'movie'
 
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
     release_date = Column(db.DateTime, nullable=False)
+    actors = db.relationship(
+        'Actor', secondary=casting, order_by='Actor.id',
+        backref=db.backref('movies', order_by='Movie.id'))
+
+    # column name -> key used for it by format()
+    response_keys = {
+        'id': 'id',
+        'title': 'title',
+        'release_date': 'release date'
+    }
+    # query argument -> (column, comparison) accepted by the list endpoint
+    filter_params = {
+        'title_prefix': ('title', 'prefix'),
+        'title_contains': ('title', 'contains'),
+        'release_date_from': ('release_date', 'min'),
+        'release_date_to': ('release_date', 'max')
+    }
+    sort_keys = ('id', 'title', 'release_date')
+    # relations that ?include= can embed in list responses
+    includes = ('actors',)
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    @classmethod
+    def validate(cls, data, partial=False):
+        values = {}
+        if not partial or 'title' in data:
+            values['title'] = clean_string(data, 'title')
+        if not partial or 'release_date' in data:
+            values['release_date'] = clean_datetime(data, 'release_date')
+        return values
+
     def create(self):
         db.session.add(self)
+        db.session.flush()
+        record_change(type(self), [self.id], 'create')
         db.session.commit()
 
     def update(self):
+        record_change(type(self), [self.id])
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        record_change(type(self), [self.id], 'delete')
+        # its casting rows go too, which changes the other side's lists
+        record_change(Actor)
+        db.session.commit()
+
+    def cast(self, actor):
+        if actor not in self.actors:
+            self.actors.append(actor)
+            record_change(Movie)
+            record_change(Actor)
+            queue_event({
+                'table': 'casting', 'op': 'create',
+                'movie_id': self.id, 'actor_id': actor.id})
         db.session.commit()
 
+    def uncast(self, actor):
+        self.actors.remove(actor)
+        record_change(Movie)
+        record_change(Actor)
+        queue_event({
+            'table': 'casting', 'op': 'delete',
+            'movie_id': self.id, 'actor_id': actor.id})
+        db.session.commit()
+
+    @classmethod
+    def lookup(cls, row_id):
+        '''
+        format() of the row with this id, read as a plain column tuple.
+        '''
+        columns = [getattr(cls, name) for name in cls.response_keys]
+        row = db.session.query(*columns).filter(cls.id == row_id) \
+            .one_or_none()
+        if row is None:
+            return None
+        return dict(zip(cls.response_keys.values(), row))
+
     def format(self):
         return {
 
@@ -80,22 +398,70 @@ class Actor(db.Model):
     age = Column(Integer)
     gender = Column(String, nullable=False)
 
+    # column name -> key used for it by format()
+    response_keys = {
+        'id': 'id',
+        'name': 'name',
+        'age': 'age',
+        'gender': 'gender'
+    }
+    # query argument -> (column, comparison) accepted by the list endpoint
+    filter_params = {
+        'name_prefix': ('name', 'prefix'),
+        'name_contains': ('name', 'contains'),
+        'age_min': ('age', 'min'),
+        'age_max': ('age', 'max'),
+        'gender': ('gender', 'exact')
+    }
+    sort_keys = ('id', 'name', 'gender')
+    # relations that ?include= can embed in list responses
+    includes = ('movies',)
+
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    @classmethod
+    def validate(cls, data, partial=False):
+        values = {}
+        if not partial or 'name' in data:
+            values['name'] = clean_string(data, 'name')
+        if not partial or 'age' in data:
+            values['age'] = clean_integer(data, 'age')
+        if not partial or 'gender' in data:
+            values['gender'] = clean_string(data, 'gender')
+        return values
+
     def create(self):
         db.session.add(self)
+        db.session.flush()
+        record_change(type(self), [self.id], 'create')
         db.session.commit()
 
     def update(self):
+        record_change(type(self), [self.id])
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        record_change(type(self), [self.id], 'delete')
+        # its casting rows go too, which changes the other side's lists
+        record_change(Movie)
         db.session.commit()
 
+    @classmethod
+    def lookup(cls, row_id):
+        '''
+        format() of the row with this id, read as a plain column tuple.
+        '''
+        columns = [getattr(cls, name) for name in cls.response_keys]
+        row = db.session.query(*columns).filter(cls.id == row_id) \
+            .one_or_none()
+        if row is None:
+            return None
+        return dict(zip(cls.response_keys.values(), row))
+
     def format(self):
         return {
 
@@ -103,4 +469,26 @@ class Actor(db.Model):
             'name': self.name,
             'age': self.age,
             'gender': self.gender
-        }
\ No newline at end of file
+        }
+
+
+def delete_castings(model, ids):
+    '''
+    Removes the casting rows of the given movies or actors, for bulk
+    deletes that bypass the ORM relationship.
+    '''
+    column = casting.c.movie_id if model is Movie else casting.c.actor_id
+    db.session.execute(casting.delete().where(column.in_(ids)))
+    record_change(Actor if model is Movie else Movie)
+
+
+# Indexes behind the list filters and sort orders. The Postgres-only
+# text_pattern_ops and trigram variants are created by the migration.
+
+Index('ix_movie_title_id', Movie.title, Movie.id)
+Index('ix_movie_release_date_id', Movie.release_date, Movie.id)
+Index('ix_movie_title_lower', func.lower(Movie.title))
+Index('ix_actor_name_id', Actor.name, Actor.id)
+Index('ix_actor_gender_id', Actor.gender, Actor.id)
+Index('ix_actor_age', Actor.age)
+Index('ix_actor_name_lower', func.lower(Actor.name))
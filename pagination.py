@@ -0,0 +1,140 @@
+import base64
+import json
+import os
+from datetime import datetime
+from flask import abort
+from sqlalchemy import and_, or_
+from models import db
+from serializers import rows_to_dicts
+
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+
+
+# Cursors
+
+def encode_cursor(last_id, sort='id', value=None):
+    position = {'id': last_id}
+    if sort != 'id':
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        position.update({'sort': sort, 'value': value})
+    raw = json.dumps(position, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    The position a cursor points at: the last id, and for pages sorted by
+    another column the sort it was issued for and that column's value.
+    '''
+    padded = cursor + '=' * (-len(cursor) % 4)
+    position = json.loads(base64.urlsafe_b64decode(padded))
+    if not isinstance(position['id'], int):
+        raise ValueError('cursor id must be an integer')
+    position.setdefault('sort', 'id')
+    position.setdefault('value', None)
+    return position
+
+
+def split_sort(sort):
+    if sort.startswith('-'):
+        return sort[1:], True
+    return sort, False
+
+
+# Query arguments
+
+def parse_fields(args, model):
+    '''
+    Column names requested through ?fields=, defaulting to every column
+    format() returns. Unknown names are rejected rather than ignored.
+    '''
+    columns = list(model.response_keys)
+    if not args.get('fields'):
+        return columns
+    fields = [name.strip() for name in args['fields'].split(',')]
+    if any(name not in columns for name in fields):
+        abort(400)
+    return [name for name in columns if name in fields]
+
+
+def parse_sort(args, model):
+    '''
+    ?sort=column or ?sort=-column for descending, limited to the model's
+    sort_keys (non-nullable columns, so keyset positions are well defined).
+    '''
+    sort = args.get('sort', 'id')
+    if split_sort(sort)[0] not in model.sort_keys:
+        abort(400)
+    return sort
+
+
+def parse_page_args(args, model):
+    sort = parse_sort(args, model)
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        after = args.get('after')
+        if after is not None:
+            after = decode_cursor(after)
+            if after['sort'] != sort:
+                raise ValueError('cursor was issued for another sort order')
+            column = getattr(model, split_sort(sort)[0])
+            if after['value'] is not None and \
+                    column.type.python_type is datetime:
+                after['value'] = datetime.fromisoformat(after['value'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        abort(400)
+    if limit < 1:
+        abort(400)
+    return min(limit, MAX_PAGE_SIZE), after, parse_fields(args, model), sort
+
+
+# Keyset pages
+
+def sort_order(model, sort):
+    name, descending = split_sort(sort)
+    column = getattr(model, name)
+    order = [column, model.id] if column is not model.id else [model.id]
+    if descending:
+        order = [clause.desc() for clause in order]
+    return order
+
+
+def after_position(model, column, descending, after):
+    if column is model.id:
+        return model.id < after['id'] if descending else model.id > after['id']
+    if descending:
+        return or_(column < after['value'],
+                   and_(column == after['value'], model.id < after['id']))
+    return or_(column > after['value'],
+               and_(column == after['value'], model.id > after['id']))
+
+
+def keyset_page(model, limit, after=None, fields=None, criteria=(), sort='id'):
+    '''
+    One page of rows matching criteria, ordered by the sort column and then
+    id, starting after the cursor position. Only the requested columns are
+    selected. Returns the formatted rows and the cursor for the next page,
+    or None on the last page.
+    '''
+    if fields is None:
+        fields = list(model.response_keys)
+    name, descending = split_sort(sort)
+    column = getattr(model, name)
+
+    query = db.session.query(
+        model.id, column, *[getattr(model, field) for field in fields]) \
+        .filter(*criteria)
+    if after is not None:
+        query = query.filter(after_position(model, column, descending, after))
+    rows = query.order_by(*sort_order(model, sort)).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0], sort, rows[-1][1])
+
+    keys = [model.response_keys[field] for field in fields]
+    return rows_to_dicts(keys, (row[2:] for row in rows)), next_cursor
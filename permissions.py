@@ -0,0 +1,91 @@
+# Every permission the API knows, in bit order. A permission first named by
+# a route is given the next free bit.
+
+PERMISSIONS = (
+    'get:actors',
+    'get:movies',
+    'post:actors',
+    'post:movies',
+    'patch:actors',
+    'patch:movies',
+    'delete:actors',
+    'delete:movies',
+    'get:diagnostics',
+    'get:changes'
+)
+
+# The Auth0 roles described in the README
+ROLES = {
+    'Casting Assistant': (
+        'get:actors', 'get:movies', 'post:actors', 'delete:actors',
+        'patch:actors', 'patch:movies'),
+    'Casting Director': ('get:actors', 'get:movies'),
+    'Executive Producer': PERMISSIONS
+}
+
+
+class PermissionRegistry:
+    '''
+    Maps permission names to bits, so a token's permissions compile once
+    into an int and each route check is a single mask test. Routes register
+    their permission when requires_auth decorates them; compile() then
+    records which URL rule needs what.
+    '''
+
+    def __init__(self, permissions=PERMISSIONS, roles=ROLES):
+        self.bits = {}
+        for permission in permissions:
+            self.bit(permission)
+        self.roles = {name: self.mask(granted) for name, granted in roles.items()}
+        self.routes = []
+
+    def bit(self, permission):
+        if permission not in self.bits:
+            self.bits[permission] = 1 << len(self.bits)
+        return self.bits[permission]
+
+    def mask(self, permissions):
+        # permissions no route asks for have no bit and are left out
+        mask = 0
+        for permission in permissions:
+            mask |= self.bits.get(permission, 0)
+        return mask
+
+    def names(self, mask):
+        return [name for name, bit in self.bits.items() if mask & bit]
+
+    def role_names(self, mask):
+        return [name for name, role in self.roles.items()
+                if role and role & mask == role]
+
+    def compile(self, app):
+        '''
+        Route -> permission table of app, read from the views requires_auth
+        has marked. Views without a permission are listed as public, and
+        views needing any valid token with an empty permission.
+        '''
+        routes = []
+        for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+            view = app.view_functions[rule.endpoint]
+            permission = getattr(view, 'required_permission', None)
+            required = self.bit(permission) if permission else 0
+            routes.append({
+                'rule': rule.rule,
+                'methods': sorted(rule.methods - {'HEAD', 'OPTIONS'}),
+                'permission': permission,
+                'roles': [name for name, role in self.roles.items()
+                          if role & required == required]
+            })
+        self.routes = routes
+        return routes
+
+    def describe(self):
+        return {
+            'permissions': list(self.bits),
+            'roles': {name: self.names(mask)
+                      for name, mask in self.roles.items()},
+            'routes': self.routes
+        }
+
+
+permission_registry = PermissionRegistry()
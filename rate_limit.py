@@ -0,0 +1,265 @@
+import math
+import os
+import threading
+import time
+from flask import abort, g, request
+from prometheus_client import Counter
+from cache import CACHE_KEY_PREFIX, CACHE_URL
+from dbpool import env_flag
+from routing import client_key
+
+
+RATE_LIMIT = env_flag('RATE_LIMIT', True)
+# requests per client for any permission without its own budget
+RATE_LIMIT_DEFAULT = os.environ.get('RATE_LIMIT_DEFAULT', '1200/minute')
+# per-permission budgets, e.g. "get:actors=600/minute,post:actors=60/minute"
+RATE_LIMITS = os.environ.get('RATE_LIMITS', '')
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_URL = os.environ.get('RATE_LIMIT_URL', CACHE_URL)
+# 0 turns each load-shedding signal off
+LOAD_SHED_MAX_IN_FLIGHT = int(os.environ.get('LOAD_SHED_MAX_IN_FLIGHT', 0))
+LOAD_SHED_POOL_WAIT_MS = float(os.environ.get('LOAD_SHED_POOL_WAIT_MS', 0))
+LOAD_SHED_RETRY_AFTER = 1
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+# requests that are never limited or shed, so the API can be watched
+EXEMPT_ENDPOINTS = {'metrics', 'static'}
+
+REJECTED = Counter(
+    'capstone_rejected_requests_total',
+    'Requests turned away by the rate limiter or by load shedding',
+    ['reason'])
+
+
+class Rate:
+    '''
+    count requests per period: a bucket of count tokens refilled at
+    count / period tokens a second, so a client may burst up to count.
+    '''
+
+    def __init__(self, count, period):
+        self.count = count
+        self.period = period
+        self.per_second = count / period
+
+    @classmethod
+    def parse(cls, value):
+        try:
+            count, period = value.strip().split('/')
+            return cls(int(count), PERIODS[period.strip().rstrip('s')])
+        except (KeyError, ValueError):
+            raise ValueError(f'invalid rate {value!r}, expected e.g. 60/minute')
+
+    def __repr__(self):
+        return f'Rate({self.count}, {self.period})'
+
+
+def parse_rates(value):
+    rates = {}
+    for entry in value.split(','):
+        if entry.strip():
+            permission, rate = entry.split('=', 1)
+            rates[permission.strip()] = Rate.parse(rate)
+    return rates
+
+
+# Buckets take one token for key if there is one. They return 0 when the
+# request may go ahead, or the seconds until the next token otherwise.
+
+class MemoryBuckets:
+    '''
+    Token buckets of this worker only, so each worker allows the full rate.
+    '''
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate):
+        now = self.clock()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (rate.count, now, 0))
+            tokens = min(rate.count, tokens + (now - updated) * rate.per_second)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now, rate.period)
+                self._prune(now)
+                return 0
+            self._buckets[key] = (tokens, now, rate.period)
+            return (1 - tokens) / rate.per_second
+
+    def _prune(self, now):
+        # a bucket idle for a whole period is full again and can go
+        if len(self._buckets) > 10000:
+            self._buckets = {
+                key: entry for key, entry in self._buckets.items()
+                if now - entry[1] < entry[2]}
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# KEYS[1] bucket, ARGV: capacity, tokens per second, now, ttl
+TAKE_SCRIPT = '''
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return tostring(wait)
+'''
+
+
+class RedisBuckets:
+    '''
+    Token buckets shared by every worker and dyno through any client
+    speaking the redis-py API. Each take is one atomic script call. Like
+    the cache, an unreachable Redis lets requests through.
+    '''
+
+    def __init__(self, client, prefix=CACHE_KEY_PREFIX + 'rate:',
+                 clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+        self.errors = 0
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def take(self, key, rate):
+        try:
+            return float(self._take(
+                keys=[self.prefix + key],
+                args=[rate.count, rate.per_second, self.clock(),
+                      int(rate.period) + 1]))
+        except Exception:
+            self.errors += 1
+            return 0
+
+    def clear(self):
+        pass
+
+
+def create_buckets(name=RATE_LIMIT_BACKEND, url=RATE_LIMIT_URL):
+    if name == 'redis':
+        # optional dependency, only needed when the buckets are shared
+        import redis
+        return RedisBuckets(redis.Redis.from_url(url))
+    return MemoryBuckets()
+
+
+class RateLimiter:
+    '''
+    Per-client budgets, keyed on the token's sub (the client's address
+    when there is none) and the permission of the route, so a client
+    exhausting one permission's budget can still use the others. Routes
+    without a permission share the default budget per address.
+    '''
+
+    def __init__(self, buckets=None, default=RATE_LIMIT_DEFAULT,
+                 rates=RATE_LIMITS, enabled=RATE_LIMIT):
+        self.buckets = create_buckets() if buckets is None else buckets
+        self.default = Rate.parse(default)
+        self.rates = parse_rates(rates)
+        self.enabled = enabled
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATE_LIMIT', RATE_LIMIT)
+        self.default = Rate.parse(
+            app.config.get('RATE_LIMIT_DEFAULT', RATE_LIMIT_DEFAULT))
+        self.rates = parse_rates(app.config.get('RATE_LIMITS', RATE_LIMITS))
+
+        @app.before_request
+        def limit_public_routes():
+            view = app.view_functions.get(request.endpoint)
+            if view is not None and request.endpoint not in EXEMPT_ENDPOINTS \
+                    and getattr(view, 'required_permission', None) is None:
+                self.limit('')
+
+    def rate(self, permission):
+        return self.rates.get(permission, self.default)
+
+    def limit(self, permission):
+        '''
+        Takes a token from the caller's bucket for permission, or aborts
+        with 429 and the seconds until the next token in Retry-After.
+        '''
+        if not self.enabled or request.method == 'OPTIONS':
+            return
+        wait = self.buckets.take(
+            f'{client_key()}:{permission}', self.rate(permission))
+        if wait:
+            REJECTED.labels('rate_limited').inc()
+            abort(429, retry_after=max(1, math.ceil(wait)))
+
+
+class LoadShedder:
+    '''
+    Turns requests away with 503 before any work is done while this worker
+    has more than max_in_flight requests running or the average wait for
+    a pooled connection is above max_pool_wait_ms, so an overloaded
+    worker sheds load quickly instead of queueing it until clients time
+    out.
+    '''
+
+    def __init__(self, max_in_flight=LOAD_SHED_MAX_IN_FLIGHT,
+                 max_pool_wait_ms=LOAD_SHED_POOL_WAIT_MS, pool_wait=None):
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait_ms = max_pool_wait_ms
+        self.pool_wait = pool_wait
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db):
+        self.max_in_flight = int(app.config.get(
+            'LOAD_SHED_MAX_IN_FLIGHT', LOAD_SHED_MAX_IN_FLIGHT))
+        self.max_pool_wait_ms = float(app.config.get(
+            'LOAD_SHED_POOL_WAIT_MS', LOAD_SHED_POOL_WAIT_MS))
+        if self.pool_wait is None:
+            self.pool_wait = lambda: engine_recent_wait(db.engine)
+
+        @app.before_request
+        def shed_load():
+            if request.endpoint in EXEMPT_ENDPOINTS:
+                return
+            with self._lock:
+                self.in_flight += 1
+            g.counted_in_flight = True
+            reason = self.overloaded()
+            if reason:
+                REJECTED.labels(reason).inc()
+                abort(503, retry_after=LOAD_SHED_RETRY_AFTER)
+
+        @app.teardown_request
+        def finish_request(exception):
+            if g.pop('counted_in_flight', False):
+                with self._lock:
+                    self.in_flight -= 1
+
+    def overloaded(self):
+        # the request asking counts itself
+        if self.max_in_flight and self.in_flight > self.max_in_flight:
+            return 'in_flight'
+        if self.max_pool_wait_ms and \
+                self.pool_wait() * 1000 > self.max_pool_wait_ms:
+            return 'pool_wait'
+        return None
+
+
+def engine_recent_wait(engine):
+    stats = getattr(engine.pool, 'stats', None)
+    return stats.recent_wait() if stats is not None else 0.0
+
+
+rate_limiter = RateLimiter()
+load_shedder = LoadShedder()
@@ -0,0 +1,79 @@
+from flask import abort
+from sqlalchemy.orm import load_only, selectinload
+from auth import check_granted
+from models import db, casting, Movie, Actor
+from permissions import permission_registry
+
+
+def related_model(model, name):
+    return getattr(model, name).property.mapper.class_
+
+
+def parse_include(args, model, granted):
+    '''
+    Relation names requested through ?include=, limited to model.includes.
+    Embedding a relation needs the permission to list it (get:actors for
+    actors), so ?include= cannot read around the per-resource permissions.
+    '''
+    if not args.get('include'):
+        return []
+    include = [name.strip() for name in args['include'].split(',')]
+    if any(name not in model.includes for name in include):
+        abort(400)
+    for name in include:
+        check_granted(granted, permission_registry.bit(f'get:{name}'))
+    return [name for name in model.includes if name in include]
+
+
+def included_tables(model, args, granted):
+    '''
+    Tables whose rows end up in a list response of model, besides its own.
+    '''
+    return [
+        related_model(model, name).__tablename__
+        for name in parse_include(args, model, granted)
+    ]
+
+
+def embed_related(model, items, include):
+    '''
+    Adds the formatted related rows named in include to each item of a
+    page. Every relation is loaded for the whole page with one selectinload
+    query, so the cost does not grow with the page size.
+    '''
+    if not include or not items:
+        return items
+    options = [
+        selectinload(getattr(model, name))
+        .load_only(*related_model(model, name).response_keys)
+        for name in include
+    ]
+    parents = db.session.query(model) \
+        .options(load_only('id'), *options) \
+        .filter(model.id.in_([item['id'] for item in items]))
+    related = {
+        parent.id: {
+            name: [row.format() for row in getattr(parent, name)]
+            for name in include
+        }
+        for parent in parents
+    }
+    for item in items:
+        # a row deleted since the page was read has nothing to embed
+        item.update(related.get(item['id'], {name: [] for name in include}))
+    return items
+
+
+# Criteria for the nested lists, read off the casting primary key and its
+# actor_id index without joining the other side
+
+def in_cast_of(movie_id):
+    return Actor.id.in_(
+        db.session.query(casting.c.actor_id)
+        .filter(casting.c.movie_id == movie_id))
+
+
+def in_films_of(actor_id):
+    return Movie.id.in_(
+        db.session.query(casting.c.movie_id)
+        .filter(casting.c.actor_id == actor_id))
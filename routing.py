@@ -0,0 +1,193 @@
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context, request, _request_ctx_stack
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, text
+from sqlalchemy.orm import sessionmaker
+from dbpool import name_pool
+
+
+def normalize_database_url(url):
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+REPLICA_URLS = [
+    normalize_database_url(url.strip())
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url.strip()
+]
+# seconds a client keeps reading from the primary after its own write
+READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+# seconds a failed replica is left out of rotation before it is rechecked
+REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+
+READ_PRIMARY_COOKIE = 'read_primary_until'
+REPLICA_BIND_PREFIX = 'replica_'
+
+
+def client_key():
+    user = getattr(_request_ctx_stack.top, 'current_user', None) or {}
+    return user.get('sub') or request.remote_addr
+
+
+class ReplicaRouter:
+    '''
+    Round-robin choice of read replica for read-only requests.
+
+    A replica whose connection fails is taken out of rotation for
+    REPLICA_RETRY_SECONDS and must answer a SELECT 1 before it is used
+    again. Clients that wrote within READ_YOUR_WRITES_SECONDS keep reading
+    from the primary, tracked per worker and through a cookie so the next
+    worker honours it too.
+    '''
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.bind_keys = []
+        self.read_your_writes = READ_YOUR_WRITES_SECONDS
+        self.retry_after = REPLICA_RETRY_SECONDS
+        self._rotation = itertools.count()
+        self._down_until = {}
+        self._recent_writes = {}
+        self._watched = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, replica_urls):
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {}) or {}
+        self.bind_keys = []
+        for index, url in enumerate(replica_urls):
+            key = f'{REPLICA_BIND_PREFIX}{index}'
+            binds[key] = normalize_database_url(url)
+            self.bind_keys.append(key)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        self.read_your_writes = app.config.get(
+            'READ_YOUR_WRITES_SECONDS', READ_YOUR_WRITES_SECONDS)
+        self.db = db
+
+        @app.after_request
+        def remember_writes(response):
+            if request.method in ('GET', 'HEAD', 'OPTIONS') or \
+                    response.status_code >= 400:
+                return response
+            until = self.clock() + self.read_your_writes
+            with self._lock:
+                self._recent_writes[client_key()] = until
+                self._prune()
+            response.set_cookie(
+                READ_PRIMARY_COOKIE, str(int(until) + 1),
+                max_age=int(self.read_your_writes) + 1, httponly=True)
+            return response
+
+    # Read-your-writes
+
+    def wrote_recently(self):
+        now = self.clock()
+        try:
+            if float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > now:
+                return True
+        except ValueError:
+            pass
+        return self._recent_writes.get(client_key(), 0) > now
+
+    def _prune(self):
+        if len(self._recent_writes) > 10000:
+            now = self.clock()
+            self._recent_writes = {
+                key: until for key, until in self._recent_writes.items()
+                if until > now
+            }
+
+    # Replica selection
+
+    def use_replica(self):
+        return bool(self.bind_keys) and has_request_context() and \
+            g.get('db_read_only', False) and not self.wrote_recently()
+
+    def choose(self, app):
+        for _ in range(len(self.bind_keys)):
+            key = self.bind_keys[next(self._rotation) % len(self.bind_keys)]
+            engine = self.db.get_engine(app, bind=key)
+            self._watch(key, engine)
+            down_until = self._down_until.get(key)
+            if down_until is None:
+                return engine
+            if down_until <= self.clock() and self.check(key, engine):
+                return engine
+        return None
+
+    def check(self, key, engine):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except Exception:
+            self.mark_down(key)
+            return False
+        self._down_until.pop(key, None)
+        return True
+
+    def mark_down(self, key):
+        self._down_until[key] = self.clock() + self.retry_after
+
+    def _watch(self, key, engine):
+        if id(engine) in self._watched:
+            return
+        self._watched.add(id(engine))
+
+        @event.listens_for(engine, 'handle_error')
+        def on_error(context):
+            if context.is_disconnect or context.connection is None:
+                self.mark_down(key)
+
+    def status(self):
+        now = self.clock()
+        return {
+            key: 'down' if self._down_until.get(key, 0) > now else 'up'
+            for key in self.bind_keys
+        }
+
+
+router = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Sends the queries of read-only requests to one replica for the whole
+    request; flushes and every other request use the primary.
+    '''
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and router.use_replica():
+            if self._replica is None:
+                self._replica = router.choose(self.app) or False
+            if self._replica:
+                return self._replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        return name_pool(super().create_engine(sa_url, engine_opts))
+
+
+def read_only(f):
+    '''
+    Marks a view as safe to serve from a read replica.
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,101 @@
+import os
+from datetime import date, datetime
+from functools import lru_cache
+from flask import current_app, json, jsonify
+from werkzeug.http import http_date
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# auto uses orjson when it is installed, stdlib forces Flask's own encoder
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+
+
+# release dates repeat a lot across rows, and http_date dominates the
+# encoding time once orjson does the rest
+@lru_cache(maxsize=4096)
+def format_http_date(value):
+    if isinstance(value, datetime):
+        return http_date(value.utctimetuple())
+    return http_date(value.timetuple())
+
+
+def encode_default(o):
+    # the conversions Flask's JSONEncoder applies to the values we return
+    if isinstance(o, date):
+        return format_http_date(o)
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+def rows_to_dicts(keys, rows):
+    '''
+    Response dicts built straight from column tuples, so list queries never
+    hydrate ORM objects.
+    '''
+    return [dict(zip(keys, row)) for row in rows]
+
+
+class StdlibSerializer:
+    '''
+    Byte for byte what jsonify produces outside debug mode: compact
+    separators, sorted keys, non-ASCII escaped.
+    '''
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(',', ':')).encode()
+
+
+class OrjsonSerializer:
+    '''
+    orjson with the same output as StdlibSerializer. orjson writes
+    non-ASCII characters and DEL unescaped, so the rare body holding them
+    is re-encoded by the stdlib encoder to stay byte-compatible.
+    '''
+
+    def __init__(self):
+        self.fallback = StdlibSerializer()
+        self.options = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self, data):
+        body = orjson.dumps(data, default=encode_default, option=self.options)
+        if body.isascii() and b'\x7f' not in body:
+            return body
+        return self.fallback.dumps(data)
+
+
+def create_serializer(name=JSON_ENCODER):
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        return OrjsonSerializer()
+    return StdlibSerializer()
+
+
+serializer = create_serializer()
+
+def set_serializer(new_serializer):
+    global serializer
+    serializer = new_serializer
+
+
+def dumps(data):
+    return serializer.dumps(data)
+
+
+def json_response(data, status=200):
+    '''
+    Drop-in for jsonify(data), status on the list and lookup endpoints.
+    Pretty-printed responses (debug mode) still go through jsonify.
+    '''
+    with timed('serialize'):
+        if current_app.debug or \
+                current_app.config['JSONIFY_PRETTYPRINT_REGULAR']:
+            response = jsonify(data)
+        else:
+            response = current_app.response_class(
+                serializer.dumps(data) + b'\n',
+                mimetype=current_app.config['JSONIFY_MIMETYPE'])
+    response.status_code = status
+    return response
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from functools import wraps
+from flask import Response, _request_ctx_stack, make_response, request
+from prometheus_client import Counter
+from dbpool import env_flag
+from routing import router
+
+
+SINGLE_FLIGHT = env_flag('SINGLE_FLIGHT', True)
+# milliseconds a finished response keeps answering identical requests,
+# 0 only shares responses that are still being built
+SINGLE_FLIGHT_MICROCACHE_MS = float(
+    os.environ.get('SINGLE_FLIGHT_MICROCACHE_MS', 0))
+SINGLE_FLIGHT_MICROCACHE_SIZE = 1024
+
+FLIGHTS = Counter(
+    'capstone_single_flight_total',
+    'Read requests by whether they ran, joined one in flight or were '
+    'answered from the micro-cache',
+    ['outcome'])
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Runs one call per key at a time within the worker. Callers arriving
+    while it runs wait for it and get its result (or its exception). With
+    a micro-cache window, results keep being handed out for that long
+    after the call finished.
+    '''
+
+    def __init__(self, micro_cache_ms=SINGLE_FLIGHT_MICROCACHE_MS,
+                 clock=time.monotonic):
+        self.micro_cache_ms = micro_cache_ms
+        self.clock = clock
+        self._flights = {}
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, use_recent=True):
+        with self._lock:
+            if use_recent:
+                recent = self._recent.get(key)
+                if recent is not None and recent[0] > self.clock():
+                    FLIGHTS.labels('micro_cache').inc()
+                    return recent[1]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            FLIGHTS.labels('joined').inc()
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        FLIGHTS.labels('ran').inc()
+        try:
+            flight.result = function()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if self.micro_cache_ms and flight.error is None and \
+                        flight.result is not None:
+                    self._remember(key, flight.result)
+            flight.done.set()
+        return flight.result
+
+    def _remember(self, key, result):
+        now = self.clock()
+        if len(self._recent) >= SINGLE_FLIGHT_MICROCACHE_SIZE:
+            self._recent = {k: entry for k, entry in self._recent.items()
+                            if entry[0] > now}
+        if len(self._recent) < SINGLE_FLIGHT_MICROCACHE_SIZE:
+            self._recent[key] = (now + self.micro_cache_ms / 1000, result)
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
+
+
+flights = SingleFlight()
+
+
+def flight_key():
+    # If-None-Match and If-Modified-Since decide between 200 and 304
+    granted = getattr(_request_ctx_stack.top, 'granted_permissions', None)
+    return (
+        request.path, request.query_string, granted,
+        request.headers.get('If-None-Match'),
+        request.headers.get('If-Modified-Since'))
+
+
+def snapshot(response):
+    return (response.status_code, list(response.headers.items()),
+            response.get_data())
+
+
+def single_flight(f):
+    '''
+    Concurrent identical GETs (same path, query, permissions and
+    conditional headers) share one run of the view and its serialized
+    body. Clients reading their own recent writes always run their own,
+    and streamed responses are never shared.
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not SINGLE_FLIGHT or router.wrote_recently():
+            return f(*args, **kwargs)
+
+        own = []
+
+        def run():
+            response = make_response(f(*args, **kwargs))
+            own.append(response)
+            return None if response.is_streamed else snapshot(response)
+
+        shared = flights.do(flight_key(), run)
+        if own:
+            return own[0]
+        if shared is None:
+            return f(*args, **kwargs)
+        status, headers, body = shared
+        return Response(body, status, headers=headers)
+
+    return wrapper
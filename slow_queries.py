@@ -0,0 +1,179 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from flask import has_request_context, request
+from dbpool import env_flag
+from metrics import add_query_listener, route_label
+
+
+# milliseconds, 0 turns the log off
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_EXPLAIN = env_flag('SLOW_QUERY_EXPLAIN')
+# runs the statement a second time, only for SELECTs
+SLOW_QUERY_EXPLAIN_ANALYZE = env_flag('SLOW_QUERY_EXPLAIN_ANALYZE')
+SLOW_QUERY_TOP_N = int(os.environ.get('SLOW_QUERY_TOP_N', 20))
+
+logger = logging.getLogger(__name__)
+
+
+# Normalized SQL: literals and bind placeholders become ?, IN lists
+# collapse to one ?, so one query shape has one fingerprint
+
+PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|\$\d+')
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+VALUE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def normalize_sql(statement):
+    sql = PLACEHOLDER.sub('?', statement)
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = VALUE_LIST.sub('(?)', sql)
+    return ' '.join(sql.split())
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def redact(parameters, executemany=False):
+    '''
+    Bind parameters with every value replaced by its type name, so the log
+    shows the query shape without the data.
+    '''
+    if executemany:
+        return f'<{len(parameters)} rows>'
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters or ()]
+
+
+def explain(conn, statement, parameters, analyze=False):
+    '''
+    The plan of a SELECT, run on the connection that ran it through a
+    plain DBAPI cursor, so it is neither timed nor logged itself. None when
+    the database has no plan to show or EXPLAIN fails.
+    '''
+    if not statement.lstrip().upper().startswith('SELECT'):
+        return None
+    dialect = conn.dialect.name
+    if dialect == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+    elif dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+
+    cursor = conn.connection.cursor()
+    try:
+        # a failed EXPLAIN must not abort the request's transaction
+        if dialect == 'postgresql':
+            cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception:
+            if dialect == 'postgresql':
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return None
+        if dialect == 'postgresql':
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return '\n'.join(row[0] for row in rows)
+        return '\n'.join(row[-1] for row in rows)
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+
+class SlowQueryLog:
+    '''
+    The size slowest statement fingerprints seen by this worker, with how
+    often each was slow, its worst time and the plan behind the worst time.
+    A new fingerprint displaces the entry with the lowest worst time.
+    '''
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, size=SLOW_QUERY_TOP_N,
+                 explain=SLOW_QUERY_EXPLAIN,
+                 explain_analyze=SLOW_QUERY_EXPLAIN_ANALYZE):
+        self.threshold_ms = threshold_ms
+        self.size = size
+        self.explain = explain
+        self.explain_analyze = explain_analyze
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.threshold_ms = float(app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS))
+        self.explain = app.config.get('SLOW_QUERY_EXPLAIN', SLOW_QUERY_EXPLAIN)
+        self.explain_analyze = app.config.get(
+            'SLOW_QUERY_EXPLAIN_ANALYZE', SLOW_QUERY_EXPLAIN_ANALYZE)
+
+    def is_worst(self, key, elapsed_ms):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is None or elapsed_ms > entry['max_ms']
+
+    def record(self, key, sql, elapsed_ms, route, plan=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.size:
+                    fastest = min(
+                        self._entries.values(), key=lambda e: e['max_ms'])
+                    if fastest['max_ms'] >= elapsed_ms:
+                        return
+                    del self._entries[fastest['fingerprint']]
+                entry = self._entries[key] = {
+                    'fingerprint': key,
+                    'sql': sql,
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'plan': None
+                }
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['last_route'] = route
+            entry['last_seen'] = time.time()
+            if elapsed_ms > entry['max_ms']:
+                entry['max_ms'] = elapsed_ms
+                if plan is not None:
+                    entry['plan'] = plan
+
+    def top(self):
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()]
+        return sorted(entries, key=lambda e: e['max_ms'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __call__(self, conn, statement, parameters, executemany, elapsed):
+        elapsed_ms = elapsed * 1000
+        if not self.threshold_ms or elapsed_ms < self.threshold_ms:
+            return
+        sql = normalize_sql(statement)
+        key = fingerprint(sql)
+        route = None
+        if has_request_context():
+            route = f'{request.method} {route_label()}'
+
+        plan = None
+        if self.explain and not executemany and self.is_worst(key, elapsed_ms):
+            plan = explain(conn, statement, parameters, self.explain_analyze)
+
+        logger.warning(
+            'slow query %.1f ms [%s] route=%s sql=%s params=%s%s',
+            elapsed_ms, key, route, sql, redact(parameters, executemany),
+            '\n' + plan if plan else '')
+        self.record(key, sql, elapsed_ms, route, plan)
+
+
+slow_query_log = SlowQueryLog()
+add_query_listener(slow_query_log)
@@ -0,0 +1,128 @@
+import time
+
+# app.py imports this module first, so the report's import phase covers
+# loading the whole app
+IMPORT_STARTED = time.perf_counter()
+
+import gc
+import logging
+import os
+from contextlib import contextmanager
+from prometheus_client import Gauge
+from auth import jwks_cache
+from dbpool import env_flag
+from models import db
+from routing import router
+
+
+# open pooled connections and fetch the JWKS before a worker takes traffic
+WARM_UP = env_flag('WARM_UP', False)
+# connections the warm-up opens per engine; more than DB_POOL_SIZE are
+# closed again rather than pooled
+WARM_UP_CONNECTIONS = int(os.environ.get('WARM_UP_CONNECTIONS', 1))
+
+logger = logging.getLogger(__name__)
+
+STARTUP_SECONDS = Gauge(
+    'capstone_startup_seconds',
+    'Time spent in each startup phase before the worker served requests',
+    ['phase'], multiprocess_mode='liveall')
+
+
+class StartupReport:
+    '''
+    How long each phase between importing the app and serving its first
+    request took in this process. A worker forked from a preloading master
+    inherits the master's import and create_app phases.
+    '''
+
+    def __init__(self, started=IMPORT_STARTED, clock=time.perf_counter):
+        self.started = started
+        self.clock = clock
+        self.phases = {}
+
+    def record(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        STARTUP_SECONDS.labels(name).set(self.phases[name])
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, self.clock() - start)
+
+    def imported(self):
+        # only the first app created in a process paid for the imports
+        if 'import' not in self.phases:
+            self.record('import', self.clock() - self.started)
+
+    def summary(self):
+        total = sum(self.phases.values())
+        return f'started in {total * 1000:.0f}ms (' + ', '.join(
+            f'{name} {seconds * 1000:.0f}ms'
+            for name, seconds in self.phases.items()) + ')'
+
+
+startup_report = StartupReport()
+
+
+def warm_up_pool(app, connections=WARM_UP_CONNECTIONS):
+    '''
+    Opens connections on the primary and every replica engine and returns
+    them to their pools, so the first requests do not wait on connects.
+    '''
+    with app.app_context():
+        engines = [db.get_engine(app)] + [
+            db.get_engine(app, bind=key) for key in router.bind_keys]
+        for engine in engines:
+            opened = [engine.connect() for _ in range(connections)]
+            for connection in opened:
+                connection.close()
+
+
+# a failed warm-up only costs the first requests the wait
+
+def warm_up_jwks():
+    with startup_report.phase('jwks'):
+        try:
+            jwks_cache.warm_up()
+        except Exception:
+            logger.exception('JWKS warm-up failed')
+
+
+def warm_up(app):
+    warm_up_jwks()
+    with startup_report.phase('pool'):
+        try:
+            warm_up_pool(app)
+        except Exception:
+            logger.exception('connection pool warm-up failed')
+
+
+# gunicorn hooks, see gunicorn.conf.py
+
+def preloaded(app):
+    '''
+    Called in the gunicorn master once a preloaded app is built and before
+    any worker is forked.
+    '''
+    if app.config.get('WARM_UP', WARM_UP):
+        # fetched once here, every worker inherits the keys
+        warm_up_jwks()
+    # moves everything allocated so far out of the collector's reach, so
+    # collections in the workers do not write to, and so copy, the pages
+    # they share with the master
+    gc.collect()
+    gc.freeze()
+
+
+def ready(app):
+    '''
+    Called in each worker just before it accepts requests. Returns the
+    startup report's summary.
+    '''
+    if app.config.get('WARM_UP', WARM_UP):
+        warm_up(app)
+    return startup_report.summary()
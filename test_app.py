@@ -1,9 +1,89 @@
 import os
+
+# TEST_GEVENT=1 runs the suite the way async_app serves requests
+if os.environ.get('TEST_GEVENT'):
+    from gevent import monkey
+    monkey.patch_all()
+
+import tempfile
+import time
 import unittest
 import json
+import rsa
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwk, jwt
+from prometheus_client import REGISTRY
 from app import create_app
-from models import setup_db, Actor, Movie
+from models import setup_db, db, record_change, Actor, IdempotencyRecord, Job, JobResultChunk, Movie
+import auth
+from auth import JWKSCache, TokenCache, set_jwks_provider
+from pagination import encode_cursor, decode_cursor
+from dbpool import PoolStats, TimedQueuePool, engine_options, name_pool, pool_metrics
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from cache import MemoryBackend, RedisBackend, set_cache_backend
+from datetime import datetime, timedelta
+from flask import Flask, jsonify, _request_ctx_stack
+import serializers
+import benchmark
+from permissions import PermissionRegistry
+from idempotency import idempotency_key, idempotency_store, request_fingerprint
+from single_flight import SingleFlight
+from compression import Gzip, compressor
+from changes import compact_change_log, notifier, purge_change_log, wait_for_changes
+import events
+from events import Broadcaster, NOTIFY_MAX_BYTES, broadcaster, init_events, notify_payloads
+import dbpool
+import jobs
+import startup
+from jobs import job_runner
+from rate_limit import LoadShedder, MemoryBuckets, Rate, RedisBuckets, load_shedder, rate_limiter
+import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from slow_queries import SlowQueryLog, slow_query_log, normalize_sql, redact
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def make_rsa_key(kid, bits=1024):
+    public_key, private_key = rsa.newkeys(bits)
+    public_jwk = jwk.construct(
+        public_key.save_pkcs1().decode(), 'RS256').to_dict()
+    public_jwk.update({'kid': kid, 'use': 'sig'})
+    return private_key.save_pkcs1().decode(), public_jwk
+
+
+def make_token(private_key, kid, permissions, sub='auth0|test'):
+    return jwt.encode({
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+        'aud': auth.API_AUDIENCE,
+        'sub': sub,
+        'exp': int(time.time()) + 3600,
+        'permissions': permissions
+    }, private_key, algorithm='RS256', headers={'kid': kid})
+
+
+@contextmanager
+def count_queries():
+    '''
+    Collects the SQL statements run on any engine inside the block.
+    '''
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
 
 
 class CapstoneTestCase(unittest.TestCase):
@@ -57,6 +137,7 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource not found')
 
+
 # Test to get movies
     def test_get_movies(self):
         res = self.client().get('/movies', headers=self.executive_producer_header)
@@ -97,6 +178,7 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+
 # Test to post new movie
     def test_post_movies(self):
         new_test_movie = {
@@ -256,6 +338,1411 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
 
 
+class JWKSCacheTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.public_jwk = make_rsa_key('key-1')[1]
+
+    def setUp(self):
+        self.now = 0
+        self.fetches = 0
+        self.fail = False
+        self.cache = JWKSCache(
+            self.provider, ttl=600, min_refresh_interval=30,
+            clock=lambda: self.now, background_refresh=False)
+
+    def provider(self):
+        self.fetches += 1
+        if self.fail:
+            raise OSError('IdP unavailable')
+        return {'keys': [self.public_jwk]}
+
+    def test_keys_are_fetched_once_within_ttl(self):
+        for _ in range(10):
+            self.assertIsNotNone(self.cache.get_key('key-1'))
+        self.assertEqual(self.fetches, 1)
+
+    def test_keys_are_refetched_after_ttl(self):
+        self.cache.get_key('key-1')
+        self.now = 601
+        self.cache.get_key('key-1')
+        self.assertEqual(self.fetches, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.cache.get_key('key-1')
+        self.now = 31
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key('forged'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_expired_keys_are_served_while_refreshing_in_background(self):
+        self.cache.background_refresh = True
+        self.cache.get_key('key-1')
+        self.now = 601
+        self.assertIsNotNone(self.cache.get_key('key-1'))
+        self.cache.refresh_in_background().join()
+        self.assertEqual(self.fetches, 2)
+        self.assertFalse(self.cache._is_stale())
+
+    def test_stale_keys_survive_failed_refetch(self):
+        self.cache.get_key('key-1')
+        self.fail = True
+        self.now = 601
+        self.assertIsNotNone(self.cache.get_key('key-1'))
+        self.assertIsNotNone(self.cache.get_key('key-1'))
+        self.assertEqual(self.fetches, 2)
+
+
+class CursorTestCase(unittest.TestCase):
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(42))['id'], 42)
+
+    def test_cursor_rejects_non_integer_id(self):
+        with self.assertRaises(ValueError):
+            decode_cursor(encode_cursor('42'))
+
+
+class LocalAuthTestCase(unittest.TestCase):
+    '''
+    Signs tokens with a locally generated key served as the JWKS, so the
+    tests need no Auth0 tenant.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_key, public_jwk = make_rsa_key('local-key')
+        cls.saved_provider = auth.jwks_cache.provider
+        set_jwks_provider(lambda: {'keys': [public_jwk]})
+
+    @classmethod
+    def tearDownClass(cls):
+        set_jwks_provider(cls.saved_provider)
+
+    @classmethod
+    def auth_header(cls, permissions, sub='auth0|test'):
+        return {'Authorization': 'Bearer ' + make_token(
+            cls.private_key, 'local-key', permissions, sub)}
+
+
+class ReplicaRoutingTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reader_header, cls.writer_header = [
+            cls.auth_header(['get:actors', 'post:actors'], sub)
+            for sub in ('auth0|reader', 'auth0|writer')
+        ]
+
+        replica_url = 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'replica.db')
+        replica = create_engine(replica_url)
+        db.Model.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Actor.__table__.insert(), {
+                'name': 'Replica Only', 'age': 30, 'gender': 'Female'})
+
+        cls.app = create_app({'DATABASE_REPLICA_URLS': [replica_url]})
+        with cls.app.app_context():
+            db.create_all()
+
+    def names(self, client, header):
+        res = client.get('/actors', headers=header)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_reads_are_served_by_replica(self):
+        self.assertIn('Replica Only', self.names(
+            self.app.test_client(), self.reader_header))
+
+    def test_client_reads_primary_after_own_write(self):
+        client = self.app.test_client()
+        new_test_actor = {"name": "Primary Only", "age": 40, "gender": "Male"}
+        res = client.post('/actors', json=new_test_actor, headers=self.writer_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Primary Only', self.names(client, self.writer_header))
+
+
+class PagingTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+        for name in ("Paged 1", "Paged 2"):
+            new_test_actor = {"name": name, "age": 30, "gender": "Female"}
+            cls.app.test_client().post('/actors', json=new_test_actor, headers=cls.header)
+
+    def test_get_actors_paginated(self):
+        res = self.app.test_client().get('/actors?limit=1&fields=name', headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(list(data['actors'][0]), ['name'])
+        self.assertIn('next_cursor', data)
+
+    def test_400_get_actors_unknown_field(self):
+        res = self.app.test_client().get('/actors?fields=salary', headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_400_get_actors_bad_cursor(self):
+        res = self.app.test_client().get('/actors?after=not-a-cursor', headers=self.header)
+        self.assertEqual(res.status_code, 400)
+
+
+class ExportTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+        for name in ("Exported 1", "Exported 2"):
+            new_test_actor = {"name": name, "age": 30, "gender": "Male"}
+            cls.app.test_client().post('/actors', json=new_test_actor, headers=cls.header)
+
+    def test_export_actors_ndjson(self):
+        res = self.app.test_client().get('/actors?export=ndjson', headers=self.header)
+        lines = res.data.decode().splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(all('id' in json.loads(line) for line in lines))
+
+    def test_400_export_actors_unknown_format(self):
+        res = self.app.test_client().get('/actors?export=xml', headers=self.header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_export_json_matches_paged_shape(self):
+        res = self.app.test_client().get('/actors?export=json&fields=name&name_prefix=exported', headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([actor['name'] for actor in data['actors']], ["Exported 1", "Exported 2"])
+
+
+class BulkTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header([
+            'get:movies', 'post:actors', 'post:movies', 'patch:movies', 'delete:movies'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def test_bulk_post_actors(self):
+        new_test_actors = [
+            {"name": "Majeed", "age": 22, "gender": "Male"},
+            {"name": "Sara", "age": "twenty", "gender": "Female"}
+        ]
+        res = self.app.test_client().post('/actors/bulk', json=new_test_actors, headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['results'][0]['success'], True)
+        self.assertEqual(data['results'][1]['error'], 'age must be an integer')
+
+    def test_422_bulk_post_actors_atomic(self):
+        new_test_actors = [
+            {"name": "Majeed", "age": 22, "gender": "Male"},
+            {"name": "", "age": 30, "gender": "Female"}
+        ]
+        res = self.app.test_client().post('/actors/bulk?atomic=true', json=new_test_actors, headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['results'][0]['error'], 'not applied, batch rejected')
+
+    def test_bulk_patch_movies(self):
+        res = self.app.test_client().patch('/movies/bulk', json=[{"id": 999999, "title": "New Movie"}], headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'][0]['error'], 'resource not found')
+
+    def test_bulk_create_inserts_a_chunk_in_one_statement(self):
+        client = self.app.test_client()
+        new_test_movies = [{"title": f"Batched {i}", "release_date": "2020-01-01"} for i in range(5)]
+        with count_queries() as statements:
+            res = client.post('/movies/bulk', json=new_test_movies, headers=self.header)
+        inserts = [s for s in statements if s.startswith('INSERT INTO movie ')]
+        self.assertEqual(len(inserts), 1)
+        ids = [result['id'] for result in json.loads(res.data)['results']]
+        titles = [json.loads(client.get(f'/movies/{movie_id}', headers=self.header).data)['movie']['title'] for movie_id in ids]
+        self.assertEqual(titles, [movie['title'] for movie in new_test_movies])
+
+    def test_bulk_create_update_delete_round_trip(self):
+        client = self.app.test_client()
+        new_test_movies = [{"title": f"Bulk {i}", "release_date": "2020-01-01"} for i in range(3)]
+        res = client.post('/movies/bulk?chunk_size=2', json=new_test_movies, headers=self.header)
+        ids = [result['id'] for result in json.loads(res.data)['results']]
+        self.assertEqual(len(set(ids)), 3)
+
+        res = client.patch('/movies/bulk', json=[{"id": ids[0], "title": "Bulk renamed"}], headers=self.header)
+        self.assertTrue(json.loads(res.data)['success'])
+        res = client.get(f'/movies/{ids[0]}', headers=self.header)
+        self.assertEqual(json.loads(res.data)['movie']['title'], "Bulk renamed")
+
+        res = client.delete('/movies/bulk', json=ids + [999999], headers=self.header)
+        results = json.loads(res.data)['results']
+        self.assertEqual([result['success'] for result in results], [True, True, True, False])
+        self.assertEqual(client.get(f'/movies/{ids[1]}', headers=self.header).status_code, 404)
+
+
+class ConditionalGetTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+        new_test_actor = {"name": "Majeed", "age": 22, "gender": "Male"}
+        cls.app.test_client().post('/actors', json=new_test_actor, headers=cls.header)
+
+    def test_304_when_etag_matches(self):
+        res = self.app.test_client().get('/actors', headers=self.header)
+        self.assertEqual(res.status_code, 200)
+        headers = dict(self.header, **{'If-None-Match': res.headers['ETag']})
+        res = self.app.test_client().get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_etag_changes_after_write(self):
+        etag = self.app.test_client().get('/actors', headers=self.header).headers['ETag']
+        new_test_actor = {"name": "Sara", "age": 30, "gender": "Female"}
+        self.app.test_client().post('/actors', json=new_test_actor, headers=self.header)
+        headers = dict(self.header, **{'If-None-Match': etag})
+        res = self.app.test_client().get('/actors', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+
+class FilterTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+        for name, age in [("Qadir", 40), ("qasim", 35), ("Qa_ra", 50), ("Qbert", 45)]:
+            new_test_actor = {"name": name, "age": age, "gender": "Male"}
+            cls.app.test_client().post('/actors', json=new_test_actor, headers=cls.header)
+
+    def names(self, query):
+        res = self.app.test_client().get('/actors?' + query, headers=self.header)
+        self.assertEqual(res.status_code, 200)
+        return [actor['name'] for actor in res.get_json()['actors']], res.get_json()['next_cursor']
+
+    def test_name_prefix_is_case_insensitive(self):
+        names, _ = self.names('name_prefix=qa&sort=name')
+        self.assertEqual(names, ['Qa_ra', 'Qadir', 'qasim'])
+
+    def test_like_wildcards_are_literal(self):
+        names, _ = self.names('name_contains=a_r')
+        self.assertEqual(names, ['Qa_ra'])
+
+    def test_range_filter(self):
+        names, _ = self.names('name_prefix=q&age_min=40&age_max=45&sort=name')
+        self.assertEqual(names, ['Qadir', 'Qbert'])
+
+    def test_sorted_pages_follow_cursor(self):
+        first, cursor = self.names('name_prefix=q&sort=-name&limit=2')
+        second, cursor = self.names('name_prefix=q&sort=-name&limit=2&after=' + cursor)
+        self.assertEqual(first + second, ['qasim', 'Qbert', 'Qadir', 'Qa_ra'])
+        self.assertIsNone(cursor)
+
+    def test_400_on_unknown_sort_or_bad_value(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/actors?sort=age', headers=self.header).status_code, 400)
+        self.assertEqual(client.get('/actors?age_min=old', headers=self.header).status_code, 400)
+        _, cursor = self.names('sort=name&limit=1')
+        res = client.get('/actors?sort=-name&after=' + cursor, headers=self.header)
+        self.assertEqual(res.status_code, 400)
+
+
+class CastingTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(
+            ['get:actors', 'get:movies', 'post:actors', 'patch:movies'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+            cls.movie_ids = []
+            for index in range(12):
+                movie = Movie(title=f"Cast {index}", release_date=datetime(2023, 1, index + 1))
+                movie.create()
+                cls.movie_ids.append(movie.id)
+        cls.actor_ids = []
+        for name in ("Lina", "Omar"):
+            new_test_actor = {"name": name, "age": 30, "gender": "Female"}
+            res = cls.app.test_client().post('/actors', json=new_test_actor, headers=cls.header)
+            cls.actor_ids.append(res.get_json()['new_actor']['id'])
+        for movie_id in cls.movie_ids:
+            for actor_id in cls.actor_ids:
+                cls.app.test_client().put(f'/movies/{movie_id}/actors/{actor_id}', headers=cls.header)
+
+    def test_movie_actors(self):
+        movie_id = self.movie_ids[0]
+        res = self.app.test_client().get(f'/movies/{movie_id}/actors', headers=self.header)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in res.get_json()['actors']], self.actor_ids)
+
+    def test_actor_movies_404_for_unknown_actor(self):
+        res = self.app.test_client().get('/actors/99999/movies', headers=self.header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_include_embeds_actors(self):
+        res = self.app.test_client().get(
+            '/movies?include=actors&fields=title&title_prefix=cast&limit=1', headers=self.header)
+        movie = res.get_json()['movies'][0]
+        self.assertEqual(movie['id'], self.movie_ids[0])
+        self.assertEqual([actor['name'] for actor in movie['actors']], ["Lina", "Omar"])
+
+    def test_include_query_count_does_not_grow_with_page(self):
+        counts = []
+        for limit in (2, 12):
+            with count_queries() as statements:
+                res = self.app.test_client().get(
+                    f'/movies?include=actors&title_prefix=cast&limit={limit}', headers=self.header)
+            self.assertEqual(len(res.get_json()['movies']), limit)
+            counts.append(len(statements))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_400_on_unknown_include(self):
+        res = self.app.test_client().get('/movies?include=crew', headers=self.header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_include_needs_permission_to_list_relation(self):
+        movies_only = self.auth_header(['get:movies'])
+        res = self.app.test_client().get('/movies?include=actors', headers=movies_only)
+        self.assertEqual(res.status_code, 401)
+        res = self.app.test_client().get('/movies?include=%20actors&title_prefix=cast', headers=self.header)
+        self.assertEqual(res.status_code, 200)
+
+    def test_nested_list_follows_deletes_of_either_side(self):
+        header = self.auth_header(
+            ['get:actors', 'get:movies', 'post:actors', 'patch:movies', 'delete:actors', 'delete:movies'])
+        client = self.app.test_client()
+        with self.app.app_context():
+            movie = Movie(title="Short lived", release_date=datetime(2023, 2, 1))
+            movie.create()
+            movie_id = movie.id
+        actor_ids = []
+        for name in ("Rami", "Dana"):
+            new_test_actor = {"name": name, "age": 30, "gender": "Male"}
+            actor_ids.append(client.post('/actors', json=new_test_actor, headers=header).get_json()['new_actor']['id'])
+            client.put(f'/movies/{movie_id}/actors/{actor_ids[-1]}', headers=header)
+
+        etag = client.get(f'/movies/{movie_id}/actors', headers=header).headers['ETag']
+        client.delete(f'/actors/{actor_ids[0]}', headers=header)
+        res = client.get(f'/movies/{movie_id}/actors', headers=dict(header, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in res.get_json()['actors']], actor_ids[1:])
+
+        etag = res.headers['ETag']
+        client.delete(f'/movies/{movie_id}', headers=header)
+        res = client.get(f'/movies/{movie_id}/actors', headers=dict(header, **{'If-None-Match': etag}))
+        self.assertEqual(res.status_code, 404)
+
+    def test_uncast(self):
+        movie_id, actor_id = self.movie_ids[-1], self.actor_ids[0]
+        client = self.app.test_client()
+        self.assertEqual(client.delete(f'/movies/{movie_id}/actors/{actor_id}', headers=self.header).status_code, 200)
+        self.assertEqual(client.delete(f'/movies/{movie_id}/actors/{actor_id}', headers=self.header).status_code, 404)
+        res = client.get(f'/actors/{actor_id}/movies?fields=id&limit=1000', headers=self.header)
+        self.assertNotIn(movie_id, [movie['id'] for movie in res.get_json()['movies']])
+
+
+class MetricsTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+        new_test_actor = {"name": "Huda", "age": 28, "gender": "Female"}
+        cls.app.test_client().post('/actors', json=new_test_actor, headers=cls.header)
+
+    def test_server_timing_header(self):
+        with count_queries() as statements:
+            res = self.app.test_client().get('/actors?name_prefix=huda', headers=self.header)
+        timing = dict(entry.split(';', 1) for entry in res.headers['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'auth', 'db', 'serialize', 'total'})
+        self.assertIn(f'desc="queries={len(statements)}"', timing['db'])
+
+    def test_metrics_endpoint(self):
+        self.app.test_client().get('/actors', headers=self.header)
+        res = self.app.test_client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        body = res.get_data(as_text=True)
+        self.assertIn('capstone_request_duration_seconds_count{method="GET",route="/actors"}', body)
+        self.assertIn('capstone_request_phase_seconds_count{phase="db",route="/actors"}', body)
+
+
+class SlowQueryTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors', 'get:diagnostics'])
+        cls.app = create_app({'SLOW_QUERY_MS': 0.0001, 'SLOW_QUERY_EXPLAIN': True})
+        with cls.app.app_context():
+            db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        slow_query_log.init_app(Flask(__name__))
+        slow_query_log.clear()
+        super().tearDownClass()
+
+    def test_normalize_sql(self):
+        sql = "SELECT a  FROM t WHERE id IN (%(id_1)s, %(id_2)s) AND name = 'x''y' LIMIT 10"
+        self.assertEqual(normalize_sql(sql), 'SELECT a FROM t WHERE id IN (?) AND name = ? LIMIT ?')
+        self.assertEqual(redact({'name': 'Majeed', 'age': 22}), {'name': 'str', 'age': 'int'})
+
+    def test_slow_queries_endpoint(self):
+        slow_query_log.clear()
+        new_test_actor = {"name": "Yusuf", "age": 33, "gender": "Male"}
+        self.app.test_client().post('/actors', json=new_test_actor, headers=self.header)
+        res = self.app.test_client().get('/actors?name_prefix=yusuf', headers=self.header)
+        self.assertEqual(res.get_json()['actors'][0]['name'], "Yusuf")
+        res = self.app.test_client().get('/admin/slow-queries', headers=self.header)
+        entries = res.get_json()['slow_queries']
+        select = [entry for entry in entries if 'FROM actor' in entry['sql'] and 'LIKE' in entry['sql']]
+        self.assertEqual(select[0]['last_route'], 'GET /actors')
+        self.assertIsNotNone(select[0]['plan'])
+        self.assertNotIn('yusuf', json.dumps(entries).lower())
+
+    def test_settings_come_from_app_config(self):
+        app = Flask(__name__)
+        app.config.update(SLOW_QUERY_MS=50, SLOW_QUERY_EXPLAIN=True, SLOW_QUERY_EXPLAIN_ANALYZE=True)
+        log = SlowQueryLog()
+        log.init_app(app)
+        self.assertEqual((log.threshold_ms, log.explain, log.explain_analyze), (50.0, True, True))
+
+    def test_slow_queries_needs_permission(self):
+        header = self.auth_header(['get:actors'])
+        res = self.app.test_client().get('/admin/slow-queries', headers=header)
+        self.assertEqual(res.status_code, 401)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, .50), 50)
+        self.assertEqual(benchmark.percentile(values, .99), 99)
+        self.assertEqual(benchmark.percentile([7], .95), 7)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'routes': {'actors_page': {'p95_ms': 10.0, 'throughput_rps': 100.0}}}
+        results = {'routes': {'actors_page': {'p95_ms': 10.5, 'throughput_rps': 80.0}}}
+        comparison = benchmark.compare(results, baseline, tolerance=0.1)
+        self.assertFalse(comparison['routes.actors_page.p95_ms']['regression'])
+        self.assertTrue(comparison['routes.actors_page.throughput_rps']['regression'])
+
+    def test_any_status_but_2xx_is_an_error(self):
+        summary = benchmark.summarize(
+            [0.01, 0.02, 0.03], {'200': 1, '202': 1, '404': 1}, 1.0)
+        self.assertEqual(summary['errors'], 1)
+
+
+class PermissionRegistryTestCase(unittest.TestCase):
+    def test_masks_and_roles(self):
+        registry = PermissionRegistry(
+            ['get:actors', 'post:actors'], {'Reader': ['get:actors']})
+        granted = registry.mask(['get:actors', 'not:registered'])
+        self.assertEqual(registry.names(granted), ['get:actors'])
+        self.assertEqual(registry.role_names(granted), ['Reader'])
+        self.assertEqual(registry.bit('delete:actors'), 4)
+
+
+class PermissionsEndpointTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def test_route_table(self):
+        header = self.auth_header(['get:actors', 'get:movies', 'get:diagnostics'])
+        res = self.app.test_client().get('/admin/permissions', headers=header)
+        data = res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertIn({'rule': '/movies/<int:movie_id>', 'methods': ['DELETE'],
+                       'permission': 'delete:movies', 'roles': ['Executive Producer']}, data['routes'])
+        self.assertEqual(data['granted']['roles'], ['Casting Director'])
+
+    def test_missing_permission(self):
+        header = self.auth_header(['get:movies'])
+        res = self.app.test_client().get('/actors', headers=header)
+        self.assertEqual(res.status_code, 401)
+
+    def test_missing_permissions_claim(self):
+        token = jwt.encode({
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'exp': int(time.time()) + 3600
+        }, self.private_key, algorithm='RS256', headers={'kid': 'local-key'})
+        res = self.app.test_client().get('/actors', headers={'Authorization': 'Bearer ' + token})
+        self.assertEqual(res.status_code, 400)
+
+
+class IdempotencyTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def post(self, key, actor):
+        headers = dict(self.header, **{'Idempotency-Key': key})
+        return self.app.test_client().post('/actors', json=actor, headers=headers)
+
+    def count(self, name):
+        with self.app.app_context():
+            return Actor.query.filter(Actor.name == name).count()
+
+    def test_retry_is_replayed(self):
+        new_test_actor = {"name": "Retry Once", "age": 40, "gender": "Male"}
+        first = self.post('retry-1', new_test_actor)
+        idempotency_store.clear()
+        second = self.post('retry-1', new_test_actor)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.get_json(), first.get_json())
+        self.assertEqual(self.count("Retry Once"), 1)
+
+    def test_concurrent_duplicates_insert_once(self):
+        new_test_actor = {"name": "Many Retries", "age": 40, "gender": "Male"}
+        with ThreadPoolExecutor(6) as executor:
+            responses = list(executor.map(
+                lambda _: self.post('retry-2', new_test_actor), range(6)))
+        self.assertEqual({res.status_code for res in responses}, {200})
+        self.assertEqual(len({res.get_json()['new_actor']['id'] for res in responses}), 1)
+        self.assertEqual(self.count("Many Retries"), 1)
+
+    def test_key_reused_with_other_body(self):
+        self.post('retry-3', {"name": "First Body", "age": 40, "gender": "Male"})
+        res = self.post('retry-3', {"name": "Second Body", "age": 40, "gender": "Male"})
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(self.count("Second Body"), 0)
+
+    def test_replay_keeps_response_headers(self):
+        headers = dict(self.header, **{'Idempotency-Key': 'retry-4'})
+        spec = {'kind': 'export', 'resource': 'actors'}
+        first = self.app.test_client().post('/jobs', json=spec, headers=headers)
+        idempotency_store.clear()
+        second = self.app.test_client().post('/jobs', json=spec, headers=headers)
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.headers['Location'], first.headers['Location'])
+        self.assertEqual(second.headers.getlist('Content-Type'), ['application/json'])
+        with self.app.app_context():
+            Job.query.delete()
+            db.session.commit()
+
+    def test_claim_of_a_lost_request_expires_after_the_lease(self):
+        new_test_actor = {"name": "Lost Claim", "age": 40, "gender": "Male"}
+        headers = dict(self.header, **{'Idempotency-Key': 'retry-5'})
+        # the request claims the key, then its worker dies before complete()
+        with self.app.test_request_context('/actors', method='POST', json=new_test_actor, headers=headers):
+            _request_ctx_stack.top.current_user = {'sub': 'auth0|test'}
+            key = idempotency_key()
+            self.assertIsNone(idempotency_store.claim(key, request_fingerprint()))
+            expires_at = IdempotencyRecord.query.get(key).expires_at
+        self.assertLessEqual(expires_at, datetime.utcnow() + timedelta(seconds=idempotency_store.lease))
+        self.assertEqual(self.post('retry-5', new_test_actor).status_code, 409)
+        # a different body under the same key is rejected at once
+        self.assertEqual(self.post('retry-5', dict(new_test_actor, age=41)).status_code, 422)
+
+        with self.app.app_context():
+            IdempotencyRecord.query.get(key).expires_at = datetime.utcnow()
+            db.session.commit()
+        self.assertEqual(self.post('retry-5', new_test_actor).status_code, 200)
+        self.assertEqual(self.count("Lost Claim"), 1)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_concurrent_calls_share_one_run(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        runs = []
+
+        def build():
+            runs.append(1)
+            started.set()
+            release.wait(5)
+            return 'body'
+
+        with ThreadPoolExecutor(4) as executor:
+            leader = executor.submit(flight.do, 'key', build)
+            started.wait(5)
+            followers = [executor.submit(flight.do, 'key', build) for _ in range(3)]
+            time.sleep(0.05)
+            release.set()
+            results = [leader.result()] + [follower.result() for follower in followers]
+        self.assertEqual(results, ['body'] * 4)
+        self.assertEqual(len(runs), 1)
+
+    def test_errors_are_not_cached(self):
+        flight = SingleFlight(micro_cache_ms=1000)
+        with self.assertRaises(ValueError):
+            flight.do('key', lambda: int('x'))
+        self.assertEqual(flight.do('key', lambda: 'body'), 'body')
+
+    def test_micro_cache_window(self):
+        self.now = 100.0
+        flight = SingleFlight(micro_cache_ms=500, clock=lambda: self.now)
+        flight.do('key', lambda: 'first')
+        self.assertEqual(flight.do('key', lambda: 'second'), 'first')
+        self.now += 1
+        self.assertEqual(flight.do('key', lambda: 'third'), 'third')
+
+
+class CountingGzip(Gzip):
+    calls = 0
+
+    def compress(self, body):
+        CountingGzip.calls += 1
+        return super().compress(body)
+
+
+class CompressionTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+        client = cls.app.test_client()
+        for index in range(40):
+            new_test_actor = {"name": f"Compressed Actor {index}", "age": 30, "gender": "Female"}
+            client.post('/actors', json=new_test_actor, headers=cls.header)
+
+    def setUp(self):
+        set_cache_backend(MemoryBackend())
+        self.saved_encoders = compressor.encoders
+
+    def tearDown(self):
+        compressor.encoders = self.saved_encoders
+
+    def get(self, url, encoding=None, **headers):
+        if encoding is not None:
+            headers['Accept-Encoding'] = encoding
+        return self.app.test_client().get(url, headers=dict(self.header, **headers))
+
+    def test_gzip_when_accepted(self):
+        plain = self.get('/actors?limit=100')
+        res = self.get('/actors?limit=100', 'gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertLess(len(res.data), len(plain.data))
+
+    def test_compressed_etag_revalidates(self):
+        etag = self.get('/actors?limit=100', 'gzip').headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        res = self.get('/actors?limit=100', 'gzip', **{'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+    def test_identity_when_refused_or_small(self):
+        res = self.get('/actors?limit=100', 'gzip;q=0')
+        self.assertNotIn('Content-Encoding', res.headers)
+        res = self.get('/actors?limit=1', 'gzip')
+        self.assertNotIn('Content-Encoding', res.headers)
+
+    def test_compressed_variant_is_cached(self):
+        compressor.encoders = [CountingGzip()]
+        CountingGzip.calls = 0
+        bodies = [self.get('/actors?limit=100', 'gzip').data for _ in range(3)]
+        self.assertEqual(CountingGzip.calls, 1)
+        self.assertEqual(len(set(bodies)), 1)
+
+    def test_streamed_export(self):
+        plain = self.get('/actors?export=ndjson')
+        res = self.get('/actors?export=ndjson', 'gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+
+
+class RateLimitTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors'])
+        cls.app = create_app({'RATE_LIMITS': 'get:actors=2/minute'})
+        with cls.app.app_context():
+            db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        rate_limiter.init_app(Flask(__name__))
+        super().tearDownClass()
+
+    def setUp(self):
+        self.saved_buckets = rate_limiter.buckets
+        rate_limiter.buckets = MemoryBuckets()
+
+    def tearDown(self):
+        rate_limiter.buckets = self.saved_buckets
+
+    def test_429_with_retry_after_once_budget_is_spent(self):
+        client = self.app.test_client()
+        statuses = [client.get('/actors?limit=1', headers=self.header).status_code for _ in range(3)]
+        self.assertNotIn(429, statuses[:2])
+        self.assertEqual(statuses[2], 429)
+        res = client.get('/actors?limit=1', headers=self.header)
+        self.assertEqual(res.get_json()['error'], 429)
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+    def test_budgets_are_per_client_and_permission(self):
+        client = self.app.test_client()
+        for _ in range(3):
+            client.get('/actors?limit=1', headers=self.header)
+        other = self.auth_header(['get:actors'], 'auth0|other')
+        self.assertNotEqual(client.get('/actors?limit=1', headers=other).status_code, 429)
+        new_test_actor = {"name": "Limited", "age": 30, "gender": "Male"}
+        self.assertEqual(client.post('/actors', json=new_test_actor, headers=self.header).status_code, 200)
+
+    def test_memory_buckets_refill(self):
+        self.now = 0.0
+        buckets = MemoryBuckets(clock=lambda: self.now)
+        rate = Rate.parse('2/second')
+        self.assertEqual([buckets.take('a', rate) for _ in range(3)][:2], [0, 0])
+        self.assertAlmostEqual(buckets.take('a', rate), 0.5)
+        self.now += 0.5
+        self.assertEqual(buckets.take('a', rate), 0)
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_buckets(self):
+        client = fakeredis.FakeStrictRedis()
+        try:
+            client.eval('return 1', 0)
+        except Exception:
+            self.skipTest('fakeredis has no Lua support')
+        buckets = RedisBuckets(client, clock=lambda: 1000.0)
+        rate = Rate.parse('2/minute')
+        self.assertEqual([buckets.take('a', rate) for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(buckets.take('a', rate), 30.0)
+        self.assertEqual(buckets.take('b', rate), 0)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            Rate.parse('10 per minute')
+
+
+class LoadSheddingTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors'])
+        cls.app = create_app({'LOAD_SHED_POOL_WAIT_MS': 100})
+        with cls.app.app_context():
+            db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        load_shedder.max_pool_wait_ms = 0
+        super().tearDownClass()
+
+    def setUp(self):
+        self.saved_pool_wait = load_shedder.pool_wait
+
+    def tearDown(self):
+        load_shedder.pool_wait = self.saved_pool_wait
+
+    def test_503_while_pool_waits_are_long(self):
+        client = self.app.test_client()
+        in_flight = load_shedder.in_flight
+        load_shedder.pool_wait = lambda: 0.5
+        res = client.get('/actors', headers=self.header)
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        self.assertEqual(client.get('/metrics').status_code, 200)
+        load_shedder.pool_wait = lambda: 0.01
+        self.assertNotEqual(client.get('/actors', headers=self.header).status_code, 503)
+        self.assertEqual(load_shedder.in_flight, in_flight)
+
+    def test_in_flight_limit(self):
+        shedder = LoadShedder(max_in_flight=2, pool_wait=lambda: 0)
+        shedder.in_flight = 2
+        self.assertIsNone(shedder.overloaded())
+        shedder.in_flight = 3
+        self.assertEqual(shedder.overloaded(), 'in_flight')
+
+    def test_recent_pool_wait_decays(self):
+        self.now = 0.0
+        stats = PoolStats(clock=lambda: self.now)
+        for _ in range(20):
+            stats.record(1.0)
+        self.assertGreater(stats.recent_wait(), 0.9)
+        self.now += 20
+        self.assertLess(stats.recent_wait(), 0.01)
+
+
+class ChangeFeedTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header([
+            'get:changes', 'get:actors', 'get:movies', 'post:actors',
+            'patch:actors', 'delete:actors', 'post:movies'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def head(self):
+        return self.app.test_client().get('/changes', headers=self.header).get_json()['next_since']
+
+    def changes(self, since, header=None, **args):
+        query = '&'.join(f'{key}={value}' for key, value in dict(since=since, **args).items())
+        return self.app.test_client().get(f'/changes?{query}', headers=header or self.header).get_json()
+
+    def test_create_update_delete_are_logged_in_order(self):
+        since = self.head()
+        client = self.app.test_client()
+        new_test_actor = {"name": "Logged", "age": 30, "gender": "Female"}
+        actor_id = client.post('/actors', json=new_test_actor, headers=self.header).get_json()['new_actor']['id']
+        client.patch(f'/actors/{actor_id}', json={'age': 31}, headers=self.header)
+        res = self.changes(since)
+        self.assertEqual([(c['table'], c['id'], c['op']) for c in res['changes']],
+                         [('actor', actor_id, 'create'), ('actor', actor_id, 'update')])
+        self.assertEqual(res['changes'][-1]['data']['age'], 31)
+        self.assertEqual(res['next_since'], res['changes'][-1]['seq'])
+
+        client.delete(f'/actors/{actor_id}', headers=self.header)
+        res = self.changes(res['next_since'])
+        self.assertEqual([(c['op'], c['data']) for c in res['changes']], [('delete', None)])
+
+    def test_pages_and_permissions(self):
+        since = self.head()
+        client = self.app.test_client()
+        client.post('/actors/bulk', json=[{"name": f"Bulk {i}", "age": 20, "gender": "Male"} for i in range(3)], headers=self.header)
+        client.post('/movies/bulk', json=[{"title": "Logged", "release_date": "2020-01-01"}], headers=self.header)
+        res = self.changes(since, limit=2)
+        self.assertEqual(len(res['changes']), 2)
+        self.assertTrue(res['more'])
+        rest = self.changes(res['next_since'])
+        self.assertEqual([c['table'] for c in rest['changes']], ['actor', 'movie'])
+
+        actors_only = self.auth_header(['get:changes', 'get:actors'])
+        self.assertEqual({c['table'] for c in self.changes(since, actors_only)['changes']}, {'actor'})
+        res = self.app.test_client().get('/changes', headers=self.auth_header(['get:actors']))
+        self.assertEqual(res.status_code, 401)
+
+    def test_wait_is_not_woken_by_changes_it_cannot_see(self):
+        since = self.head()
+        # a change in a table the reader cannot see, already committed
+        notifier.notify(since + 1)
+        with self.app.app_context(), count_queries() as statements:
+            started = time.perf_counter()
+            self.assertFalse(wait_for_changes(since, ['movie'], 0.3))
+        self.assertGreaterEqual(time.perf_counter() - started, 0.3)
+        self.assertLessEqual(len(statements), 3)
+
+    def test_long_poll_returns_when_a_change_commits(self):
+        since = self.head()
+        new_test_actor = {"name": "Awaited", "age": 30, "gender": "Male"}
+
+        def write():
+            time.sleep(0.2)
+            self.app.test_client().post('/actors', json=new_test_actor, headers=self.header)
+
+        writer = threading.Thread(target=write)
+        started = time.perf_counter()
+        writer.start()
+        res = self.changes(since, wait=10)
+        writer.join()
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual(res['changes'][0]['data']['name'], 'Awaited')
+
+    def test_compaction_and_retention(self):
+        since = self.head()
+        client = self.app.test_client()
+        new_test_actor = {"name": "Compacted", "age": 30, "gender": "Male"}
+        actor_id = client.post('/actors', json=new_test_actor, headers=self.header).get_json()['new_actor']['id']
+        client.patch(f'/actors/{actor_id}', json={'age': 31}, headers=self.header)
+        with self.app.app_context():
+            compact_change_log()
+        self.assertEqual([c['op'] for c in self.changes(since)['changes']], ['update'])
+
+        with self.app.app_context():
+            purge_change_log(0, now=datetime.utcnow() + timedelta(minutes=1))
+        res = self.app.test_client().get(f'/changes?since={since}', headers=self.header)
+        self.assertEqual(res.status_code, 410)
+        self.assertEqual(self.changes(self.head())['changes'], [])
+
+    def test_400_on_bad_arguments(self):
+        for query in ('since=x', 'since=-1', 'since=0&limit=0', 'since=0&wait=x'):
+            res = self.app.test_client().get(f'/changes?{query}', headers=self.header)
+            self.assertEqual(res.status_code, 400)
+
+
+class EventStreamTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'get:movies', 'post:actors', 'post:movies', 'get:changes'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def open_stream(self, header, **headers):
+        res = self.app.test_client().get('/events', headers=dict(header, **headers), buffered=False)
+        self.addCleanup(res.close)
+        chunks = iter(res.iter_encoded())
+        self.assertEqual(next(chunks), b'retry: 2000\n\n')
+        return chunks
+
+    def add_actor(self, name):
+        new_test_actor = {"name": name, "age": 30, "gender": "Female"}
+        res = self.app.test_client().post('/actors', json=new_test_actor, headers=self.header)
+        return res.get_json()['new_actor']['id']
+
+    def test_commits_are_pushed(self):
+        chunks = self.open_stream(self.header)
+        actor_id = self.add_actor('Pushed')
+        event = next(chunks).decode()
+        self.assertIn('event: change\n', event)
+        self.assertIn(f'"id":{actor_id},"op":"create"', event)
+        self.assertIn('"table":"actor"', event)
+
+    def test_events_are_filtered_by_permission(self):
+        chunks = self.open_stream(self.auth_header(['get:movies']))
+        self.add_actor('Hidden')
+        self.app.test_client().post('/movies/bulk', json=[{"title": "Shown", "release_date": "2020-01-01"}], headers=self.header)
+        self.assertIn('"table":"movie"', next(chunks).decode())
+        res = self.app.test_client().get('/events', headers=self.auth_header(['post:actors']))
+        self.assertEqual(res.status_code, 401)
+
+    def test_resume_from_last_event_id(self):
+        since = self.app.test_client().get('/changes', headers=self.header).get_json()['next_since']
+        first, second = self.add_actor('Missed 1'), self.add_actor('Missed 2')
+        chunks = self.open_stream(self.header, **{'Last-Event-ID': str(since)})
+        self.assertIn(f'"id":{first}', next(chunks).decode())
+        self.assertIn(f'"id":{second}', next(chunks).decode())
+
+    def test_stream_unsubscribes_on_close(self):
+        subscribers = len(broadcaster)
+        res = self.app.test_client().get('/events', headers=self.header, buffered=False)
+        self.assertEqual(len(broadcaster), subscribers + 1)
+        res.close()
+        self.assertEqual(len(broadcaster), subscribers)
+
+    def test_slow_client_is_dropped_not_buffered(self):
+        hub = Broadcaster()
+        slow = hub.subscribe(~0, size=3)
+        fast = hub.subscribe(~0, size=10)
+        hub.publish([{'seq': i, 'table': 'actor', 'id': i, 'op': 'update'} for i in range(5)])
+        self.assertTrue(slow.overflowed)
+        self.assertEqual(slow.get(0), [])
+        self.assertEqual(len(fast.get(0)), 5)
+
+    def test_bridge_follows_the_database(self):
+        self.addCleanup(events.set_bridge, events.bridge)
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://localhost/capstone'
+        init_events(app)
+        self.assertIsInstance(events.bridge, events.PostgresBridge)
+        # LISTEN through a transaction-mode pooler hears nothing
+        app.config['DB_EXTERNAL_POOLER'] = True
+        init_events(app)
+        self.assertIsInstance(events.bridge, events.LocalBridge)
+        app.config['EVENTS_LISTEN_URL'] = 'postgres://localhost/capstone'
+        init_events(app)
+        self.assertEqual(events.bridge.listen_url, 'postgres://localhost/capstone')
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        init_events(app)
+        self.assertIsInstance(events.bridge, events.LocalBridge)
+
+    def test_notify_payloads_stay_small(self):
+        events = [{'seq': i, 'table': 'actor', 'id': i, 'op': 'update'} for i in range(500)]
+        payloads = list(notify_payloads(events))
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(payload) <= NOTIFY_MAX_BYTES for payload in payloads))
+        self.assertEqual(sum(len(json.loads(payload)) for payload in payloads), 500)
+
+
+class FlakyJob:
+    def __init__(self, failures):
+        self.failures = failures
+
+    def validate(self, spec):
+        return {}
+
+    def permission(self, params):
+        return 'get:actors'
+
+    def max_attempts(self, params):
+        return 2
+
+    def run(self, params):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('flaky')
+        return [b'done'], 'text/plain'
+
+
+class JobQueueTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'get:movies', 'post:actors', 'post:movies'])
+        # no worker threads: the tests run jobs with run_pending
+        cls.app = create_app({'JOB_WORKER_THREADS': 0})
+        with cls.app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        jobs.JOB_KINDS.pop('flaky', None)
+        with self.app.app_context():
+            JobResultChunk.query.delete()
+            Job.query.delete()
+            db.session.commit()
+
+    def enqueue(self, spec, header=None):
+        return self.app.test_client().post('/jobs', json=spec, headers=header or self.header)
+
+    def test_bulk_import_runs_in_the_background(self):
+        items = [{"name": f"Queued {i}", "age": 20, "gender": "Male"} for i in range(3)]
+        res = self.enqueue({'kind': 'bulk', 'resource': 'actors', 'method': 'POST', 'items': items})
+        self.assertEqual(res.status_code, 202)
+        job = res.get_json()['job']
+        self.assertEqual(job['status'], 'queued')
+        self.assertTrue(res.headers['Location'].endswith(f'/jobs/{job["id"]}'))
+
+        client = self.app.test_client()
+        self.assertEqual(client.get(f'/jobs/{job["id"]}/result', headers=self.header).status_code, 409)
+        self.assertEqual(job_runner.run_pending(self.app), 1)
+        status = client.get(f'/jobs/{job["id"]}', headers=self.header).get_json()['job']
+        self.assertEqual((status['status'], status['attempts']), ('succeeded', 1))
+        result = client.get(f'/jobs/{job["id"]}/result', headers=self.header).get_json()
+        self.assertTrue(result['success'])
+        self.assertEqual(len(result['results']), 3)
+
+    def test_export_result_and_access(self):
+        self.app.test_client().post('/movies/bulk', json=[{"title": "Exported", "release_date": "2020-01-01"}], headers=self.header)
+        job = self.enqueue({'kind': 'export', 'resource': 'movies', 'format': 'ndjson',
+                            'query': {'fields': 'id,title', 'title': 'Exported'}}).get_json()['job']
+        job_runner.run_pending(self.app)
+        res = self.app.test_client().get(f'/jobs/{job["id"]}/result', headers=self.header)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertIn(b'"title":"Exported"', res.data)
+
+        other = self.auth_header(['get:movies'], sub='auth0|other')
+        self.assertEqual(self.app.test_client().get(f'/jobs/{job["id"]}', headers=other).status_code, 404)
+        self.assertEqual(self.enqueue({'kind': 'export', 'resource': 'movies'}, self.auth_header(['get:actors'])).status_code, 401)
+        self.assertEqual(self.enqueue({'kind': 'export', 'resource': 'movies', 'query': {'sort': 'nope'}}).status_code, 400)
+        self.assertEqual(self.enqueue({'kind': 'unknown'}).status_code, 400)
+
+    def test_result_is_stored_and_read_in_chunks(self):
+        jobs.JOB_KINDS['flaky'] = FlakyJob(failures=0)
+        job_id = self.enqueue({'kind': 'flaky'}).get_json()['job']['id']
+        with self.app.app_context():
+            jobs.store_result(job_id, iter([b'ab', b'cd', b'e']), chunk_bytes=3)
+            db.session.commit()
+            self.assertEqual(list(jobs.result_chunks(job_id)), [b'abcd', b'e'])
+
+            job = Job.query.get(job_id)
+            job.status, job.finished_at = 'succeeded', datetime.utcnow()
+            db.session.commit()
+            jobs.expire_jobs(ttl=0, now=datetime.utcnow() + timedelta(seconds=1))
+            self.assertEqual(JobResultChunk.query.count(), 0)
+        res = self.app.test_client().get(f'/jobs/{job_id}/result', headers=self.header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_failed_job_is_retried_after_backoff(self):
+        jobs.JOB_KINDS['flaky'] = FlakyJob(failures=1)
+        job_id = self.enqueue({'kind': 'flaky'}).get_json()['job']['id']
+        job_runner.run_pending(self.app)
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            self.assertEqual((job.status, job.attempts, job.error), ('queued', 1, 'flaky'))
+            self.assertGreater(job.run_after, datetime.utcnow())
+        # not due yet
+        self.assertEqual(job_runner.run_pending(self.app), 0)
+        with self.app.app_context():
+            Job.query.get(job_id).run_after = datetime.utcnow()
+            db.session.commit()
+        self.assertEqual(job_runner.run_pending(self.app), 1)
+        res = self.app.test_client().get(f'/jobs/{job_id}/result', headers=self.header)
+        self.assertEqual(res.data, b'done')
+
+    def test_job_of_a_lost_worker_is_claimed_again(self):
+        jobs.JOB_KINDS['flaky'] = FlakyJob(failures=0)
+        job_id = self.enqueue({'kind': 'flaky'}).get_json()['job']['id']
+        with self.app.app_context():
+            self.assertEqual(jobs.claim('lost', {'flaky': 1}).id, job_id)
+            # the kind is at its concurrency limit while the lease holds
+            self.assertIsNone(jobs.claim('other', {'flaky': 1}))
+            later = datetime.utcnow() + timedelta(seconds=jobs.JOB_LEASE_SECONDS + 1)
+            job = jobs.claim('other', {'flaky': 1}, now=later)
+            self.assertEqual((job.id, job.locked_by, job.attempts), (job_id, 'other', 2))
+
+            # out of attempts, a lost job fails instead
+            jobs.expire_jobs(now=later + timedelta(seconds=jobs.JOB_LEASE_SECONDS + 1))
+            job = Job.query.get(job_id)
+            self.assertEqual((job.status, job.error), ('failed', 'worker lost'))
+
+    def test_queued_jobs_per_client_are_limited(self):
+        jobs.JOB_KINDS['flaky'] = FlakyJob(failures=0)
+        for _ in range(jobs.JOB_MAX_QUEUED_PER_CLIENT):
+            self.enqueue({'kind': 'flaky'})
+        res = self.enqueue({'kind': 'flaky'})
+        self.assertEqual(res.status_code, 429)
+        self.assertIn('Retry-After', res.headers)
+
+
+class StartupTestCase(LocalAuthTestCase):
+    def test_create_app_does_not_connect(self):
+        app = create_app()
+        self.assertEqual(app.extensions['sqlalchemy'].connectors, {})
+        # Flask-Migrate is only set up for the flask command
+        self.assertNotIn('migrate', app.extensions)
+        self.assertIn('create_app', startup.startup_report.phases)
+
+    def test_ready_warms_up_pool_and_jwks(self):
+        app = create_app({'WARM_UP': True})
+        fetches = auth.jwks_cache.fetch_count
+        summary = startup.ready(app)
+        self.assertEqual(auth.jwks_cache.fetch_count, fetches + 1)
+        self.assertIn(None, app.extensions['sqlalchemy'].connectors)
+        self.assertIn('pool', summary)
+        # keys inherited from the master are not fetched again
+        startup.ready(app)
+        self.assertEqual(auth.jwks_cache.fetch_count, fetches + 1)
+
+    def test_report_counts_imports_once(self):
+        ticks = iter([10.5, 11.0, 13.5])
+        report = startup.StartupReport(started=10.0, clock=lambda: next(ticks))
+        report.imported()
+        with report.phase('create_app'):
+            pass
+        report.imported()
+        self.assertEqual(report.phases, {'import': 0.5, 'create_app': 2.5})
+        self.assertTrue(report.summary().startswith('started in 3000ms'))
+
+    def test_connection_from_parent_process_is_replaced(self):
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool)
+        with engine.connect() as connection:
+            parent = connection.connection.connection
+        real_getpid = os.getpid
+        dbpool.os.getpid = lambda: real_getpid() + 1
+        try:
+            with engine.connect() as connection:
+                self.assertIsNot(connection.connection.connection, parent)
+        finally:
+            dbpool.os.getpid = real_getpid
+
+
+class ResourceCacheTestCase(LocalAuthTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.header = cls.auth_header(['get:actors', 'post:actors', 'patch:actors'])
+        cls.app = create_app()
+        with cls.app.app_context():
+            db.create_all()
+
+    def setUp(self):
+        if fakeredis is None:
+            self.skipTest('fakeredis is not installed')
+        self.redis = fakeredis.FakeStrictRedis()
+        set_cache_backend(RedisBackend(self.redis))
+        self.addCleanup(set_cache_backend, MemoryBackend())
+
+    def add_actor(self, name):
+        new_test_actor = {"name": name, "age": 22, "gender": "Male"}
+        res = self.app.test_client().post('/actors', json=new_test_actor, headers=self.header)
+        return json.loads(res.data)['new_actor']['id']
+
+    def test_get_actor_by_id(self):
+        actor_id = self.add_actor("Majeed")
+        res = self.app.test_client().get(f'/actors/{actor_id}', headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['id'], actor_id)
+
+    def test_404_get_actor_by_id(self):
+        res = self.app.test_client().get('/actors/999999', headers=self.header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['message'], 'resource not found')
+
+    def test_cache_hit_does_not_query_the_database(self):
+        actor_id = self.add_actor("Cached")
+        client = self.app.test_client()
+        client.get(f'/actors/{actor_id}', headers=self.header)
+        with count_queries() as statements:
+            res = client.get(f'/actors/{actor_id}', headers=self.header)
+        self.assertEqual(json.loads(res.data)['actor']['name'], "Cached")
+        self.assertEqual(statements, [])
+
+    def test_actor_lookup_is_invalidated_on_update(self):
+        actor_id = self.add_actor("Majeed")
+        other_id = self.add_actor("Untouched")
+        client = self.app.test_client()
+        client.get(f'/actors/{actor_id}', headers=self.header)
+        client.get(f'/actors/{other_id}', headers=self.header)
+        self.assertTrue(self.redis.exists(f'capstone:actor:{actor_id}'))
+
+        client.patch(f'/actors/{actor_id}', json={'age': 23}, headers=self.header)
+        self.assertFalse(self.redis.exists(f'capstone:actor:{actor_id}'))
+        # other rows of the table stay cached
+        self.assertTrue(self.redis.exists(f'capstone:actor:{other_id}'))
+        res = client.get(f'/actors/{actor_id}', headers=self.header)
+        self.assertEqual(json.loads(res.data)['actor']['age'], 23)
+
+    def test_rolled_back_write_keeps_the_entry(self):
+        actor_id = self.add_actor("Kept")
+        self.app.test_client().get(f'/actors/{actor_id}', headers=self.header)
+        with self.app.app_context():
+            record_change(Actor, [actor_id])
+            db.session.rollback()
+        self.assertTrue(self.redis.exists(f'capstone:actor:{actor_id}'))
+
+    def test_lookups_are_not_cached_per_worker(self):
+        # another worker's write could not remove them
+        backend = MemoryBackend()
+        set_cache_backend(backend)
+        actor_id = self.add_actor("Per Worker")
+        self.app.test_client().get(f'/actors/{actor_id}', headers=self.header)
+        self.assertEqual(backend.size, 0)
+
+
+class CacheBackendTestCase(unittest.TestCase):
+    def test_memory_backend_evicts_by_size(self):
+        backend = MemoryBackend(max_bytes=10)
+        backend.set('a', b'12345', 60)
+        backend.set('b', b'123456', 60)
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.get('b'), b'123456')
+        self.assertEqual(backend.size, 6)
+
+    def test_memory_backend_expires_entries(self):
+        now = [0]
+        backend = MemoryBackend(clock=lambda: now[0])
+        backend.set('a', b'1', 60)
+        now[0] = 60
+        self.assertIsNone(backend.get('a'))
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_backend(self):
+        backend = RedisBackend(fakeredis.FakeStrictRedis())
+        backend.set('a', b'1', 60)
+        self.assertEqual(backend.get('a'), b'1')
+        backend.delete_many(['a'])
+        self.assertIsNone(backend.get('a'))
+
+
+class SerializerTestCase(unittest.TestCase):
+    data = {
+        'success': True,
+        'movies': [
+            {'id': 1, 'title': 'FSND', 'release date': datetime(2023, 1, 26)},
+            {'id': 2, 'title': 'Caf\u00e9 \u00fcber', 'release date': datetime(2000, 12, 12, 8, 30)}
+        ],
+        'next_cursor': None
+    }
+
+    def assert_matches_jsonify(self, serializer):
+        with Flask(__name__).test_request_context():
+            serializers.set_serializer(serializer)
+            try:
+                body = serializers.json_response(self.data).get_data()
+            finally:
+                serializers.set_serializer(serializers.create_serializer())
+            self.assertEqual(body, jsonify(self.data).get_data())
+
+    def test_stdlib_serializer_matches_jsonify(self):
+        self.assert_matches_jsonify(serializers.StdlibSerializer())
+
+    @unittest.skipIf(serializers.orjson is None, 'orjson is not installed')
+    def test_orjson_serializer_matches_jsonify(self):
+        self.assert_matches_jsonify(serializers.OrjsonSerializer())
+
+
+class PoolTestCase(unittest.TestCase):
+    def test_sqlite_keeps_default_engine_options(self):
+        self.assertEqual(engine_options('sqlite:///capstone.db'), {})
+
+    def test_pool_metrics_record_checkout_timeouts(self):
+        engine = create_engine(
+            'sqlite://', poolclass=TimedQueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=0.01)
+        connection = engine.connect()
+        with self.assertRaises(PoolTimeoutError):
+            engine.connect()
+        metrics = pool_metrics(engine)
+        connection.close()
+        self.assertEqual(metrics['checked_out'], 1)
+        self.assertEqual(metrics['timeouts'], 1)
+
+    def test_pool_is_exported_on_metrics(self):
+        engine = name_pool(create_engine(
+            'sqlite:////tmp/pool-metrics.db', poolclass=TimedQueuePool,
+            pool_size=1, max_overflow=1, pool_timeout=0.01))
+        labels = {'database': '/tmp/pool-metrics.db'}
+        first, second = engine.connect(), engine.connect()
+        self.assertEqual(REGISTRY.get_sample_value('capstone_db_pool_checked_out', labels), 2)
+        self.assertEqual(REGISTRY.get_sample_value('capstone_db_pool_overflow', labels), 1)
+        with self.assertRaises(PoolTimeoutError):
+            engine.connect()
+        second.close()
+        first.close()
+        self.assertEqual(REGISTRY.get_sample_value('capstone_db_pool_checked_out', labels), 0)
+        self.assertEqual(REGISTRY.get_sample_value('capstone_db_pool_timeouts_total', labels), 1)
+        self.assertEqual(REGISTRY.get_sample_value('capstone_db_pool_wait_seconds_count', labels), 3)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.cache = TokenCache(maxsize=2, clock=lambda: self.now)
+
+    def test_cached_payload_is_served_until_exp(self):
+        payload = {'sub': 'a', 'exp': 1100}
+        self.cache.put('token-a', payload)
+        self.assertEqual(self.cache.get('token-a'), payload)
+        self.now = 1100
+        self.assertIsNone(self.cache.get('token-a'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_least_recently_used_token_is_evicted(self):
+        self.cache.put('token-a', {'exp': 2000})
+        self.cache.put('token-b', {'exp': 2000})
+        self.cache.get('token-a')
+        self.cache.put('token-c', {'exp': 2000})
+        self.assertIsNone(self.cache.get('token-b'))
+        self.assertIsNotNone(self.cache.get('token-a'))
+        self.assertIsNotNone(self.cache.get('token-c'))
+
+    def test_lookups_are_exported_on_metrics(self):
+        def lookups(result):
+            return REGISTRY.get_sample_value(
+                'capstone_token_cache_lookups_total', {'result': result}) or 0
+        hits, misses = lookups('hit'), lookups('miss')
+        self.cache.put('token-a', {'exp': 2000})
+        self.cache.get('token-a')
+        self.cache.get('token-b')
+        self.assertEqual(lookups('hit'), hits + 1)
+        self.assertEqual(lookups('miss'), misses + 1)
+
+    def test_tokens_without_exp_are_not_cached(self):
+        self.cache.put('token-a', {'sub': 'a'})
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file